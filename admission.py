@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from broadcast import TokenBucket
+
+__all__ = ["Admission", ]
+
+logger = logging.getLogger(__name__)
+
+
+class _Chat:
+    # Token bucket of one chat and when its last score was stored.
+    __slots__ = ("tokens", "updated", "stored_at")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.stored_at = float("-inf")
+
+
+class Admission:
+    # Admission control in front of the handlers, in memory only and O(1) per update:
+    # - every chat gets `chat_burst` updates, refilled at `chat_rate` per second, and updates over that are dropped;
+    # - a score coming less than `coalesce_window` seconds after the last stored score of its chat is held back and
+    #   later ones replace it. The first score of a burst is stored at once and the rest collapse into one more row
+    #   and reply per window. When the window ends, `flush(chat_id)` is called from a background thread; the owner
+    #   then stores what `take_held(chat_id)` returns in the chat's turn, so replies keep the order of the updates.
+    #   `take_held` may also be called earlier, e.g. before another update of the chat is handled;
+    # - score replies take a token of a global bucket of `reply_rate` per second, without one the score is stored
+    #   but not confirmed.
+    # A rate or window of 0 disables that part. Only the last `max_chats` active chats are remembered, held scores
+    # are kept until taken whatever happens to their chat.
+    def __init__(
+            self,
+            flush: Callable[[int], None],
+            chat_rate: float = 1.0,
+            chat_burst: float = 5.0,
+            coalesce_window: float = 1.0,
+            reply_rate: float = 25.0,
+            max_chats: int = 100000,
+    ):
+        self._flush = flush
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.coalesce_window = coalesce_window
+        self.max_chats = max_chats
+        self.replies = TokenBucket(reply_rate) if reply_rate > 0 else None
+        self.dropped = 0
+        self.coalesced = 0
+        self.replies_dropped = 0
+        self._chats: "OrderedDict[int, _Chat]" = OrderedDict()
+        # chat id -> (last held row, scores it stands for, deadline).
+        self._held_scores: Dict[int, Tuple[Tuple, int, float]] = {}
+        # (deadline, chat id) in order: the window is the same for everybody, so deadlines are appended in order.
+        self._deadlines: Deque[Tuple[float, int]] = deque()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        if coalesce_window > 0:
+            self._thread = threading.Thread(target=self._run, name="admission", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        # Hands the scores that are still held back to `flush`, no score is held back anew after that.
+        if self._thread is not None and self._thread.is_alive():
+            with self._condition:
+                self._stopping = True
+                self._condition.notify_all()
+            self._thread.join()
+
+    def join(self) -> None:
+        # Blocks until every held score has been taken.
+        with self._condition:
+            while self._held_scores:
+                self._condition.wait()
+
+    def stats(self) -> dict:
+        return {
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "replies_dropped": self.replies_dropped,
+        }
+
+    def _get_chat(self, chat_id: int, now: float) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(self.chat_burst, now)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return chat
+
+    def admit(self, chat_id: int) -> bool:
+        if self.chat_rate <= 0:
+            return True
+        with self._condition:
+            now = time.monotonic()
+            chat = self._get_chat(chat_id, now)
+            chat.tokens = min(self.chat_burst, chat.tokens + (now - chat.updated) * self.chat_rate)
+            chat.updated = now
+            if chat.tokens >= 1:
+                chat.tokens -= 1
+                return True
+            self.dropped += 1
+            return False
+
+    def hold_score(self, chat_id: int, row: Tuple) -> bool:
+        # True if the score is held back and will be handed to `flush`, False if the caller stores it now.
+        if self.coalesce_window <= 0:
+            return False
+        with self._condition:
+            held = self._held_scores.get(chat_id)
+            if held is not None:
+                # Also while stopping: the held score is still to be stored in the chat's turn.
+                self._held_scores[chat_id] = (row, held[1] + 1, held[2])
+                self.coalesced += 1
+                return True
+            if self._stopping:
+                return False
+            now = time.monotonic()
+            chat = self._get_chat(chat_id, now)
+            if now - chat.stored_at < self.coalesce_window:
+                deadline = now + self.coalesce_window
+                self._held_scores[chat_id] = (row, 1, deadline)
+                self._deadlines.append((deadline, chat_id))
+                self._condition.notify_all()
+                return True
+            chat.stored_at = now
+            return False
+
+    def take_held(self, chat_id: int) -> Optional[Tuple[Tuple, int]]:
+        # (row, number of scores it stands for) held for the chat, if any. The caller stores it.
+        if chat_id not in self._held_scores:
+            return None
+        with self._condition:
+            held = self._held_scores.pop(chat_id, None)
+            if held is None:
+                return None
+            now = time.monotonic()
+            self._get_chat(chat_id, now).stored_at = now
+            self._condition.notify_all()
+            return held[0], held[1]
+
+    def take_reply(self) -> bool:
+        if self.replies is None or self.replies.try_acquire():
+            return True
+        self.replies_dropped += 1
+        return False
+
+    def _notify(self, chat_id: int) -> None:
+        try:
+            self._flush(chat_id)
+        except Exception:
+            logger.exception(f"Failed to flush the held score of chat {chat_id}")
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._deadlines and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    break
+                deadline, chat_id = self._deadlines[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                self._deadlines.popleft()
+                # The score may have been taken already, and a newer one held with a later deadline.
+                held = self._held_scores.get(chat_id)
+                if held is None or held[2] != deadline:
+                    continue
+            self._notify(chat_id)
+        with self._condition:
+            chat_ids = list(self._held_scores)
+            self._deadlines.clear()
+        for chat_id in chat_ids:
+            self._notify(chat_id)
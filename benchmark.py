@@ -0,0 +1,491 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from database_handler import INSERT_SCORE, SQLiteDB
+
+
+class ConnectPerStatementDB(SQLiteDB):
+    # Reproduces the original access pattern: a fresh connection and a commit for every statement.
+    def _execute(self, sql_statement, parameters=()):
+        con = sqlite3.connect(self.db_path)
+        cur = con.cursor()
+        result = cur.execute(sql_statement, parameters).fetchall()
+        con.commit()
+        con.close()
+        return result
+
+
+# The statements the original `CringeMeterBot.on_get_score` issued for one score message. They are run through
+# `_execute` directly: the state and name caches of `SQLiteDB` would otherwise answer most of them without any
+# statement, and both sides have to do the same database work.
+SCORE_MESSAGE_STATEMENTS = [
+    (
+        "SELECT ready, university_id, subject_id, response_message_id, request_message_id, wait_for"
+        " FROM user_activity WHERE id = ?",
+        lambda user_id, university_id, subject_id, score: (user_id,),
+    ),
+    (
+        "SELECT ready, university_id, subject_id, response_message_id, request_message_id, wait_for"
+        " FROM user_activity WHERE id = ?",
+        lambda user_id, university_id, subject_id, score: (user_id,),
+    ),
+    ("SELECT name FROM university WHERE id = ?", lambda user_id, university_id, subject_id, score: (university_id,)),
+    ("SELECT name FROM subject WHERE id = ?", lambda user_id, university_id, subject_id, score: (subject_id,)),
+    (
+        INSERT_SCORE,
+        lambda user_id, university_id, subject_id, score: (user_id, university_id, subject_id, score, int(time.time())),
+    ),
+]
+
+
+def _score_message_workload(database, user_id, university_id, subject_id, score):
+    for statement, parameters in SCORE_MESSAGE_STATEMENTS:
+        database._execute(statement, parameters(user_id, university_id, subject_id, score))
+    return len(SCORE_MESSAGE_STATEMENTS)
+
+
+def _prepare_database(database, n_users):
+    database.append_university("ИТМО")
+    database.append_subject("ArchNN")
+    university_id = database.university2id("ИТМО")
+    subject_id = database.subject2id("ArchNN")
+    database.append_subject_to_university(university_id, subject_id)
+    for user_id in range(n_users):
+        database.append_user(user_id)
+        database.set_university_for_user(user_id, university_id)
+        database.set_subject_for_user(user_id, subject_id)
+    return university_id, subject_id
+
+
+def bench_connections(n_messages, n_users):
+    results = {}
+    for name, factory in [
+        ("connect_per_statement", ConnectPerStatementDB),
+        ("pooled", SQLiteDB),
+    ]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database = factory(os.path.join(tmp_dir, "bench.sqlite"))
+            university_id, subject_id = _prepare_database(database, n_users)
+            n_statements = 0
+            start = time.perf_counter()
+            for i in range(n_messages):
+                n_statements += _score_message_workload(database, i % n_users, university_id, subject_id, i % 11)
+            elapsed = time.perf_counter() - start
+            database.close()
+        results[name] = n_statements / elapsed
+        print(f"{name:>24}: {n_statements / elapsed:10.0f} statements/s ({n_messages / elapsed:8.0f} messages/s)")
+    print(f"{'speedup':>24}: {results['pooled'] / results['connect_per_statement']:10.1f}x")
+    return results
+
+
+# Score insert and state lookup as the access layer used to issue them, with the values formatted into the text,
+# and as fixed statements with bound parameters.
+STATEMENT_PATHS = {
+    "score_insert": (
+        lambda user_id, score: "INSERT INTO score(user_id, university_id, subject_id, score, date)"
+                               f" VALUES ({user_id}, 1, 1, {score}, {int(time.time())})",
+        "INSERT INTO score(user_id, university_id, subject_id, score, date) VALUES (?, ?, ?, ?, ?)",
+        lambda user_id, score: (user_id, 1, 1, score, int(time.time())),
+    ),
+    "state_lookup": (
+        lambda user_id, score: "SELECT ready, university_id, subject_id, response_message_id, request_message_id,"
+                               f" wait_for FROM user_activity WHERE id={user_id}",
+        "SELECT ready, university_id, subject_id, response_message_id, request_message_id, wait_for"
+        " FROM user_activity WHERE id = ?",
+        lambda user_id, score: (user_id,),
+    ),
+}
+
+
+def bench_statements(n_statements, n_users):
+    # Parse/plan cost only: every path runs in one transaction, so commits do not dominate.
+    # "interpolated" builds a new text per call and never hits the statement cache, "uncached" binds parameters
+    # with the cache disabled and "cached" is what `SQLiteDB` does.
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "bench.sqlite")
+        database = SQLiteDB(db_path)
+        _prepare_database(database, n_users)
+        database.close()
+        for path, (format_statement, statement, parameters) in STATEMENT_PATHS.items():
+            for variant, cached_statements in [("interpolated", 256), ("uncached", 0), ("cached", 256)]:
+                con = sqlite3.connect(db_path, isolation_level=None, cached_statements=cached_statements)
+                con.execute("BEGIN")
+                start = time.perf_counter()
+                for i in range(n_statements):
+                    user_id, score = i % n_users, i % 11
+                    if variant == "interpolated":
+                        con.execute(format_statement(user_id, score)).fetchall()
+                    else:
+                        con.execute(statement, parameters(user_id, score)).fetchall()
+                elapsed = time.perf_counter() - start
+                con.execute("ROLLBACK")
+                con.close()
+                results[(path, variant)] = elapsed / n_statements
+                print(f"{path:>14} {variant:>12}: {1e6 * elapsed / n_statements:8.2f} us/statement")
+            speedup = results[(path, "interpolated")] / results[(path, "cached")]
+            print(f"{path:>14} {'speedup':>12}: {speedup:8.1f}x")
+    return results
+
+
+class FakeBotAPI:
+    # In-process stand-in for the Bot API methods `CringeMeterBot` calls. `latency` simulates the network.
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {"send_message": 0, "delete_message": 0, "delete_messages": 0, "set_my_commands": 0}
+        self._message_ids = itertools.count(1_000_000)
+        self._lock = threading.Lock()
+
+    def _call(self, method):
+        with self._lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        self._call("send_message")
+        message_id = next(self._message_ids)
+        return SimpleNamespace(id=message_id, message_id=message_id, chat=SimpleNamespace(id=chat_id), text=text)
+
+    def delete_message(self, chat_id, message_id, *args, **kwargs):
+        self._call("delete_message")
+        return True
+
+    def delete_messages(self, chat_id, message_ids, *args, **kwargs):
+        self._call("delete_messages")
+        return True
+
+    def set_my_commands(self, commands, *args, **kwargs):
+        self._call("set_my_commands")
+        return True
+
+    def install(self, bot_api):
+        for method in self.calls:
+            setattr(bot_api, method, getattr(self, method))
+
+
+class UpdateStream:
+    # Generates Bot API update payloads. Updates of one chat keep their order, different chats interleave.
+    def __init__(self, n_chats, n_scores, seed=0, first_chat_id=10_000):
+        self.n_chats = n_chats
+        self.n_scores = n_scores
+        self.random = random.Random(seed)
+        self.chat_ids = list(range(first_chat_id, first_chat_id + n_chats))
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _message(self, chat_id, text):
+        return {
+            "message_id": next(self._message_ids),
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "chat": {"id": chat_id, "type": "private"},
+            "date": int(time.time()),
+            "text": text,
+        }
+
+    def message(self, chat_id, text):
+        return {"update_id": next(self._update_ids), "message": self._message(chat_id, text)}
+
+    def callback_query(self, chat_id, data):
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": self._message(chat_id, "menu"),
+            },
+        }
+
+    def _interleave(self, per_chat):
+        # Round-robin over chats in a shuffled order, each round takes the next update of every chat.
+        streams = [iter(updates) for updates in per_chat]
+        result = []
+        while streams:
+            self.random.shuffle(streams)
+            alive = []
+            for stream in streams:
+                update = next(stream, None)
+                if update is not None:
+                    result.append(update)
+                    alive.append(stream)
+            streams = alive
+        return result
+
+    def onboarding(self, university_id, subject_id):
+        return self._interleave([
+            [
+                self.message(chat_id, "/start"),
+                self.callback_query(chat_id, f"university_id:{university_id}"),
+                self.callback_query(chat_id, f"subject_id:{subject_id}"),
+            ]
+            for chat_id in self.chat_ids
+        ])
+
+    def scores(self):
+        return self._interleave([
+            [self.message(chat_id, str(self.random.randint(0, 10))) for _ in range(self.n_scores)]
+            for chat_id in self.chat_ids
+        ])
+
+
+class _CountingCursor:
+    # Counts the statements run through a cursor. Trace callbacks cannot be used for this: since Python 3.11 they
+    # also fire for the statements of trigger programs.
+    def __init__(self, cursor, statements):
+        self._cursor = cursor
+        self._statements = statements
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, sql, parameters=()):
+        next(self._statements)
+        return self._cursor.execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        next(self._statements)
+        return self._cursor.executemany(sql, seq_of_parameters)
+
+
+class _CountingConnection:
+    # The statements of `SQLiteDB` go through `execute`, `executemany` or a cursor of the connection.
+    def __init__(self, connection, statements):
+        self._connection = connection
+        self._statements = statements
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self):
+        return _CountingCursor(self._connection.cursor(), self._statements)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _replay_phase(bot, payloads, latencies, statements, fake_api, batch_size):
+    import telebot
+
+    updates = [telebot.types.Update.de_json(payload) for payload in payloads]
+    latencies.clear()
+    n_statements = next(statements)
+    n_api_calls = sum(fake_api.calls.values())
+    admission_stats = bot.admission.stats()
+    start = time.perf_counter()
+    # Fed in getUpdates-sized batches, as polling does.
+    for i in range(0, len(updates), batch_size):
+        bot.bot_api.process_new_updates(updates[i:i + batch_size])
+    bot.dispatcher.join()
+    elapsed = time.perf_counter() - start
+    # Scores held back by admission are stored when their window ends: the wait is reported on its own, their
+    # statements and API calls are counted with the phase.
+    bot.admission.join()
+    bot.dispatcher.join()
+    flush_elapsed = time.perf_counter() - start - elapsed
+    n_statements = next(statements) - n_statements - 1
+    n_api_calls = sum(fake_api.calls.values()) - n_api_calls
+    timings = sorted(latencies)
+    return {
+        "updates": len(updates),
+        "seconds": elapsed,
+        "held_scores_seconds": flush_elapsed,
+        "updates_per_second": len(updates) / elapsed,
+        "latency_ms": {
+            "p50": 1000 * _percentile(timings, 0.50),
+            "p95": 1000 * _percentile(timings, 0.95),
+            "p99": 1000 * _percentile(timings, 0.99),
+            "max": 1000 * (timings[-1] if timings else 0.0),
+        },
+        "sql_statements_per_update": n_statements / len(updates),
+        "api_calls_per_update": n_api_calls / len(updates),
+        "admission": {name: value - admission_stats[name] for name, value in bot.admission.stats().items()},
+    }
+
+
+def bench_replay(
+        n_chats,
+        n_scores,
+        seed=0,
+        dispatch_workers=8,
+        api_latency_ms=0.0,
+        batch_size=100,
+        updates_path=None,
+        output_path=None,
+        compare_path=None,
+        chat_rate=0.0,
+        chat_burst=5.0,
+        score_coalesce_window=0.0,
+        reply_rate=0.0,
+        **database_options,
+):
+    # `bot_api.process_new_updates` goes through the real handlers and dispatcher; only the network is faked.
+    # Admission control is off unless asked for: replayed chats send far faster than its default limits allow.
+    from main import CringeMeterBot
+
+    if updates_path is not None and os.path.exists(updates_path):
+        with open(updates_path) as f:
+            phases = json.load(f)
+    else:
+        stream = UpdateStream(n_chats, n_scores, seed)
+        # The demo catalog is created first, so ИТМО and ArchNN are university 1 and subject 1.
+        phases = {"onboarding": stream.onboarding(1, 1), "scores": stream.scores()}
+        if updates_path is not None:
+            with open(updates_path, "w") as f:
+                json.dump(phases, f)
+    results = {
+        "config": {
+            "n_chats": n_chats,
+            "n_scores": n_scores,
+            "seed": seed,
+            "dispatch_workers": dispatch_workers,
+            "api_latency_ms": api_latency_ms,
+            "batch_size": batch_size,
+            "admission": {
+                "chat_rate": chat_rate,
+                "chat_burst": chat_burst,
+                "score_coalesce_window": score_coalesce_window,
+                "reply_rate": reply_rate,
+            },
+            "updates_path": updates_path,
+            "database_options": database_options,
+        },
+        "phases": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bot = CringeMeterBot(
+            "0:benchmark",
+            os.path.join(tmp_dir, "bench.sqlite"),
+            debug=True,
+            dispatch_workers=max(dispatch_workers, 1),
+            chat_rate=chat_rate,
+            chat_burst=chat_burst,
+            score_coalesce_window=score_coalesce_window,
+            reply_rate=reply_rate,
+            **database_options,
+        )
+        fake_api = FakeBotAPI(api_latency_ms / 1000)
+        fake_api.install(bot.bot_api)
+        # Handler latency is measured around the dispatcher's handler, i.e. without queueing time.
+        latencies = []
+        handle = bot.dispatcher._handle
+
+        def timed_handle(update):
+            start = time.perf_counter()
+            try:
+                handle(update)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        bot.dispatcher._handle = timed_handle
+        # Every statement executed through `SQLiteDB` connections, BEGIN/COMMIT included and trigger bodies excluded.
+        # Other backends run no SQL and stay at 0 statements per update.
+        statements = itertools.count()
+        if isinstance(bot.database, SQLiteDB):
+            connect = bot.database._connect
+
+            def counted_connect():
+                return _CountingConnection(connect(), statements)
+
+            bot.database._connect = counted_connect
+        try:
+            for name, payloads in phases.items():
+                results["phases"][name] = _replay_phase(bot, payloads, latencies, statements, fake_api, batch_size)
+        finally:
+            bot.shutdown()
+    for name, phase in results["phases"].items():
+        latency = phase["latency_ms"]
+        print(
+            f"{name:>12}: {phase['updates_per_second']:8.0f} updates/s"
+            f"  p50 {latency['p50']:6.2f} ms  p95 {latency['p95']:6.2f} ms  p99 {latency['p99']:6.2f} ms"
+            f"  {phase['sql_statements_per_update']:5.2f} SQL/update  {phase['api_calls_per_update']:5.2f} API/update"
+        )
+        if any(phase["admission"].values()):
+            events = ", ".join(f"{name} {value}" for name, value in phase["admission"].items())
+            print(f"{'':>12}  admission: {events}, held scores stored {phase['held_scores_seconds']:.2f} s later")
+    if compare_path is not None:
+        with open(compare_path) as f:
+            baseline = json.load(f)
+        for name, phase in results["phases"].items():
+            before = baseline["phases"].get(name)
+            if before is None:
+                continue
+            print(
+                f"{name:>12}: throughput {phase['updates_per_second'] / before['updates_per_second']:5.2f}x"
+                f"  p99 {phase['latency_ms']['p99'] / max(before['latency_ms']['p99'], 1e-9):5.2f}x"
+                f"  SQL/update {phase['sql_statements_per_update'] - before['sql_statements_per_update']:+.2f}"
+                f" vs {compare_path}"
+            )
+    if output_path is not None:
+        with open(output_path, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Course cringe meter bot benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    connections_parser = subparsers.add_parser("connections", help="Connection-per-statement vs pooled connections")
+    connections_parser.add_argument("-n", "--n_messages", type=int, default=2000)
+    connections_parser.add_argument("-u", "--n_users", type=int, default=100)
+    statements_parser = subparsers.add_parser("statements", help="Interpolated vs parameterized cached statements")
+    statements_parser.add_argument("-n", "--n_statements", type=int, default=20000)
+    statements_parser.add_argument("-u", "--n_users", type=int, default=1000)
+    replay_parser = subparsers.add_parser("replay", help="Replay generated updates through CringeMeterBot")
+    replay_parser.add_argument("-c", "--n_chats", type=int, default=2000)
+    replay_parser.add_argument("-s", "--n_scores", type=int, default=10, help="Scores sent by every chat")
+    replay_parser.add_argument("--seed", type=int, default=0)
+    replay_parser.add_argument("--dispatch_workers", type=int, default=8)
+    replay_parser.add_argument("--api_latency_ms", type=float, default=0.0, help="Simulated Bot API call latency")
+    replay_parser.add_argument("--batch_size", type=int, default=100, help="Updates per process_new_updates call")
+    replay_parser.add_argument("--score_batch_size", type=int, default=0)
+    replay_parser.add_argument("--storage", default="sqlite", choices=["sqlite", "memory"])
+    replay_parser.add_argument("--chat_rate", type=float, default=0.0,
+                               help="Admission control as in main.py, all of it off by default")
+    replay_parser.add_argument("--chat_burst", type=float, default=5.0)
+    replay_parser.add_argument("--score_coalesce_s", type=float, default=0.0)
+    replay_parser.add_argument("--reply_rate", type=float, default=0.0)
+    replay_parser.add_argument("--updates", help="Update stream file: replayed if it exists, written otherwise")
+    replay_parser.add_argument("-o", "--output", help="Write results as JSON")
+    replay_parser.add_argument("--compare", help="Results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+    if args.benchmark == "connections":
+        bench_connections(args.n_messages, args.n_users)
+    elif args.benchmark == "statements":
+        bench_statements(args.n_statements, args.n_users)
+    elif args.benchmark == "replay":
+        bench_replay(
+            args.n_chats,
+            args.n_scores,
+            seed=args.seed,
+            dispatch_workers=args.dispatch_workers,
+            api_latency_ms=args.api_latency_ms,
+            batch_size=args.batch_size,
+            updates_path=args.updates,
+            output_path=args.output,
+            compare_path=args.compare,
+            chat_rate=args.chat_rate,
+            chat_burst=args.chat_burst,
+            score_coalesce_window=args.score_coalesce_s,
+            reply_rate=args.reply_rate,
+            score_batch_size=args.score_batch_size,
+            storage=args.storage,
+        )
@@ -0,0 +1,186 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+__all__ = ["Broadcaster", "RecipientStatus", "TokenBucket", ]
+
+logger = logging.getLogger(__name__)
+
+
+class RecipientStatus:
+    PENDING = 0
+    SENT = 1
+    BLOCKED = 2
+    FAILED = 3
+
+
+class TokenBucket:
+    # Global send rate limit shared by all workers. `pause` stops everybody, e.g. on a 429 retry-after.
+    def __init__(self, rate: float = 30.0, capacity: float = None):
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= tokens:
+                        self._tokens -= tokens
+                        return
+                    delay = (tokens - self._tokens) / self.rate
+                else:
+                    delay = self._paused_until - now
+            time.sleep(delay)
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        # Non-blocking `acquire`: False instead of waiting for the tokens.
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return False
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._updated = self._paused_until
+
+
+def _error_code(exception) -> Optional[int]:
+    # Duck-typed to match `telebot.apihelper.ApiTelegramException` and fake APIs alike.
+    return getattr(exception, "error_code", None)
+
+
+def _retry_after(exception) -> Optional[float]:
+    result_json = getattr(exception, "result_json", None) or {}
+    return (result_json.get("parameters") or {}).get("retry_after")
+
+
+def _is_blocked(exception) -> bool:
+    # 403: blocked by the user or deactivated account, 400 "chat not found": the chat is gone.
+    code = _error_code(exception)
+    description = str(getattr(exception, "description", "") or exception).lower()
+    return code == 403 or (code == 400 and "chat not found" in description)
+
+
+class Broadcaster:
+    # Sends one text to every known user. Progress is stored per recipient, so a broadcast that was
+    # interrupted is resumed by the next `run` instead of starting over. Blocked chats are recorded and
+    # skipped by later broadcasts.
+    def __init__(
+            self,
+            database,
+            deliver: Callable[[int, str], None],
+            rate: float = 30.0,
+            calls_per_recipient: int = 1,
+            max_workers: int = 8,
+            max_retries: int = 3,
+            progress_batch_size: int = 100,
+    ):
+        self.database = database
+        self._deliver = deliver
+        self.bucket = TokenBucket(rate)
+        self.calls_per_recipient = calls_per_recipient
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.progress_batch_size = progress_batch_size
+        self._running = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self, text: str = None) -> Optional[threading.Thread]:
+        # Runs `run` in a background thread. Returns None if a broadcast is already running.
+        if self._running.locked():
+            return None
+        self._thread = threading.Thread(target=self.run, args=(text,), name="broadcast", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self) -> None:
+        # Recipients that were not reached stay pending, so the broadcast resumes on the next `run`.
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self, text: str = None) -> Optional[dict]:
+        # Resumes the unfinished broadcast if there is one, otherwise starts a new one with `text`.
+        if not self._running.acquire(blocking=False):
+            return None
+        self._stopping.clear()
+        try:
+            broadcast = self.database.get_unfinished_broadcast()
+            if broadcast is None:
+                if text is None:
+                    return None
+                broadcast = (self.database.create_broadcast(text), text)
+            return self._run(*broadcast)
+        finally:
+            self._running.release()
+
+    def _run(self, broadcast_id: int, text: str) -> dict:
+        recipients = self.database.get_pending_broadcast_recipients(broadcast_id)
+        logger.info(f"Broadcast {broadcast_id}: {len(recipients)} pending recipients")
+        counts = {RecipientStatus.PENDING: 0, RecipientStatus.SENT: 0, RecipientStatus.BLOCKED: 0, RecipientStatus.FAILED: 0}
+        progress = []
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="broadcast") as executor:
+            # Progress is written from this thread only, in batches, while workers keep sending.
+            statuses = executor.map(lambda chat_id: self._send(chat_id, text), recipients)
+            for chat_id, status in zip(recipients, statuses):
+                counts[status] += 1
+                if status == RecipientStatus.PENDING:
+                    continue
+                progress.append((status, broadcast_id, chat_id))
+                if len(progress) >= self.progress_batch_size:
+                    self.database.update_broadcast_recipients(progress)
+                    progress = []
+        if progress:
+            self.database.update_broadcast_recipients(progress)
+        if counts[RecipientStatus.PENDING] == 0:
+            self.database.finish_broadcast(broadcast_id)
+        result = {
+            "broadcast_id": broadcast_id,
+            "pending": counts[RecipientStatus.PENDING],
+            "sent": counts[RecipientStatus.SENT],
+            "blocked": counts[RecipientStatus.BLOCKED],
+            "failed": counts[RecipientStatus.FAILED],
+        }
+        logger.info(f"Broadcast {broadcast_id} {'stopped' if result['pending'] else 'finished'}: {result}")
+        return result
+
+    def _send(self, chat_id: int, text: str) -> int:
+        attempt = 0
+        while attempt < self.max_retries:
+            if self._stopping.is_set():
+                return RecipientStatus.PENDING
+            self.bucket.acquire(self.calls_per_recipient)
+            try:
+                self._deliver(chat_id, text)
+            except Exception as exception:
+                if _is_blocked(exception):
+                    self.database.block_chat(chat_id, str(exception))
+                    return RecipientStatus.BLOCKED
+                retry_after = _retry_after(exception)
+                if _error_code(exception) == 429 and retry_after is not None:
+                    # Flood limit: everybody waits, the attempt is not counted.
+                    self.bucket.pause(retry_after)
+                    continue
+                attempt += 1
+                logger.warning(f"Broadcast to {chat_id} failed (attempt {attempt}/{self.max_retries}): {exception}")
+            else:
+                return RecipientStatus.SENT
+        return RecipientStatus.FAILED
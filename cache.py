@@ -0,0 +1,136 @@
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Collection, Hashable, List, Optional, Set, Tuple
+
+__all__ = ["LRUCache", "NameIndex", "normalize_name", ]
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def update(self, key: Hashable, function: Callable[[Any], Any]) -> None:
+        # Write-through update: only entries that are already cached are refreshed.
+        with self._lock:
+            if key in self._data:
+                self._data[key] = function(self._data[key])
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "maxsize": self.maxsize}
+
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize_name(name: str) -> str:
+    # Case, "ё" and punctuation are ignored when catalog names are compared.
+    return " ".join(_NON_WORD.sub(" ", name.casefold().replace("ё", "е")).split())
+
+
+def _trigrams(normalized: str) -> Set[str]:
+    if not normalized:
+        return set()
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    # Bidirectional id <-> name mapping for append-only catalog tables, with lookups by normalized name
+    # and a trigram index for similar names.
+    def __init__(self):
+        self.max_id = 0
+        self._id2name = {}
+        self._name2id = {}
+        self._normalized2id = {}
+        self._trigram_ids = {}
+        self._trigram_counts = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._id2name)
+
+    def add(self, id: int, name: str) -> None:
+        with self._lock:
+            if self._id2name.get(id) == name:
+                return
+            self._id2name[id] = name
+            self._name2id[name] = id
+            self.max_id = max(self.max_id, id)
+            normalized = normalize_name(name)
+            # The oldest of several spellings stays the canonical one.
+            self._normalized2id.setdefault(normalized, id)
+            trigrams = _trigrams(normalized)
+            self._trigram_counts[id] = len(trigrams)
+            for trigram in trigrams:
+                self._trigram_ids.setdefault(trigram, []).append(id)
+
+    def id2name(self, id: int) -> Optional[str]:
+        return self._id2name.get(id)
+
+    def name2id(self, name: str) -> Optional[int]:
+        return self._name2id.get(name)
+
+    def find(self, name: str) -> Optional[int]:
+        # Id of the entry spelled like `name` up to normalization.
+        return self._normalized2id.get(normalize_name(name))
+
+    def search(
+            self,
+            name: str,
+            limit: int = 5,
+            ids: Collection[int] = None,
+            min_similarity: float = 0.3,
+    ) -> List[Tuple[int, str]]:
+        # Most similar names first by trigram Jaccard similarity, optionally only among `ids`.
+        trigrams = _trigrams(normalize_name(name))
+        shared = Counter()
+        for trigram in trigrams:
+            shared.update(self._trigram_ids.get(trigram, ()))
+        scored = []
+        for id, n_shared in shared.items():
+            if ids is not None and id not in ids:
+                continue
+            similarity = n_shared / (len(trigrams) + self._trigram_counts[id] - n_shared)
+            if similarity >= min_similarity:
+                scored.append((-similarity, id))
+        scored.sort()
+        return [(id, self._id2name[id]) for _, id in scored[:limit]]
+
+    def items(self):
+        return sorted(self._id2name.items())
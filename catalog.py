@@ -0,0 +1,51 @@
+import csv
+import json
+from typing import IO, List, Tuple
+
+__all__ = ["CATALOG_FORMATS", "format_catalog_diff", "import_catalog", "read_catalog", ]
+
+CATALOG_FORMATS = ("csv", "json")
+
+
+def read_catalog(f: IO[str], format: str = "csv") -> Tuple[List[str], List[str], List[Tuple[str, str]]]:
+    # Returns (universities, subjects, (university, subject) links), in file order.
+    # CSV has a "university,subject" header and one link per row; an empty column adds only the other name.
+    # JSON is an object mapping every university to the list of its subjects.
+    universities, subjects, university_subjects = [], [], []
+    if format == "csv":
+        for row in csv.DictReader(f):
+            university, subject = (row.get("university") or "").strip(), (row.get("subject") or "").strip()
+            if university and subject:
+                university_subjects.append((university, subject))
+            elif university:
+                universities.append(university)
+            elif subject:
+                subjects.append(subject)
+    elif format == "json":
+        catalog = json.load(f)
+        if not isinstance(catalog, dict):
+            raise ValueError("A JSON catalog maps university names to lists of subject names")
+        for university, university_subject_names in catalog.items():
+            # A bare string would otherwise be imported one subject per character.
+            if not isinstance(university_subject_names, list) or not all(
+                    isinstance(subject, str) for subject in university_subject_names
+            ):
+                raise ValueError(f"Subjects of {university} must be a list of names, got {university_subject_names!r}")
+            universities.append(university)
+            university_subjects.extend((university, subject) for subject in university_subject_names)
+    else:
+        raise ValueError(f"Unknown catalog format: {format}")
+    return universities, subjects, university_subjects
+
+
+def import_catalog(database, f: IO[str], format: str = "csv"):
+    # Inserts whatever is missing in one go and returns what was inserted, see `Storage.import_catalog`.
+    return database.import_catalog(*read_catalog(f, format))
+
+
+def format_catalog_diff(diff) -> str:
+    new_universities, new_subjects, new_university_subjects = diff
+    lines = [f"+ university {name}" for _, name in new_universities]
+    lines += [f"+ subject {name}" for _, name in new_subjects]
+    lines += [f"+ {university} / {subject}" for university, subject in new_university_subjects]
+    return "\n".join(lines)
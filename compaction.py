@@ -0,0 +1,48 @@
+import logging
+import threading
+import time
+
+__all__ = ["Compactor", ]
+
+logger = logging.getLogger(__name__)
+
+
+class Compactor:
+    # Background retention job: every `interval` seconds raw scores older than `retention` seconds are deleted
+    # (their daily roll-up stays in `score_aggregate`) and freed pages are returned with incremental vacuum.
+    def __init__(
+            self,
+            database,
+            retention: float,
+            interval: float = 3600.0,
+            batch_size: int = 1000,
+            vacuum_pages: int = 1000,
+    ):
+        self.database = database
+        self.retention = retention
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="compactor", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._thread.join()
+
+    def run_once(self) -> dict:
+        before = int(time.time() - self.retention)
+        deleted = self.database.compact_scores(before, self.batch_size)
+        freed_pages = self.database.incremental_vacuum(self.vacuum_pages) if deleted else 0
+        return {"deleted": deleted, "freed_pages": freed_pages}
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.interval):
+            try:
+                result = self.run_once()
+            except Exception:
+                logger.exception("Score compaction failed")
+            else:
+                if result["deleted"]:
+                    logger.info(f"Compacted scores: {result}")
@@ -1,219 +1,676 @@
-import os
+import pathlib
 import sqlite3
-from typing import List, Any, Tuple
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import List, Any, Tuple, Iterable, Iterator, Callable, Optional
 
-__all__ = ["SQLiteDB", ]
+from cache import LRUCache, NameIndex
+from migrations import ALL_TIME_BUCKET, BUCKET_SECONDS, create_base_schema, migrate
+from score_writer import ScoreWriter
+from storage import ScoreAggregate, Storage, UserState
 
+__all__ = ["ScoreAggregate", "SQLiteDB", "UserState", ]
 
-class SQLiteDB:
-    def __init__(self, db_path):
+# Statements used by several methods. Every statement text is fixed and takes its values as parameters,
+# so each one is parsed and planned once per connection and then served from the statement cache.
+INSERT_SCORE = "INSERT INTO score(user_id, university_id, subject_id, score, date) VALUES (?, ?, ?, ?, ?)"
+AGGREGATE_COLUMNS = f"bucket, count, sum, sum_sq, min, max, {', '.join(f'h{score}' for score in range(11))}"
+
+
+class _ConnectionOwner:
+    # Kept in a thread's locals next to its connection. The locals are dropped when the thread exits, and
+    # the finalizer attached to this object closes the connection then.
+    pass
+
+
+def _release_connection(con, connections, connections_lock) -> None:
+    with connections_lock:
+        if con in connections:
+            connections.remove(con)
+    con.close()
+
+
+class SQLiteDB(Storage):
+    def __init__(
+            self,
+            db_path,
+            journal_mode: str = "WAL",
+            synchronous: str = "NORMAL",
+            cache_size: int = -16000,
+            busy_timeout: float = 5.0,
+            user_cache_size: int = 4096,
+            score_batch_size: int = 0,
+            score_flush_interval_ms: int = 50,
+            score_queue_size: int = 10000,
+            cached_statements: int = 256,
+            metrics=None,
+    ):
         self.db_path = db_path
+        # `metrics.Metrics` to time every statement, None leaves connections uninstrumented.
+        self.metrics = metrics
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.busy_timeout = busy_timeout
+        # Prepared statements kept per connection, enough for every fixed statement text used here.
+        self.cached_statements = cached_statements
+        # One long-lived connection per thread, closed when its thread exits. Connections of live threads are
+        # tracked to be closed on shutdown.
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # `user_activity` rows keyed by user id. Every setter writes through, so cached rows are never stale.
+        # Write-through only refreshes cached rows, so a miss caches what it read only if no setter ran meanwhile:
+        # `_user_state_writes` counts write-throughs, and both are done under `_user_state_lock`.
+        self._user_states = LRUCache(user_cache_size)
+        self._user_state_writes = 0
+        self._user_state_lock = threading.Lock()
+        # University and subject names never change once inserted, so they are served from memory.
+        # Rows added by other processes are picked up when `PRAGMA data_version` reports a foreign commit.
+        self._universities = NameIndex()
+        self._subjects = NameIndex()
+        # Called as `listener(table, university_id)` after a catalog row is actually inserted.
+        self._catalog_listeners = []
         self._initialize_database()
+        self._refresh_catalog(force=True)
+        # Opt-in group commit for scores: `append_score` only enqueues and a background thread flushes batches.
+        self._score_writer = None
+        if score_batch_size > 0:
+            self._score_writer = ScoreWriter(
+                self.append_scores,
+                batch_size=score_batch_size,
+                flush_interval=score_flush_interval_ms / 1000,
+                max_queue_size=score_queue_size,
+            )
 
     # PRIVATE METHODS
-    def _initialize_database(self) -> None:
-        if not os.path.exists(self.db_path):
-            con = sqlite3.connect(self.db_path)
-            cur = con.cursor()
-            cur.execute(
-                "CREATE TABLE user_activity ("
-                "   id INTEGER PRIMARY KEY,"
-                "   ready INTEGER DEFAULT 0,"
-                "   university_id INTEGER,"
-                "   subject_id INTEGER,"
-                "   response_message_id INTEGER,"
-                "   request_message_id INTEGER,"
-                "   wait_for INTEGER DEFAULT 0"
-                ")"
-            )
-            cur.execute(
-                "CREATE TABLE subject ("
-                "   id INTEGER PRIMARY KEY,"
-                "   name TEXT NOT NULL UNIQUE"
-                ")"
-            )
-            cur.execute(
-                "CREATE TABLE university ("
-                "   id INTEGER PRIMARY KEY,"
-                "   name TEXT NOT NULL UNIQUE"
-                ")"
-            )
-            cur.execute(
-                "CREATE TABLE university_subject ("
-                "   id INTEGER PRIMARY KEY,"
-                "   university_id INTEGER NOT NULL,"
-                "   subject_id INTEGER NOT NULL,"
-                "   FOREIGN KEY (university_id) REFERENCES university(id),"
-                "   FOREIGN KEY (subject_id) REFERENCES subject(id),"
-                "   UNIQUE(university_id, subject_id)"
-                ")"
+    def _connect(self) -> sqlite3.Connection:
+        con = getattr(self._local, "connection", None)
+        if con is None:
+            # Autocommit mode: single statements commit by themselves, multi-statement work goes through
+            # `_transaction`. The connection never leaves its thread, `check_same_thread` is disabled
+            # only to let `close` run from the main thread.
+            connect = sqlite3.connect if self.metrics is None else self.metrics.sqlite_connect
+            con = connect(
+                self.db_path,
+                timeout=self.busy_timeout,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=self.cached_statements,
             )
-            cur.execute(
-                "CREATE TABLE score ("
-                "   id INTEGER PRIMARY KEY,"
-                "   user_id INTEGER,"
-                "   university_id INTEGER,"
-                "   subject_id INTEGER,"
-                "   score INTEGER NOT NULL,"
-                "   date FLOAT,"
-                "   FOREIGN KEY (user_id) REFERENCES user_activity(id),"
-                "   FOREIGN KEY (university_id) REFERENCES university(id),"
-                "   FOREIGN KEY (subject_id) REFERENCES subject(id)"
-                ")"
-            )
-            con.commit()
-            con.close()
+            # Takes effect only for a new database file, and has to come before the journal mode writes the header.
+            # Existing files are converted by `incremental_vacuum(full=True)`.
+            con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            con.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            con.execute(f"PRAGMA synchronous={self.synchronous}")
+            con.execute(f"PRAGMA cache_size={int(self.cache_size)}")
+            self._local.connection = con
+            self._local.owner = _ConnectionOwner()
+            weakref.finalize(self._local.owner, _release_connection, con, self._connections, self._connections_lock)
+            with self._connections_lock:
+                self._connections.append(con)
+        return con
 
-    def _execute(self, sql_statement) -> List[Any]:
-        con = sqlite3.connect(self.db_path)
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        con = self._connect()
         cur = con.cursor()
-        result = cur.execute(sql_statement).fetchall()
-        con.commit()
-        con.close()
-        return result
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            yield cur
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        else:
+            cur.execute("COMMIT")
+        finally:
+            cur.close()
+
+    def _initialize_database(self) -> None:
+        with self._transaction() as cur:
+            create_base_schema(cur)
+        migrate(self._connect())
+
+    def _execute(self, sql_statement, parameters=()) -> List[Any]:
+        return self._connect().execute(sql_statement, parameters).fetchall()
+
+    def _refresh_catalog(self, force=False) -> None:
+        con = self._connect()
+        data_version = con.execute("PRAGMA data_version").fetchone()[0]
+        if not force and getattr(self._local, "data_version", None) == data_version:
+            return
+        for table, index in [("university", self._universities), ("subject", self._subjects)]:
+            rows = con.execute(f"SELECT id, name FROM {table} WHERE id > ?", (index.max_id,)).fetchall()
+            for id, name in rows:
+                index.add(id, name)
+            if rows and table == "university" and not force:
+                self._notify_catalog_change("university")
+        self._local.data_version = data_version
+
+    def _notify_catalog_change(self, table, university_id=None) -> None:
+        for listener in list(self._catalog_listeners):
+            listener(table, university_id)
+
+    def _write_through_user_state(self, user_id, **fields) -> None:
+        # Called after the write is committed.
+        with self._user_state_lock:
+            self._user_state_writes += 1
+            self._user_states.update(int(user_id), lambda state: state._replace(**fields))
+
+    def _append_name(self, cur, table, name) -> Tuple[int, bool]:
+        cur.execute(f"INSERT OR IGNORE INTO {table}(name) VALUES (?)", (name,))
+        if cur.rowcount == 1:
+            return cur.lastrowid, True
+        return cur.execute(f"SELECT id FROM {table} WHERE name = ?", (name,)).fetchone()[0], False
+
+    def _insert_names(self, cur, table, names) -> List[Tuple[int, str]]:
+        # Without AUTOINCREMENT a new row gets the largest id plus one, so inserted rows are the ones above the
+        # previous maximum. `executemany` drops RETURNING rows, they are read back by that range instead.
+        last_id = cur.execute(f"SELECT coalesce(max(id), 0) FROM {table}").fetchone()[0]
+        cur.executemany(
+            f"INSERT INTO {table}(name) VALUES (?) ON CONFLICT(name) DO NOTHING",
+            [(name,) for name in names],
+        )
+        return cur.execute(f"SELECT id, name FROM {table} WHERE id > ? ORDER BY id", (last_id,)).fetchall()
 
     # ____PUBLIC_METHODS____
 
-    def clear_user_awaiting(self, user_id):
-        self.set_wait_for_user(user_id, 0)
-        self.set_request_message_id_for_user(user_id, None)
-        self.set_response_message_id_for_user(user_id, None)
+    def close(self) -> None:
+        if self._score_writer is not None:
+            self._score_writer.stop()
+        with self._connections_lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for con in connections:
+            con.close()
+        self._local = threading.local()
+        self._user_states.clear()
+
+    def add_catalog_listener(self, listener: Callable[[str, Optional[int]], None]) -> None:
+        # `table` is "university" for a new university and "university_subject" for a new link,
+        # in which case `university_id` is the university whose subject list changed.
+        self._catalog_listeners.append(listener)
+
+    def cache_stats(self) -> dict:
+        stats = {
+            "user_state": self._user_states.stats(),
+            "university_names": len(self._universities),
+            "subject_names": len(self._subjects),
+        }
+        if self._score_writer is not None:
+            stats["score_writer"] = self._score_writer.stats()
+        return stats
+
+    # ___STATE_TRANSITIONS___
+    def begin_user_awaiting(self, user_id, status, response_message_id, request_message_id) -> None:
+        self._execute(
+            "UPDATE user_activity"
+            " SET wait_for = ?, response_message_id = ?, request_message_id = ?"
+            " WHERE id = ?",
+            (int(status), response_message_id, request_message_id, user_id),
+        )
+        self._write_through_user_state(
+            user_id,
+            wait_for=int(status),
+            response_message_id=response_message_id,
+            request_message_id=request_message_id,
+        )
+
+    def clear_user_awaiting(self, user_id) -> None:
+        self._execute(
+            "UPDATE user_activity"
+            " SET wait_for = 0, response_message_id = NULL, request_message_id = NULL"
+            " WHERE id = ?",
+            (user_id,),
+        )
+        self._write_through_user_state(user_id, wait_for=0, response_message_id=None, request_message_id=None)
+
+    def register_and_select_university(self, user_id, university_name: str) -> int:
+        with self._transaction() as cur:
+            university_id, inserted = self._append_name(cur, "university", university_name)
+            cur.execute("UPDATE user_activity SET university_id = ? WHERE id = ?", (university_id, user_id))
+        self._universities.add(university_id, university_name)
+        if inserted:
+            self._notify_catalog_change("university")
+        self._write_through_user_state(user_id, university_id=university_id)
+        return university_id
+
+    def register_and_select_subject(self, user_id, subject_name: str) -> int:
+        # The subject is also linked to the university the user has selected.
+        linked_university_id = None
+        with self._transaction() as cur:
+            subject_id, _ = self._append_name(cur, "subject", subject_name)
+            cur.execute("UPDATE user_activity SET subject_id = ? WHERE id = ?", (subject_id, user_id))
+            university_id = cur.execute(
+                "SELECT university_id FROM user_activity WHERE id = ?", (user_id,),
+            ).fetchone()[0]
+            if university_id is not None:
+                cur.execute(
+                    "INSERT OR IGNORE INTO university_subject(university_id, subject_id) VALUES (?, ?)",
+                    (university_id, subject_id),
+                )
+                if cur.rowcount == 1:
+                    linked_university_id = university_id
+        self._subjects.add(subject_id, subject_name)
+        if linked_university_id is not None:
+            self._notify_catalog_change("university_subject", linked_university_id)
+        self._write_through_user_state(user_id, subject_id=subject_id)
+        return subject_id
 
     # ___GETTERS___
-    def get_all_users(self):
-        sql_statement = f"SELECT id from user_activity"
-        users = self._execute(sql_statement)
-        return users
+    def get_all_users(self) -> List[Tuple[int]]:
+        return self._execute("SELECT id FROM user_activity")
+
     def get_all_universities(self) -> List[Tuple[int, str]]:
-        sql_statement = f"SELECT * from university"
-        universities = self._execute(sql_statement)
-        return universities
-
-    def get_university_subjects(self, university_id: int = None) -> List[Tuple[int, str]]:
-        sql_statement = f"SELECT subject_id" \
-                        f" from university_subject" \
-                        f" WHERE university_id={university_id}"
-        subjects = self._execute(sql_statement)
-        return subjects
-
-    def get_user_current_state(self, user_id: int) -> Tuple:
-        sql_statement = f"SELECT ready, university_id, subject_id, response_message_id, request_message_id, wait_for" \
-                        f" FROM user_activity" \
-                        f" WHERE id={user_id}"
-        data = self._execute(sql_statement)[0]
-        ready, university_id, subject_id, response_message_id, request_message_id, wait_for = data
-        return ready, university_id, subject_id, response_message_id, request_message_id, wait_for
+        self._refresh_catalog()
+        return self._universities.items()
+
+    def get_university_subjects(self, university_id: int = None) -> List[Tuple[int]]:
+        return self._execute("SELECT subject_id FROM university_subject WHERE university_id = ?", (university_id,))
+
+    def get_university_subject_names(self, university_id: int) -> List[Tuple[int, str]]:
+        return self._execute(
+            "SELECT subject.id, subject.name"
+            " FROM university_subject"
+            " JOIN subject ON subject.id = university_subject.subject_id"
+            " WHERE university_subject.university_id = ?"
+            " ORDER BY subject.id",
+            (university_id,),
+        )
+
+    def _get_page(self, select, key, conditions, parameters, after_id, before_id, limit):
+        conditions, parameters = list(conditions), list(parameters)
+        if after_id is not None:
+            conditions.append(f"{key} > ?")
+            parameters.append(int(after_id))
+        if before_id is not None:
+            conditions.append(f"{key} < ?")
+            parameters.append(int(before_id))
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        # A page before `before_id` is read backwards from it, so both directions stop after `limit` rows.
+        order = "DESC" if before_id is not None else "ASC"
+        rows = self._execute(f"{select}{where} ORDER BY {key} {order} LIMIT ?", (*parameters, limit))
+        return rows[::-1] if before_id is not None else rows
+
+    def get_universities_page(
+            self,
+            after_id: int = None,
+            before_id: int = None,
+            limit: int = 10,
+    ) -> List[Tuple[int, str]]:
+        return self._get_page("SELECT id, name FROM university", "id", [], [], after_id, before_id, limit)
+
+    def get_university_subjects_page(
+            self,
+            university_id: int,
+            after_id: int = None,
+            before_id: int = None,
+            limit: int = 10,
+    ) -> List[Tuple[int, str]]:
+        # Served by the UNIQUE(university_id, subject_id) index.
+        return self._get_page(
+            "SELECT subject.id, subject.name"
+            " FROM university_subject"
+            " JOIN subject ON subject.id = university_subject.subject_id",
+            "university_subject.subject_id",
+            ["university_subject.university_id = ?"],
+            [university_id],
+            after_id,
+            before_id,
+            limit,
+        )
+
+    def find_university(self, university_name: str) -> Optional[int]:
+        self._refresh_catalog()
+        return self._universities.find(university_name)
+
+    def find_subject(self, subject_name: str) -> Optional[int]:
+        self._refresh_catalog()
+        return self._subjects.find(subject_name)
+
+    def search_universities(self, university_name: str, limit: int = 5) -> List[Tuple[int, str]]:
+        self._refresh_catalog()
+        return self._universities.search(university_name, limit)
+
+    def search_subjects(self, subject_name: str, university_id: int = None, limit: int = 5) -> List[Tuple[int, str]]:
+        self._refresh_catalog()
+        subject_ids = None
+        if university_id is not None:
+            subject_ids = {subject_id for subject_id, in self.get_university_subjects(university_id)}
+        return self._subjects.search(subject_name, limit, subject_ids)
+
+    def get_score_aggregate(self, university_id: int, subject_id: int) -> Optional[ScoreAggregate]:
+        rows = self._execute(
+            f"SELECT {AGGREGATE_COLUMNS}"
+            f" FROM score_aggregate"
+            f" WHERE university_id = ? AND subject_id = ? AND bucket = ?",
+            (university_id, subject_id, ALL_TIME_BUCKET),
+        )
+        return ScoreAggregate(*rows[0]) if rows else None
+
+    def get_daily_score_aggregates(
+            self,
+            university_id: int,
+            subject_id: int,
+            days: int,
+            now: float = None,
+    ) -> List[ScoreAggregate]:
+        # At most `days` rows read through the primary key, oldest first. Days without scores are omitted.
+        last_bucket = int(time.time() if now is None else now) // BUCKET_SECONDS
+        rows = self._execute(
+            f"SELECT {AGGREGATE_COLUMNS}"
+            f" FROM score_aggregate"
+            f" WHERE university_id = ? AND subject_id = ? AND bucket BETWEEN ? AND ?"
+            f" ORDER BY bucket",
+            (university_id, subject_id, last_bucket - days + 1, last_bucket),
+        )
+        return [ScoreAggregate(*row) for row in rows]
+
+    def iter_scores(
+            self,
+            university_id: int = None,
+            subject_id: int = None,
+            since: int = None,
+            until: int = None,
+            chunk_size: int = 1000,
+    ) -> Iterator[Tuple[int, int, str, str, int, int]]:
+        # Yields (id, user_id, university, subject, score, date) rows, `until` is exclusive. A separate
+        # read-only connection reads one WAL snapshot in `chunk_size` steps, so the writer is never blocked
+        # and memory does not grow with the table.
+        uri = pathlib.Path(self.db_path).absolute().as_uri() + "?mode=ro"
+        con = sqlite3.connect(uri, uri=True, timeout=self.busy_timeout, isolation_level=None)
+        try:
+            conditions, parameters = [], []
+            for condition, value in [
+                ("score.university_id = ?", university_id),
+                ("score.subject_id = ?", subject_id),
+                ("score.date >= ?", since),
+                ("score.date < ?", until),
+            ]:
+                if value is not None:
+                    conditions.append(condition)
+                    parameters.append(value)
+            where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+            con.execute("BEGIN")
+            cur = con.execute(
+                f"SELECT score.id, score.user_id, university.name, subject.name, score.score, score.date"
+                f" FROM score"
+                f" LEFT JOIN university ON university.id = score.university_id"
+                f" LEFT JOIN subject ON subject.id = score.subject_id"
+                f"{where}"
+                f" ORDER BY score.id",
+                parameters,
+            )
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+            con.execute("COMMIT")
+        finally:
+            con.close()
+
+    def get_recent_scores(self, since: int, chunk_size: int = 1000) -> List[Tuple[int, int, int, int]]:
+        # Scores are appended roughly in date order, so the table is read backwards by id and the scan stops at the
+        # first chunk dated entirely before `since` instead of scanning the whole table for a date range.
+        rows = []
+        last_id = 2 ** 63 - 1
+        while True:
+            chunk = self._execute(
+                "SELECT id, university_id, subject_id, score, date FROM score WHERE id < ? ORDER BY id DESC LIMIT ?",
+                (last_id, chunk_size),
+            )
+            rows.extend(
+                row[1:] for row in chunk
+                if row[4] is not None and row[4] >= since and row[1] is not None and row[2] is not None
+            )
+            if len(chunk) < chunk_size or all(row[4] is None or row[4] < since for row in chunk):
+                break
+            last_id = chunk[-1][0]
+        rows.reverse()
+        return rows
+
+    def get_user_current_state(self, user_id: int) -> UserState:
+        cached = self._user_states.get(int(user_id))
+        if cached is not None:
+            return cached
+        writes = self._user_state_writes
+        state = UserState(*self._execute(
+            "SELECT ready, university_id, subject_id, response_message_id, request_message_id, wait_for"
+            " FROM user_activity"
+            " WHERE id = ?",
+            (int(user_id),),
+        )[0])
+        with self._user_state_lock:
+            # A setter that ran during the SELECT may have committed after it, so its row is not cached.
+            if writes == self._user_state_writes:
+                self._user_states.put(int(user_id), state)
+        return state
 
     # ___APPENDERS___
     def append_user(self, user_id: int) -> None:
-        sql_statement = f"INSERT OR IGNORE INTO user_activity(id) VALUES ({user_id})"
-        self._execute(sql_statement)
+        self._execute("INSERT OR IGNORE INTO user_activity(id) VALUES (?)", (int(user_id),))
 
     def append_university(self, university_name: str) -> None:
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        cur.execute(
-            f"INSERT OR IGNORE"
-            f" INTO university(name)"
-            f" VALUES (\"{university_name}\")",
-        )
-        con.commit()
-        con.close()
+        cur = self._connect().execute("INSERT OR IGNORE INTO university(name) VALUES (?)", (university_name,))
+        if cur.rowcount == 1:
+            self._universities.add(cur.lastrowid, university_name)
+            self._notify_catalog_change("university")
 
     def append_subject(self, subject_name: str) -> None:
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        cur.execute(
-            f"INSERT OR IGNORE"
-            f" INTO subject(name)"
-            f" VALUES (\"{subject_name}\")",
-        )
-        con.commit()
-        con.close()
+        cur = self._connect().execute("INSERT OR IGNORE INTO subject(name) VALUES (?)", (subject_name,))
+        if cur.rowcount == 1:
+            self._subjects.add(cur.lastrowid, subject_name)
 
-    def append_subject_to_university(self, university_id, subject_id):
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        cur.execute(
-            f"INSERT OR IGNORE"
-            f" INTO university_subject(university_id, subject_id)"
-            f" VALUES ({university_id}, {subject_id})",
+    def append_subject_to_university(self, university_id, subject_id) -> None:
+        cur = self._connect().execute(
+            "INSERT OR IGNORE INTO university_subject(university_id, subject_id) VALUES (?, ?)",
+            (int(university_id), int(subject_id)),
         )
-        con.commit()
-        con.close()
+        if cur.rowcount == 1:
+            self._notify_catalog_change("university_subject", int(university_id))
+
+    def import_catalog(
+            self,
+            universities: Iterable[str],
+            subjects: Iterable[str],
+            university_subjects: Iterable[Tuple[str, str]],
+    ) -> Tuple[List[Tuple[int, str]], List[Tuple[int, str]], List[Tuple[str, str]]]:
+        university_subjects = list(university_subjects)
+        universities = list(dict.fromkeys([*universities, *(university for university, _ in university_subjects)]))
+        subjects = list(dict.fromkeys([*subjects, *(subject for _, subject in university_subjects)]))
+        with self._transaction() as cur:
+            new_universities = self._insert_names(cur, "university", universities)
+            new_subjects = self._insert_names(cur, "subject", subjects)
+            last_link_id = cur.execute("SELECT coalesce(max(id), 0) FROM university_subject").fetchone()[0]
+            cur.executemany(
+                "INSERT INTO university_subject(university_id, subject_id)"
+                " SELECT university.id, subject.id FROM university, subject"
+                " WHERE university.name = ? AND subject.name = ?"
+                " ON CONFLICT DO NOTHING",
+                university_subjects,
+            )
+            new_links = cur.execute(
+                "SELECT university_subject.university_id, university.name, subject.name"
+                " FROM university_subject"
+                " JOIN university ON university.id = university_subject.university_id"
+                " JOIN subject ON subject.id = university_subject.subject_id"
+                " WHERE university_subject.id > ?"
+                " ORDER BY university_subject.id",
+                (last_link_id,),
+            ).fetchall()
+        for id, name in new_universities:
+            self._universities.add(id, name)
+        for id, name in new_subjects:
+            self._subjects.add(id, name)
+        if new_universities:
+            self._notify_catalog_change("university")
+        for university_id in dict.fromkeys(university_id for university_id, _, _ in new_links):
+            self._notify_catalog_change("university_subject", university_id)
+        return new_universities, new_subjects, [(university, subject) for _, university, subject in new_links]
 
     def append_score(self, user_id: int, university_id: int, subject_id: int, score: int, date: int) -> None:
-        sql_statement = f"INSERT INTO" \
-                        f" score(user_id, university_id, subject_id, score, date)" \
-                        f" VALUES ({user_id}, {university_id}, {subject_id}, {score}, \"{date}\")"
-        self._execute(sql_statement)
+        row = (user_id, university_id, subject_id, score, int(date))
+        if self._score_writer is not None:
+            self._score_writer.put(row)
+            return
+        self._execute(INSERT_SCORE, row)
+
+    def append_scores(self, scores: List[Tuple[int, int, int, int, int]]) -> None:
+        with self._transaction() as cur:
+            cur.executemany(INSERT_SCORE, scores)
 
     # ___SETTERS___
-    def set_ready_for_user(self, user_id):
-        sql_statement = f"UPDATE user_activity" \
-                        f" SET ready ={1}" \
-                        f" WHERE id={user_id}"
-        self._execute(sql_statement)
-
-    def set_wait_for_user(self, user_id, status):
-        sql_statement = f"UPDATE user_activity" \
-                        f" SET wait_for ={int(status)}" \
-                        f" WHERE id={user_id}"
-        self._execute(sql_statement)
-
-    def set_request_message_id_for_user(self, user_id, request_message_id):
-        if request_message_id is None:
-            request_message_id = "NULL"
-        sql_statement = f"UPDATE user_activity" \
-                        f" SET request_message_id ={request_message_id}" \
-                        f" WHERE id={user_id}"
-        self._execute(sql_statement)
-
-    def set_response_message_id_for_user(self, user_id, response_message_id):
-        if response_message_id is None:
-            response_message_id = "NULL"
-        sql_statement = f"UPDATE user_activity" \
-                        f" SET response_message_id ={response_message_id}" \
-                        f" WHERE id={user_id}"
-        self._execute(sql_statement)
+    def set_ready_for_user(self, user_id) -> None:
+        self._execute("UPDATE user_activity SET ready = 1 WHERE id = ?", (int(user_id),))
+        self._write_through_user_state(user_id, ready=1)
+
+    def set_wait_for_user(self, user_id, status) -> None:
+        self._execute("UPDATE user_activity SET wait_for = ? WHERE id = ?", (int(status), int(user_id)))
+        self._write_through_user_state(user_id, wait_for=int(status))
+
+    def set_request_message_id_for_user(self, user_id, request_message_id) -> None:
+        request_message_id = None if request_message_id is None else int(request_message_id)
+        self._execute(
+            "UPDATE user_activity SET request_message_id = ? WHERE id = ?",
+            (request_message_id, int(user_id)),
+        )
+        self._write_through_user_state(user_id, request_message_id=request_message_id)
+
+    def set_response_message_id_for_user(self, user_id, response_message_id) -> None:
+        response_message_id = None if response_message_id is None else int(response_message_id)
+        self._execute(
+            "UPDATE user_activity SET response_message_id = ? WHERE id = ?",
+            (response_message_id, int(user_id)),
+        )
+        self._write_through_user_state(user_id, response_message_id=response_message_id)
 
     def set_university_for_user(self, user_id: int, university_id: int) -> None:
-        sql_statement = f"UPDATE user_activity" \
-                        f" SET university_id ={university_id}" \
-                        f" WHERE id={user_id}"
-        self._execute(sql_statement)
+        self._execute("UPDATE user_activity SET university_id = ? WHERE id = ?", (int(university_id), int(user_id)))
+        self._write_through_user_state(user_id, university_id=int(university_id))
 
     def set_subject_for_user(self, user_id: int, subject_id: int) -> None:
-        sql_statement = f"UPDATE user_activity" \
-                        f" SET subject_id ={subject_id}" \
-                        f" WHERE id={user_id}"
-        self._execute(sql_statement)
+        self._execute("UPDATE user_activity SET subject_id = ? WHERE id = ?", (int(subject_id), int(user_id)))
+        self._write_through_user_state(user_id, subject_id=int(subject_id))
+
+    # ___COMPACTION___
+    def compact_scores(self, before: int, batch_size: int = 1000, pause: float = 0.01) -> int:
+        # Deletes raw scores dated before `before`, `batch_size` rows per transaction so the write lock is
+        # only held briefly. Their per-day roll-up is already in `score_aggregate`, which is maintained on insert
+        # and not touched by deletes, so statistics do not change. Rows that were never aggregated
+        # (without university, subject or date) are kept.
+        deleted = 0
+        while True:
+            with self._transaction() as cur:
+                cur.execute(
+                    "DELETE FROM score WHERE id IN ("
+                    "   SELECT id FROM score"
+                    "   WHERE date < ? AND university_id IS NOT NULL AND subject_id IS NOT NULL"
+                    "   ORDER BY id LIMIT ?"
+                    ")",
+                    (int(before), batch_size),
+                )
+                n_rows = cur.rowcount
+            deleted += n_rows
+            if n_rows < batch_size:
+                return deleted
+            time.sleep(pause)
+
+    def incremental_vacuum(self, pages: int = 0, full: bool = False) -> int:
+        # Returns the freed pages given back to the file system, 0 frees all of them. A database created
+        # without incremental auto-vacuum needs one `full` VACUUM to switch; it rewrites the whole file.
+        con = self._connect()
+        if full and con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            con.execute("VACUUM")
+            return 0
+        free_pages = con.execute("PRAGMA freelist_count").fetchone()[0]
+        # `execute` steps the pragma only once, i.e. frees a single page; `executescript` runs it to completion.
+        con.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        return free_pages - con.execute("PRAGMA freelist_count").fetchone()[0]
+
+    # ___BROADCASTS___
+    def create_broadcast(self, text: str) -> int:
+        # Every known user except blocked chats becomes a pending recipient.
+        with self._transaction() as cur:
+            cur.execute("INSERT INTO broadcast(text, created) VALUES (?, ?)", (text, int(time.time())))
+            broadcast_id = cur.lastrowid
+            cur.execute(
+                "INSERT INTO broadcast_recipient(broadcast_id, chat_id)"
+                " SELECT ?, id FROM user_activity WHERE id NOT IN (SELECT chat_id FROM blocked_chat)",
+                (broadcast_id,),
+            )
+        return broadcast_id
+
+    def get_unfinished_broadcast(self) -> Optional[Tuple[int, str]]:
+        rows = self._execute("SELECT id, text FROM broadcast WHERE finished IS NULL ORDER BY id LIMIT 1")
+        return rows[0] if rows else None
+
+    def get_pending_broadcast_recipients(self, broadcast_id: int) -> List[int]:
+        rows = self._execute(
+            "SELECT chat_id FROM broadcast_recipient"
+            " WHERE broadcast_id = ? AND status = 0"
+            " AND chat_id NOT IN (SELECT chat_id FROM blocked_chat)",
+            (broadcast_id,),
+        )
+        return [chat_id for chat_id, in rows]
+
+    def update_broadcast_recipients(self, progress: List[Tuple[int, int, int]]) -> None:
+        # `progress` holds (status, broadcast_id, chat_id) rows.
+        with self._transaction() as cur:
+            cur.executemany(
+                "UPDATE broadcast_recipient SET status = ? WHERE broadcast_id = ? AND chat_id = ?",
+                progress,
+            )
+
+    def finish_broadcast(self, broadcast_id: int) -> None:
+        self._execute("UPDATE broadcast SET finished = ? WHERE id = ?", (int(time.time()), broadcast_id))
+
+    def block_chat(self, chat_id: int, reason: str = None) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO blocked_chat(chat_id, date, reason) VALUES (?, ?, ?)",
+            (chat_id, int(time.time()), reason),
+        )
+
+    def unblock_chat(self, chat_id: int) -> None:
+        self._execute("DELETE FROM blocked_chat WHERE chat_id = ?", (chat_id,))
+
+    # ___UPDATE_OFFSET___
+    def get_last_update_id(self) -> Optional[int]:
+        rows = self._execute("SELECT update_id FROM update_offset WHERE id = 0")
+        return rows[0][0] if rows else None
+
+    def save_update_offset(self, update_id: int, scores: List[Tuple[int, int, int, int, int]] = ()) -> None:
+        with self._transaction() as cur:
+            if scores:
+                cur.executemany(INSERT_SCORE, scores)
+            cur.execute(
+                "INSERT INTO update_offset(id, update_id) VALUES (0, ?)"
+                " ON CONFLICT(id) DO UPDATE SET update_id = excluded.update_id",
+                (update_id,),
+            )
 
     # ___CONVERTERS___
+    def _lookup(self, lookup, key):
+        value = lookup(key)
+        if value is None:
+            # Possibly inserted by another process since the last refresh.
+            self._refresh_catalog()
+            value = lookup(key)
+            if value is None:
+                raise IndexError(f"Unknown catalog entry: {key}")
+        return value
+
     def id2subject(self, subject_id: int) -> str:
-        sql_statement = f"SELECT name" \
-                        f" FROM subject" \
-                        f" WHERE id = {subject_id}"
-        subject_name = self._execute(sql_statement)[0][0]
-        return subject_name
+        return self._lookup(self._subjects.id2name, int(subject_id))
 
     def subject2id(self, subject_name: str) -> int:
-        sql_statement = f"SELECT id" \
-                        f" FROM subject" \
-                        f" WHERE name = \"{subject_name}\""
-        subject_id = self._execute(sql_statement)[0][0]
-        return subject_id
+        return self._lookup(self._subjects.name2id, subject_name)
 
     def id2university(self, university_id: int) -> str:
-        sql_statement = f"SELECT name" \
-                        f" FROM university" \
-                        f" WHERE id = {university_id}"
-        university_name = self._execute(sql_statement)[0][0]
-        return university_name
+        return self._lookup(self._universities.id2name, int(university_id))
 
     def university2id(self, university_name: str) -> int:
-        sql_statement = f"SELECT id" \
-                        f" FROM university" \
-                        f" WHERE name = \"{university_name}\""
-        subject_id = self._execute(sql_statement)[0][0]
-        return subject_id
+        return self._lookup(self._universities.name2id, university_name)
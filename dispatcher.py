@@ -0,0 +1,99 @@
+import logging
+import queue
+import threading
+from typing import Any, Callable, List, Optional
+
+__all__ = ["ChatDispatcher", "update_chat_id", ]
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _Call:
+    __slots__ = ("function", )
+
+    def __init__(self, function: Callable[[], None]):
+        self.function = function
+
+
+def update_chat_id(update) -> Optional[int]:
+    # The chat an update belongs to, or the sender for updates that are not bound to a chat.
+    for name in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        message = getattr(update, name, None)
+        if message is not None:
+            return message.chat.id
+    callback_query = getattr(update, "callback_query", None)
+    if callback_query is not None:
+        if callback_query.message is not None:
+            return callback_query.message.chat.id
+        return callback_query.from_user.id
+    for name in ("my_chat_member", "chat_member", "chat_join_request"):
+        member_update = getattr(update, name, None)
+        if member_update is not None:
+            return member_update.chat.id
+    for name in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query"):
+        query = getattr(update, name, None)
+        if query is not None:
+            return query.from_user.id
+    return None
+
+
+class ChatDispatcher:
+    # Updates are routed to a worker by chat id: one chat is always handled by the same worker, in order,
+    # while different chats run in parallel. A full worker queue blocks the producer (backpressure).
+    def __init__(
+            self,
+            handle: Callable[[Any], None],
+            n_workers: int = 8,
+            max_queue_size: int = 100,
+    ):
+        self._handle = handle
+        self.n_workers = n_workers
+        self._queues = [queue.Queue(maxsize=max_queue_size) for _ in range(n_workers)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,), name=f"dispatcher-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, update) -> None:
+        chat_id = update_chat_id(update)
+        key = update.update_id if chat_id is None else chat_id
+        self._queues[hash(key) % self.n_workers].put(update)
+
+    def submit_call(self, chat_id: int, function: Callable[[], None]) -> None:
+        # Runs `function()` in the chat's turn, after the updates of the chat submitted so far.
+        self._queues[hash(chat_id) % self.n_workers].put(_Call(function))
+
+    def stop(self) -> None:
+        # Handles everything already queued, then stops the workers.
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def join(self) -> None:
+        # Blocks until every update submitted so far has been handled.
+        for q in self._queues:
+            q.join()
+
+    def queue_sizes(self) -> List[int]:
+        return [q.qsize() for q in self._queues]
+
+    def _run(self, q: queue.Queue) -> None:
+        while True:
+            update = q.get()
+            if update is _STOP:
+                q.task_done()
+                return
+            try:
+                if isinstance(update, _Call):
+                    update.function()
+                else:
+                    self._handle(update)
+            except Exception:
+                logger.exception(f"Failed to handle update {getattr(update, 'update_id', None)}")
+            finally:
+                q.task_done()
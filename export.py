@@ -0,0 +1,63 @@
+import csv
+import json
+from datetime import datetime, timezone
+from typing import IO, Iterable, Optional, Tuple
+
+__all__ = ["EXPORT_COLUMNS", "EXPORT_FORMATS", "export_scores", "parse_date", ]
+
+EXPORT_COLUMNS = ("id", "user_id", "university", "subject", "score", "date")
+EXPORT_FORMATS = ("csv", "jsonl")
+
+
+def parse_date(value: Optional[str]) -> Optional[int]:
+    # ISO date or datetime to a unix timestamp, naive values are taken as UTC.
+    if value is None:
+        return None
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp())
+
+
+def _write_csv(rows: Iterable[Tuple], f: IO[str]) -> int:
+    writer = csv.writer(f)
+    writer.writerow(EXPORT_COLUMNS)
+    n_rows = 0
+    for row in rows:
+        writer.writerow(row)
+        n_rows += 1
+    return n_rows
+
+
+def _write_jsonl(rows: Iterable[Tuple], f: IO[str]) -> int:
+    n_rows = 0
+    for row in rows:
+        f.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False))
+        f.write("\n")
+        n_rows += 1
+    return n_rows
+
+
+def export_scores(
+        database,
+        f: IO[str],
+        format: str = "csv",
+        university: str = None,
+        subject: str = None,
+        since: str = None,
+        until: str = None,
+        chunk_size: int = 1000,
+) -> int:
+    # Streams the matching scores to `f` and returns the number of rows written.
+    # Raises IndexError for an unknown university or subject name.
+    writers = {"csv": _write_csv, "jsonl": _write_jsonl}
+    if format not in writers:
+        raise ValueError(f"Unknown export format: {format}")
+    rows = database.iter_scores(
+        university_id=None if university is None else database.university2id(university),
+        subject_id=None if subject is None else database.subject2id(subject),
+        since=parse_date(since),
+        until=parse_date(until),
+        chunk_size=chunk_size,
+    )
+    return writers[format](rows, f)
@@ -0,0 +1,114 @@
+import threading
+import time
+from array import array
+from typing import Dict, Iterable, Optional, Tuple
+
+__all__ = ["LiveMeter", ]
+
+
+class _Window:
+    # Scores of one (university, subject) in date order, in a ring buffer that doubles when full. Positions are
+    # absolute counters taken modulo the capacity: [first, middle) is the older half of the window and
+    # [middle, end) the newer one, each with a running count and sum. Pointers only move forward, so keeping
+    # the halves up to date costs O(1) amortized per score.
+    __slots__ = ("dates", "scores", "first", "middle", "end", "n_older", "sum_older", "n_newer", "sum_newer")
+
+    def __init__(self, capacity: int = 16):
+        self.dates = array("q", bytes(8 * capacity))
+        self.scores = array("b", bytes(capacity))
+        self.first = self.middle = self.end = 0
+        self.n_older = self.sum_older = self.n_newer = self.sum_newer = 0
+
+    def _grow(self) -> None:
+        capacity = len(self.dates)
+        order = [i % capacity for i in range(self.first, self.end)]
+        self.dates = array("q", [self.dates[i] for i in order]) + array("q", bytes(8 * capacity))
+        self.scores = array("b", [self.scores[i] for i in order]) + array("b", bytes(capacity))
+        self.middle -= self.first
+        self.end -= self.first
+        self.first = 0
+
+    @property
+    def last_date(self) -> Optional[int]:
+        if self.first == self.end:
+            return None
+        return self.dates[(self.end - 1) % len(self.dates)]
+
+    def add(self, date: int, score: int) -> None:
+        if self.end - self.first == len(self.dates):
+            self._grow()
+        position = self.end % len(self.dates)
+        self.dates[position] = date
+        self.scores[position] = score
+        self.end += 1
+        self.n_newer += 1
+        self.sum_newer += score
+
+    def advance(self, now: float, window: float) -> None:
+        capacity = len(self.dates)
+        while self.first < self.end and self.dates[self.first % capacity] <= now - window:
+            score = self.scores[self.first % capacity]
+            if self.first < self.middle:
+                self.n_older -= 1
+                self.sum_older -= score
+            else:
+                self.n_newer -= 1
+                self.sum_newer -= score
+                self.middle += 1
+            self.first += 1
+        while self.middle < self.end and self.dates[self.middle % capacity] <= now - window / 2:
+            score = self.scores[self.middle % capacity]
+            self.n_newer -= 1
+            self.sum_newer -= score
+            self.n_older += 1
+            self.sum_older += score
+            self.middle += 1
+
+
+class LiveMeter:
+    # Sliding-window cringe per (university, subject), in memory only and rebuilt from recent scores on start.
+    # Dates are expected to arrive roughly in order; an older date than the last one in its window is taken as
+    # that last date, which keeps the buffers sorted.
+    def __init__(self, window: float = 600.0):
+        self.window = window
+        self._windows: Dict[Tuple[int, int], _Window] = {}
+        self._lock = threading.Lock()
+
+    def add(self, university_id: int, subject_id: int, score: int, date: int) -> None:
+        with self._lock:
+            key = (university_id, subject_id)
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = _Window()
+            last_date = window.last_date
+            date = int(date) if last_date is None else max(int(date), last_date)
+            window.add(date, score)
+            window.advance(date, self.window)
+
+    def load(self, rows: Iterable[Tuple[int, int, int, int]]) -> None:
+        # (university_id, subject_id, score, date) rows, oldest first.
+        for university_id, subject_id, score, date in rows:
+            self.add(university_id, subject_id, score, date)
+
+    def get(
+            self,
+            university_id: int,
+            subject_id: int,
+            now: float = None,
+    ) -> Tuple[int, Optional[float], Optional[float]]:
+        # Returns the number of scores in the window, their mean and the trend: the mean of the newer half of the
+        # window minus that of the older half. The mean is None without scores, the trend without both halves.
+        now = time.time() if now is None else now
+        with self._lock:
+            window = self._windows.get((university_id, subject_id))
+            if window is None:
+                return 0, None, None
+            window.advance(max(now, window.last_date or now), self.window)
+            n_older, sum_older, n_newer, sum_newer = window.n_older, window.sum_older, window.n_newer, window.sum_newer
+            if n_older + n_newer == 0:
+                # Nothing recent, the buffer is dropped until the next score.
+                del self._windows[(university_id, subject_id)]
+                return 0, None, None
+        count = n_older + n_newer
+        trend = sum_newer / n_newer - sum_older / n_older if n_older and n_newer else None
+        return count, (sum_older + sum_newer) / count, trend
@@ -1,9 +1,31 @@
 import argparse
+import functools
+import logging
+import signal
+import sys
+import tempfile
+import threading
+import time
 from enum import Enum
 
 import telebot
 
+from admission import Admission
+from broadcast import Broadcaster
+from cache import LRUCache
+from catalog import CATALOG_FORMATS, format_catalog_diff, import_catalog
 from database_handler import SQLiteDB
+from compaction import Compactor
+from dispatcher import ChatDispatcher
+from export import EXPORT_FORMATS, export_scores
+from live import LiveMeter
+from metrics import Metrics
+from outbound import OutboundAPI
+from router import Router
+from memory_storage import MemoryDB
+from migrations import BUCKET_SECONDS
+
+logger = logging.getLogger(__name__)
 
 
 class Status(Enum):
@@ -14,29 +36,253 @@ class Status(Enum):
 class ReturnCode(Enum):
     DELETE_RESPONSE_REQUEST = 1
     DELETE_RESPONSE = 2
+    # The response message was replaced by another one that is still awaiting input.
+    KEEP_RESPONSE = 3
 
 
 class CringeMeterBot:
-    def __init__(self, api_token, sqlite_db_path, debug=False):
+    STATS_TREND_DAYS = 7
+    PICKER_PAGE_SIZE = 8
+    PICKER_SUGGESTIONS = 5
+
+    def __init__(
+            self,
+            api_token,
+            sqlite_db_path,
+            debug=False,
+            broadcast_rate=30.0,
+            broadcast_workers=8,
+            dispatch_workers=8,
+            dispatch_queue_size=100,
+            metrics=None,
+            admin_ids=(),
+            retention_days=0,
+            compaction_interval=3600.0,
+            storage="sqlite",
+            pending_updates="skip",
+            live_window=600.0,
+            chat_rate=1.0,
+            chat_burst=5.0,
+            score_coalesce_window=1.0,
+            reply_rate=25.0,
+            **database_options,
+    ):
         self.db_path = sqlite_db_path
-        self.bot_api = telebot.TeleBot(api_token, skip_pending=True)
-        self.database = SQLiteDB(sqlite_db_path)
+        # `metrics.Metrics` instance, None disables instrumentation altogether.
+        self.metrics = metrics
+        self.admin_ids = set(admin_ids)
+        if metrics is not None:
+            metrics.instrument_bot_api()
+        # "skip" drops the updates sent while the bot was down, "catch_up" leaves them to `catch_up`.
+        self.pending_updates = pending_updates
+        skip_pending = pending_updates == "skip"
+        self.dispatcher = None
+        if dispatch_workers > 0:
+            # Handlers run synchronously in the dispatcher workers, so that updates of one chat never overlap.
+            # Updates are routed by `self.router` directly instead of the telebot handler chain.
+            self.bot_api = self._create_bot_api(api_token, skip_pending=skip_pending, threaded=False)
+            self.dispatcher = ChatDispatcher(
+                self._process_update,
+                n_workers=dispatch_workers,
+                max_queue_size=dispatch_queue_size,
+            )
+            self.bot_api.process_new_updates = self._submit_updates
+        else:
+            self.bot_api = self._create_bot_api(api_token, skip_pending=skip_pending, threaded=True)
+        # Batched background deletions and deduplicated command lists and reply keyboards.
+        self.outbound = OutboundAPI(self.bot_api)
+        self._menu_markup = self._build_menu_markup()
+        # "memory" keeps everything in process memory and loses it on exit, for tests and benchmarks.
+        if storage == "memory":
+            self.database = MemoryDB(**database_options)
+        else:
+            self.database = SQLiteDB(sqlite_db_path, metrics=metrics, **database_options)
+        # Cringe over the last `live_window` seconds per university and subject, see /now.
+        self.live = LiveMeter(live_window)
+        self.live.load(self.database.get_recent_scores(int(time.time() - live_window)))
+        # Per-chat rate limit, coalescing of rapid scores and the global budget of score replies.
+        self.admission = Admission(
+            self._on_held_score_due,
+            chat_rate=chat_rate,
+            chat_burst=chat_burst,
+            coalesce_window=score_coalesce_window,
+            reply_rate=reply_rate,
+        )
+        # Set by `catch_up`: the backlog is made of updates already sent, so none of them is dropped as a burst.
+        self._catching_up = False
+        if metrics is not None:
+            metrics.add_counters(
+                "cringe_admission_events_total",
+                "Updates dropped over the chat rate, scores coalesced and score replies dropped",
+                "event",
+                self.admission.stats,
+            )
+        # Raw scores older than `retention_days` are deleted in the background, 0 keeps them forever.
+        self.compactor = None
+        if retention_days > 0:
+            self.compactor = Compactor(self.database, retention_days * 86400, interval=compaction_interval)
+        # Prebuilt inline keyboard pages keyed by ("university" or "subject", university id or None, cancel option,
+        # page cursor). Entries are dropped only when the database reports an inserted university or
+        # university-subject link.
+        self._select_markups = {}
+        self._select_markups_lock = threading.RLock()
+        # chat id -> (kind, name) typed by the user while similar entries are offered instead.
+        self._pending_names = LRUCache(4096)
+        self.database.add_catalog_listener(self._on_catalog_change)
+        # Two API calls per recipient: commands reset and the message itself.
+        self.broadcaster = Broadcaster(
+            self.database,
+            self._deliver_update_notification,
+            rate=broadcast_rate,
+            calls_per_recipient=2,
+            max_workers=broadcast_workers,
+        )
         self._initialize_handlers()
         if debug:
             self._add_demo_data()
 
+    def shutdown(self):
+        self.bot_api.stop_polling()
+        # Held scores are queued to their chats first, then the dispatcher handles everything queued.
+        self.admission.stop()
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        self.broadcaster.stop()
+        self.outbound.stop()
+        if self.compactor is not None:
+            self.compactor.stop()
+        self.database.close()
+        if self.metrics is not None:
+            self.metrics.close()
+
+    def _create_bot_api(self, api_token, skip_pending, threaded):
+        # The client every handler sends through.
+        return telebot.TeleBot(api_token, skip_pending=skip_pending, threaded=threaded)
+
+    def _submit_updates(self, updates):
+        # Stands in for `TeleBot.process_new_updates`, which is also where telebot advances the polling offset:
+        # without it every getUpdates call would return the same updates again.
+        for update in updates:
+            if update.update_id > self.bot_api.last_update_id:
+                self.bot_api.last_update_id = update.update_id
+            self.dispatcher.submit(update)
+
+    def _process_update(self, update):
+        if self.metrics is None:
+            self.router.dispatch(update)
+        else:
+            update_type = "callback_query" if update.callback_query is not None else "message"
+            with self.metrics.timer("update", update_type):
+                self.router.dispatch(update)
+
+    def _get_backlog_score(self, update):
+        # The score row `on_get_score` would append for this update, None for anything else.
+        message = update.message
+        if message is None:
+            return None
+        try:
+            if self.router.route_message(message) is not self.router.default_handler:
+                return None
+            state = self.database.get_user_current_state(message.chat.id)
+        except IndexError:
+            # Unknown chat, the handler deals with it.
+            return None
+        if state.university_id is None or state.subject_id is None:
+            return None
+        try:
+            score = int(message.text)
+        except ValueError:
+            return None
+        if not 0 <= score <= 10:
+            return None
+        return message.chat.id, state.university_id, state.subject_id, score, int(message.date)
+
+    def _send_backlog_replies(self, scores):
+        # One reply per chat and subject instead of one per score.
+        replies = {}
+        for chat_id, university_id, subject_id, score, _ in scores:
+            replies.setdefault((chat_id, university_id, subject_id), []).append(str(score))
+        for (chat_id, university_id, subject_id), chat_scores in replies.items():
+            university_name = self.database.id2university(university_id)
+            subject_name = self.database.id2subject(subject_id)
+            if len(chat_scores) == 1:
+                text = f"Записал {chat_scores[0]} для {subject_name} в {university_name}"
+            else:
+                text = f"Записал оценки {', '.join(chat_scores)} для {subject_name} в {university_name}"
+            text += f"\n{self._format_live(university_id, subject_id)}"
+            try:
+                self.bot_api.send_message(chat_id, text)
+            except Exception:
+                logger.exception(f"Failed to reply to chat {chat_id}")
+
+    def catch_up(self, batch_size=100):
+        # Handles the updates sent while the bot was down, in order and in the calling thread, before polling
+        # starts. Scores are appended in bulk in one transaction with the id of the last handled update, and
+        # other updates go through the usual handlers one at a time. A crash therefore loses nothing and
+        # replays at most the one non-score update that was being handled; updates are confirmed to Telegram
+        # only by fetching past the stored id. Returns (updates handled, scores appended, seconds).
+        start = time.perf_counter()
+        last_update_id = saved_update_id = self.database.get_last_update_id()
+        if saved_update_id is not None and self._update_ids_restarted(saved_update_id, batch_size):
+            logger.warning(f"Pending update ids are all below the stored {saved_update_id}, starting over from them")
+            last_update_id = saved_update_id = None
+        n_updates = n_scores = 0
+        scores = []
+
+        def save():
+            nonlocal saved_update_id, n_scores
+            if last_update_id is None or last_update_id == saved_update_id:
+                return
+            self.database.save_update_offset(last_update_id, scores)
+            saved_update_id = last_update_id
+            for _, university_id, subject_id, score, date in scores:
+                self.live.add(university_id, subject_id, score, date)
+            n_scores += len(scores)
+            self._send_backlog_replies(scores)
+            scores.clear()
+
+        self._catching_up = True
+        try:
+            while True:
+                offset = None if last_update_id is None else last_update_id + 1
+                updates = self.bot_api.get_updates(offset=offset, limit=batch_size, timeout=0)
+                updates = [update for update in updates if last_update_id is None or update.update_id > last_update_id]
+                if not updates:
+                    break
+                for update in updates:
+                    row = self._get_backlog_score(update)
+                    if row is not None:
+                        scores.append(row)
+                    else:
+                        # The handler may change the state later scores depend on, so earlier ones go in first.
+                        save()
+                        try:
+                            self._process_update(update)
+                        except Exception:
+                            logger.exception(f"Failed to handle update {update.update_id}")
+                    last_update_id = update.update_id
+                    n_updates += 1
+                save()
+        finally:
+            self._catching_up = False
+        if last_update_id is not None:
+            # Polling continues right after the backlog.
+            self.bot_api.last_update_id = last_update_id
+        return n_updates, n_scores, time.perf_counter() - start
+
+    def _update_ids_restarted(self, saved_update_id, batch_size):
+        # After a week without updates Telegram numbers the next ones from a random value, which may be below the
+        # stored id: fetching past it would then confirm and drop the whole backlog. Without an offset nothing is
+        # confirmed. Updates handled but not yet confirmed before a restart end at the stored id, never below it.
+        updates = self.bot_api.get_updates(offset=None, limit=batch_size, timeout=0)
+        return bool(updates) and max(update.update_id for update in updates) < saved_update_id
+
     def _add_demo_data(self):
-        university_ids = []
-        subject_ids = []
-        for university_name in ["ИТМО", "ЛЭТИ", "СПБГУ"]:
-            self.database.append_university(university_name)
-            university_ids.append(self.database.university2id(university_name))
-        for subject_name in ["ArchNN", "BigData", "IRME"]:
-            self.database.append_subject(subject_name)
-            subject_ids.append(self.database.subject2id(subject_name))
-        self.database.append_subject_to_university(university_ids[0], subject_ids[0])
-        self.database.append_subject_to_university(university_ids[0], subject_ids[1])
-        self.database.append_subject_to_university(university_ids[1], subject_ids[2])
+        self.database.import_catalog(
+            ["ИТМО", "ЛЭТИ", "СПБГУ"],
+            ["ArchNN", "BigData", "IRME"],
+            [("ИТМО", "ArchNN"), ("ИТМО", "BigData"), ("ЛЭТИ", "IRME")],
+        )
 
     def _build_menu_markup(self):
         markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
@@ -45,63 +291,116 @@ class CringeMeterBot:
         markup.add(select_subject_button, current_subject_button)
         return markup
 
-    def _show_command_menu(self, chat_id):
-        commands = [
+    def _build_command_list(self):
+        return [
             telebot.types.BotCommand("/start", "Запустить или обновить бота"),
             telebot.types.BotCommand("/help", "Показать справку"),
             telebot.types.BotCommand("/change_university", "Сменить университет"),
             telebot.types.BotCommand("/current_university", "Показать выбранный университет"),
             telebot.types.BotCommand("/change_subject", "Сменить предмет"),
             telebot.types.BotCommand("/current_subject", "Показать выбранный предмет"),
+            telebot.types.BotCommand("/stats", "Статистика кринжа по выбранному предмету"),
+            telebot.types.BotCommand("/now", "Кринж прямо сейчас по выбранному предмету"),
         ]
-        self.bot_api.set_my_commands(commands, telebot.types.BotCommandScopeChat(chat_id))
+
+    def _show_command_menu(self, chat_id):
+        self.outbound.set_my_commands(chat_id, self._build_command_list())
+
+    def _instrument(self, label, function):
+        if self.metrics is None:
+            return function
+        return self.metrics.wrap("handler", label, function)
+
+    def _admitted(self, function, holds_scores=False):
+        # Updates over the chat's rate are dropped before the handler does anything, see `Admission`. Handlers
+        # other than the score one store the chat's held score first: it came before the update they handle.
+        # Dropped callback queries are still answered, or the pressed button keeps spinning.
+        @functools.wraps(function)
+        def wrapper(item):
+            chat = getattr(item, "chat", None)
+            if chat is not None:
+                chat_id = chat.id
+            elif item.message is not None:
+                chat_id = item.message.chat.id
+            else:
+                chat_id = item.from_user.id
+            if self._catching_up or self.admission.admit(chat_id):
+                if not holds_scores:
+                    self._store_held_score(chat_id)
+                return function(item)
+            if chat is None:
+                self.bot_api.answer_callback_query(item.id)
+
+        return wrapper
 
     def _initialize_handlers(self):
-        # Callback query handlers. The handlers and processed in the declaration order.
-        self.bot_api.callback_query_handler(func=lambda call: True)(self._callback_query_handler)
-        # Message handlers. The handlers and processed in the declaration order.
+        # The routing table keeps the order telebot handlers were declared in: callback queries,
+        # commands, menu buttons, awaited input and finally scores. See `Router`. Filters are not rate limited,
+        # handlers are.
+        def i(label, function, admitted=True, holds_scores=False):
+            function = self._instrument(label, function)
+            return self._admitted(function, holds_scores) if admitted else function
+
+        router = Router()
+        #   Callback query handlers
+        router.add_callback_prefix("university_id", i("callback_query", self._callback_query_handler))
+        router.add_callback_prefix("subject_id", i("callback_query", self._callback_query_handler))
+        router.add_callback_prefix("university_page", i("callback_query:page", self._page_callback_handler))
+        router.add_callback_prefix("subject_page", i("callback_query:page", self._page_callback_handler))
+        router.add_callback_prefix("university_new", i("callback_query:new", self._new_name_callback_handler))
+        router.add_callback_prefix("subject_new", i("callback_query:new", self._new_name_callback_handler))
         #   Command handlers
-        self.bot_api.message_handler(commands=["start"])(self.on_start)
-        self.bot_api.message_handler(commands=["help"])(self.on_help)
-        self.bot_api.message_handler(commands=["change_university"])(self.on_change_university)
-        self.bot_api.message_handler(commands=["current_university"])(self.on_get_current_university)
-        self.bot_api.message_handler(commands=["change_subject"])(self.on_change_subject)
-        self.bot_api.message_handler(commands=["current_subject"])(self.on_get_current_subject)
-        self.bot_api.message_handler(commands=["kon_notify_users"])(self.notify_for_update)
-        # #   Menu button handlers
-        self.bot_api.message_handler(func=lambda msg: msg.text == "Выбрать предмет")(self.on_change_subject)
-        self.bot_api.message_handler(func=lambda msg: msg.text == "Выбранный предмет")(self.on_get_current_subject)
-        # #   Data handlers
-        if_user_await = lambda msg: self.database.get_user_current_state(msg.chat.id)[-1] != 0
-        self.bot_api.message_handler(func=if_user_await)(self._on_wait_new_entry_message)
-        self.bot_api.message_handler(content_types=["text"])(self.on_get_score)
+        router.add_command("start", i("on_start", self.on_start))
+        router.add_command("help", i("on_help", self.on_help))
+        router.add_command("change_university", i("on_change_university", self.on_change_university))
+        router.add_command("current_university", i("on_get_current_university", self.on_get_current_university))
+        router.add_command("change_subject", i("on_change_subject", self.on_change_subject))
+        router.add_command("current_subject", i("on_get_current_subject", self.on_get_current_subject))
+        router.add_command("stats", i("on_stats", self.on_stats))
+        router.add_command("now", i("on_now", self.on_now))
+        router.add_command("kon_notify_users", i("notify_for_update", self.notify_for_update))
+        router.add_command("kon_metrics", i("on_metrics", self.on_metrics))
+        router.add_command("kon_export", i("on_export", self.on_export))
+        #   Menu button handlers
+        router.add_text("Выбрать предмет", i("on_change_subject", self.on_change_subject))
+        router.add_text("Выбранный предмет", i("on_get_current_subject", self.on_get_current_subject))
+        #   Data handlers. The awaiting state comes from the cached user state.
+        if_user_await = i(
+            "filter:user_await",
+            lambda msg: self.database.get_user_current_state(msg.chat.id).wait_for != 0,
+            admitted=False,
+        )
+        router.set_awaiting(if_user_await, i("on_wait_new_entry", self._on_wait_new_entry_message))
+        router.set_default(i("on_get_score", self.on_get_score, holds_scores=True))
+        self.router = router
+        self._register_handlers()
+
+    def _register_handlers(self):
+        # Used when updates are not routed by the dispatcher.
+        self.router.register(self.bot_api)
 
     def _delete_response_request_messages(self, chat_id, response_message_id, request_message_id=None):
-        if request_message_id is not None:
-            self.bot_api.delete_message(chat_id, request_message_id)
-        self.bot_api.delete_message(chat_id, response_message_id)
-        # self.user__state[chat_id].clear_awaiting()
+        # The deletion goes out in the background, the awaiting state is cleared right away.
+        self.outbound.delete_messages(chat_id, [request_message_id, response_message_id])
         self.database.clear_user_awaiting(chat_id)
 
     # ___
 
     def _maybe_continue_on_start(self, message):
         chat_id = message.chat.id
-        ready, _, _, _, _, _ = self.database.get_user_current_state(chat_id)
-        if not ready:
+        if not self.database.get_user_current_state(chat_id).ready:
             self.on_start(message, send_welcome=False)
 
     def _is_wait_for_university_promt(self, chat_id):
-        _, _, _, _, _, wait_for = self.database.get_user_current_state(chat_id)
-        return wait_for == Status.WAIT_FOR_UNIVERSITY_NAME.value
+        return self.database.get_user_current_state(chat_id).wait_for == Status.WAIT_FOR_UNIVERSITY_NAME.value
 
     def _is_wait_for_subject_promt(self, chat_id):
-        _, _, _, _, _, wait_for = self.database.get_user_current_state(chat_id)
-        return wait_for == Status.WAIT_FOR_SUBJECT_NAME.value
+        return self.database.get_user_current_state(chat_id).wait_for == Status.WAIT_FOR_SUBJECT_NAME.value
 
     def on_get_score(self, message):
         chat_id = message.chat.id
-        _, university_id, subject_id, _, _, _ = self.database.get_user_current_state(chat_id)
+        state = self.database.get_user_current_state(chat_id)
+        university_id, subject_id = state.university_id, state.subject_id
         if university_id is None or subject_id is None:
             if university_id is None:
                 text = "Выбери свой университет с помощью /select_university"
@@ -116,34 +415,116 @@ class CringeMeterBot:
                     text = "Шкала кринжа от 0 до 10."
                     self.bot_api.send_message(chat_id, text)
                 else:
-                    university_name = self.database.id2university(university_id)
-                    subject_name = self.database.id2subject(subject_id)
-                    date = message.date
-                    self.database.append_score(chat_id, university_id, subject_id, score, date)
-                    text = f"Записал {score} для {subject_name} в {university_name}"
-                    self.bot_api.send_message(chat_id, text)
+                    row = (chat_id, university_id, subject_id, score, int(message.date))
+                    if not self.admission.hold_score(chat_id, row):
+                        self._store_score(row)
             except ValueError:
                 text = "Жду от тебя текущий уровень кринжа по шкале от 0 до 10."
                 self.bot_api.send_message(chat_id, text)
 
+    def _build_score_reply(self, row, n_scores=1):
+        _, university_id, subject_id, score, _ = row
+        university_name = self.database.id2university(university_id)
+        subject_name = self.database.id2subject(subject_id)
+        text = f"Записал {score} для {subject_name} в {university_name}"
+        if n_scores > 1:
+            text += f" (последнюю из {n_scores} оценок подряд)"
+        return f"{text}\n{self._format_live(university_id, subject_id)}"
+
+    def _store_score(self, row, n_scores=1):
+        chat_id, university_id, subject_id, score, date = row
+        self.database.append_score(*row)
+        self.live.add(university_id, subject_id, score, date)
+        if self.admission.take_reply():
+            self.bot_api.send_message(chat_id, self._build_score_reply(row, n_scores))
+
+    def _store_held_score(self, chat_id):
+        held = self.admission.take_held(chat_id)
+        if held is not None:
+            self._store_score(*held)
+
+    def _on_held_score_due(self, chat_id):
+        # Called by `self.admission` from its own thread.
+        self._run_in_chat(chat_id, functools.partial(self._store_held_score, chat_id))
+
+    def _run_in_chat(self, chat_id, function):
+        # Runs `function()` after the updates of the chat received so far, like one more update of the chat.
+        if self.dispatcher is not None:
+            self.dispatcher.submit_call(chat_id, function)
+        else:
+            # The telebot thread pool does not keep the order of a chat's updates anyway.
+            function()
+
+    def _resolve_typed_name(self, chat_id, kind, name):
+        # Returns the name to register and the similar entries to offer instead, at most one of them set.
+        # A name differing from an existing one only in case, "ё" or punctuation is the existing one. Similar
+        # entries are offered once; the same name typed again or "Добавить" registers it as is.
+        if kind == "university":
+            existing_id = self.database.find_university(name)
+            if existing_id is not None:
+                return self.database.id2university(existing_id), None
+            similar = self.database.search_universities(name, self.PICKER_SUGGESTIONS)
+        else:
+            existing_id = self.database.find_subject(name)
+            if existing_id is not None:
+                return self.database.id2subject(existing_id), None
+            university_id = self.database.get_user_current_state(chat_id).university_id
+            similar = self.database.search_subjects(name, university_id, self.PICKER_SUGGESTIONS)
+        if not similar or self._pending_names.get(chat_id) == (kind, name):
+            self._pending_names.pop(chat_id)
+            return name, None
+        self._pending_names.put(chat_id, (kind, name))
+        return None, similar
+
+    def _build_suggestions_markup(self, kind, name, similar):
+        markup = telebot.types.InlineKeyboardMarkup()
+        for id, similar_name in similar:
+            markup.add(telebot.types.InlineKeyboardButton(similar_name, callback_data=f"{kind}_id:{id}"))
+        markup.add(telebot.types.InlineKeyboardButton(f"Добавить «{name}»", callback_data=f"{kind}_new:"))
+        return markup
+
+    def _suggest_similar(self, chat_id, kind, name, similar):
+        # The suggestions replace the open menu as the message awaiting a choice.
+        state = self.database.get_user_current_state(chat_id)
+        text = "Похожие названия уже есть, выбери одно из них или добавь своё."
+        response_message = self.bot_api.send_message(
+            chat_id,
+            text,
+            reply_markup=self._build_suggestions_markup(kind, name, similar),
+        )
+        self.outbound.delete_messages(chat_id, [state.response_message_id])
+        self.database.begin_user_awaiting(chat_id, state.wait_for, response_message.id, state.request_message_id)
+        return ReturnCode.KEEP_RESPONSE
+
     def _handle_university_promt(self, chat_id, university_name):
-        self.database.append_university(university_name)
-        university_id = self.database.university2id(university_name)
-        self.database.set_university_for_user(chat_id, university_id)
-        text = f"Все последующие оценки будут записаны для {university_name}."
+        name, similar = self._resolve_typed_name(chat_id, "university", university_name)
+        if similar is not None:
+            return self._suggest_similar(chat_id, "university", university_name, similar)
+        self.database.register_and_select_university(chat_id, name)
+        text = f"Все последующие оценки будут записаны для {name}."
         self.bot_api.send_message(chat_id, text)
         return ReturnCode.DELETE_RESPONSE
 
     def _handle_subject_promt(self, chat_id, subject_name):
-        self.database.append_subject(subject_name)
-        subject_id = self.database.subject2id(subject_name)
-        _, university_id, _, _, _, _ = self.database.get_user_current_state(chat_id)
-        self.database.set_subject_for_user(chat_id, subject_id)
-        self.database.append_subject_to_university(university_id, subject_id)
-        text = f"Все последующие оценки будут записаны для {subject_name}."
+        name, similar = self._resolve_typed_name(chat_id, "subject", subject_name)
+        if similar is not None:
+            return self._suggest_similar(chat_id, "subject", subject_name, similar)
+        self.database.register_and_select_subject(chat_id, name)
+        text = f"Все последующие оценки будут записаны для {name}."
         self.bot_api.send_message(chat_id, text)
         return ReturnCode.DELETE_RESPONSE
 
+    def _finish_new_entry(self, message, return_code):
+        if return_code == ReturnCode.KEEP_RESPONSE:
+            return
+        if return_code == ReturnCode.DELETE_RESPONSE:
+            chat_id = message.chat.id
+            response_message_id = self.database.get_user_current_state(chat_id).response_message_id
+            self._delete_response_request_messages(chat_id, response_message_id, None)
+        else:
+            raise ValueError(f"Invalid return code: {return_code}")
+        self._maybe_continue_on_start(message)
+
     def _on_wait_new_entry_message(self, message):
         chat_id = message.chat.id
         try:
@@ -165,12 +546,7 @@ class CringeMeterBot:
             return_code = self._handle_subject_promt(chat_id, message.text)
         else:
             return
-        if return_code == ReturnCode.DELETE_RESPONSE:
-            _, _, _, response_message_id, _, _ = self.database.get_user_current_state(chat_id)
-            self._delete_response_request_messages(chat_id, response_message_id, None)
-        else:
-            raise ValueError(f"Invalid return code: {return_code}")
-        self._maybe_continue_on_start(message)
+        self._finish_new_entry(message, return_code)
 
     def _handle_university_selection(self, chat_id, university_id):
         if university_id != "None":
@@ -193,9 +569,21 @@ class CringeMeterBot:
             return ReturnCode.DELETE_RESPONSE_REQUEST
 
     def _maybe_cancel_previous_menu(self, chat_id):
-        _, _, _, response_message_id, request_message_id, wait_for = self.database.get_user_current_state(chat_id)
-        if wait_for == 1:
-            self._delete_response_request_messages(chat_id, response_message_id, request_message_id)
+        state = self.database.get_user_current_state(chat_id)
+        if state.wait_for == 1:
+            self._delete_response_request_messages(chat_id, state.response_message_id, state.request_message_id)
+
+    def _build_placeholder_message(self, chat_id):
+        # Stands in for a user message when a menu is opened by the bot itself.
+        return telebot.types.Message(
+            message_id=-1,
+            from_user=telebot.types.User(id=None, is_bot=None, first_name=None),
+            date=None,
+            chat=telebot.types.Chat(id=chat_id, type=None),
+            content_type=None,
+            options={},
+            json_string=None,
+        )
 
     def _callback_query_handler(self, callback_query):
         chat_id = callback_query.message.chat.id
@@ -209,30 +597,63 @@ class CringeMeterBot:
         else:
             return
         if return_code == ReturnCode.DELETE_RESPONSE:
-            ready, _, _, response_message_id, _, _ = self.database.get_user_current_state(chat_id)
-            self._delete_response_request_messages(chat_id, response_message_id, None)
-            if ask_to_select_subject and ready:
-                message = telebot.types.Message(
-                    message_id=-1,
-                    from_user=telebot.types.User(id=None, is_bot=None, first_name=None),
-                    date=None,
-                    chat=telebot.types.Chat(id=chat_id, type=None),
-                    content_type=None,
-                    options={},
-                    json_string=None,
-                )
-                self._ask_to_select_subject(message=message, cancel_option=False)
+            state = self.database.get_user_current_state(chat_id)
+            self._delete_response_request_messages(chat_id, state.response_message_id, None)
+            if ask_to_select_subject and state.ready:
+                self._ask_to_select_subject(message=self._build_placeholder_message(chat_id), cancel_option=False)
         elif return_code == ReturnCode.DELETE_RESPONSE_REQUEST:
-            _, _, _, response_message_id, request_message_id, _ = self.database.get_user_current_state(chat_id)
+            state = self.database.get_user_current_state(chat_id)
             self._delete_response_request_messages(
                 chat_id,
-                response_message_id,
-                request_message_id,
+                state.response_message_id,
+                state.request_message_id,
             )
         else:
             raise ValueError(f"Invalid return code: {return_code}")
         self._maybe_continue_on_start(callback_query.message)
 
+    def _get_page_markup(self, chat_id, callback_query):
+        # Callback data is "<kind>_page:<after|before>:<id>:<cancel option>". Returns None for malformed data
+        # and for keyboards of menus that are no longer awaiting a choice.
+        split = callback_query.data.split(":")
+        if len(split) != 4 or split[1] not in ("after", "before") or not split[2].isdigit():
+            return None
+        kind = split[0][:-len("_page")]
+        state = self.database.get_user_current_state(chat_id)
+        if state.wait_for == 0 or state.response_message_id != callback_query.message.message_id:
+            return None
+        scope = None if kind == "university" else state.university_id
+        markup, _ = self._get_select_markup(kind, scope, split[3] == "1", (split[1], int(split[2])))
+        return markup
+
+    def _page_callback_handler(self, callback_query):
+        chat_id = callback_query.message.chat.id
+        markup = self._get_page_markup(chat_id, callback_query)
+        if markup is not None:
+            self.bot_api.edit_message_reply_markup(chat_id, callback_query.message.message_id, reply_markup=markup)
+        self.bot_api.answer_callback_query(callback_query.id)
+
+    def _new_name_callback_handler(self, callback_query):
+        chat_id = callback_query.message.chat.id
+        kind = callback_query.data.split(":")[0][:-len("_new")]
+        # Only the suggestions message still awaiting this kind of name can add it, not an older menu.
+        status = Status.WAIT_FOR_UNIVERSITY_NAME if kind == "university" else Status.WAIT_FOR_SUBJECT_NAME
+        state = self.database.get_user_current_state(chat_id)
+        if state.wait_for != status.value or state.response_message_id != callback_query.message.message_id:
+            self.bot_api.answer_callback_query(callback_query.id, "Это меню уже закрыто.")
+            return
+        pending = self._pending_names.get(chat_id)
+        if pending is None or pending[0] != kind:
+            # Offered before a restart, the typed name is gone.
+            self.bot_api.answer_callback_query(callback_query.id, "Напиши название ещё раз.")
+            return
+        self.bot_api.answer_callback_query(callback_query.id)
+        if kind == "university":
+            return_code = self._handle_university_promt(chat_id, pending[1])
+        else:
+            return_code = self._handle_subject_promt(chat_id, pending[1])
+        self._finish_new_entry(callback_query.message, return_code)
+
     def send_welcome(self, chat_id):
         welcome_message = "Привет!\n" \
                           "Я предлагаю тебе присоединиться к сбору статистики по уровню кринжа на парах.\n" \
@@ -242,71 +663,96 @@ class CringeMeterBot:
     def _show_keyboard_menu(self, chat_id):
         text = "Я готов к использованию.\n" \
                "Нажми /help, чтобы увидеть справку."
-        menu_markup = self._build_menu_markup()
-        self.bot_api.send_message(chat_id, text=text, reply_markup=menu_markup)
+        self.outbound.send_reply_keyboard(chat_id, text, self._menu_markup)
 
-    def _ask_to_select(
-            self,
-            message,
-            response_message_text,
-            id_name,
-            callback_data_prefix,
-            status,
-            cancel_option=True,
-    ):
+    def _on_catalog_change(self, table, university_id):
+        if table == "university":
+            kind, scope = "university", None
+        elif table == "university_subject":
+            kind, scope = "subject", university_id
+        else:
+            return
+        with self._select_markups_lock:
+            for key in [key for key in self._select_markups if key[:2] == (kind, scope)]:
+                del self._select_markups[key]
+
+    def _load_select_page(self, kind, scope, cursor):
+        # One row more than a page, to tell whether there is another page in that direction.
+        direction, id = cursor if cursor is not None else ("after", None)
+        after_id, before_id = (id, None) if direction == "after" else (None, id)
+        limit = self.PICKER_PAGE_SIZE + 1
+        if kind == "university":
+            return self.database.get_universities_page(after_id, before_id, limit)
+        if scope is None:
+            return []
+        return self.database.get_university_subjects_page(scope, after_id, before_id, limit)
+
+    def _get_select_markup(self, kind, scope, cancel_option, cursor=None):
+        # Returns the cached keyboard page and the number of entries in it. `cursor` is None for the first page,
+        # ("after", id) for the page after `id` or ("before", id) for the page before it.
+        key = (kind, scope, cancel_option, cursor)
+        with self._select_markups_lock:
+            cached = self._select_markups.get(key)
+            if cached is not None:
+                return cached
+            rows = self._load_select_page(kind, scope, cursor)
+            if cursor is not None and cursor[0] == "before":
+                has_previous, has_next = len(rows) > self.PICKER_PAGE_SIZE, True
+                rows = rows[-self.PICKER_PAGE_SIZE:]
+            else:
+                has_previous, has_next = cursor is not None, len(rows) > self.PICKER_PAGE_SIZE
+                rows = rows[:self.PICKER_PAGE_SIZE]
+            markup = telebot.types.InlineKeyboardMarkup()
+            if cancel_option:
+                markup.add(telebot.types.InlineKeyboardButton("Отмена", callback_data=f"{kind}_id:None"))
+            for id, name in rows:
+                markup.add(telebot.types.InlineKeyboardButton(name, callback_data=f"{kind}_id:{id}"))
+            navigation = []
+            if rows and has_previous:
+                callback_data = f"{kind}_page:before:{rows[0][0]}:{int(cancel_option)}"
+                navigation.append(telebot.types.InlineKeyboardButton("◀", callback_data=callback_data))
+            if rows and has_next:
+                callback_data = f"{kind}_page:after:{rows[-1][0]}:{int(cancel_option)}"
+                navigation.append(telebot.types.InlineKeyboardButton("▶", callback_data=callback_data))
+            if navigation:
+                markup.row(*navigation)
+            cached = (markup, len(rows))
+            self._select_markups[key] = cached
+            return cached
+
+    def _ask_to_select(self, message, response_message_text, markup, status):
         chat_id = message.chat.id
-        markup = telebot.types.InlineKeyboardMarkup()
-        if cancel_option:
-            markup.add(telebot.types.InlineKeyboardButton("Отмена", callback_data=f"{callback_data_prefix}:None"))
-        for id, name in id_name:
-            callback_data = f"{callback_data_prefix}:{id}"
-            markup.add(telebot.types.InlineKeyboardButton(name, callback_data=callback_data))
         response_message = self.bot_api.send_message(chat_id, response_message_text, reply_markup=markup)
-        self.database.set_wait_for_user(chat_id, status.value)
-        self.database.set_response_message_id_for_user(chat_id, response_message.id)
-        self.database.set_request_message_id_for_user(chat_id, message.id)
+        self.database.begin_user_awaiting(chat_id, status.value, response_message.id, message.id)
 
     def _ask_to_select_university(self, message, cancel_option=True):
-        university_id_name = self.database.get_all_universities()
-        if len(university_id_name) == 0:
+        markup, n_universities = self._get_select_markup("university", None, cancel_option)
+        if n_universities == 0:
             response_message_text = "Напиши название своего университета."
         else:
             response_message_text = "Выбери свой университет из списка или напиши свой."
-        self._ask_to_select(
-            message,
-            response_message_text,
-            university_id_name,
-            "university_id",
-            Status.WAIT_FOR_UNIVERSITY_NAME,
-            cancel_option,
-        )
+        self._ask_to_select(message, response_message_text, markup, Status.WAIT_FOR_UNIVERSITY_NAME)
 
     def _ask_to_select_subject(self, message, cancel_option=True):
         chat_id = message.chat.id
-        _, university_id, subject_id, _, _, _ = self.database.get_user_current_state(chat_id)
-        subject_ids = [i[0] for i in self.database.get_university_subjects(university_id)]
-        subject_names = [self.database.id2subject(i) for i in subject_ids]
-        subject_id_name = list(zip(subject_ids, subject_names))
-        if len(subject_id_name) == 0:
+        university_id = self.database.get_user_current_state(chat_id).university_id
+        markup, n_subjects = self._get_select_markup("subject", university_id, cancel_option)
+        if n_subjects == 0:
             response_message_text = "Напиши название предмета."
         else:
             response_message_text = "Выбери предмет из списка или напиши свой."
-        self._ask_to_select(
-            message,
-            response_message_text,
-            subject_id_name,
-            "subject_id",
-            Status.WAIT_FOR_SUBJECT_NAME,
-            cancel_option,
-        )
+        self._ask_to_select(message, response_message_text, markup, Status.WAIT_FOR_SUBJECT_NAME)
 
     # Command events
     def on_start(self, message, send_welcome=True):
         chat_id = message.chat.id
         self.database.append_user(chat_id)
+        # Writing to the bot again means it is no longer blocked by this chat.
+        self.database.unblock_chat(chat_id)
         if send_welcome:
             self.send_welcome(chat_id)
-        _, university_id, subject_id, _, _, _ = self.database.get_user_current_state(chat_id)
+        state = self.database.get_user_current_state(chat_id)
+        university_id, subject_id = state.university_id, state.subject_id
         if university_id is None:
             self._ask_to_select_university(message, cancel_option=False)  # Add decorator that calls `on_start` again
             return
@@ -336,14 +782,14 @@ class CringeMeterBot:
                "Ставить оценок можешь сколько угодно.\n\n" \
                "Список доступных команд ты можешь увидеть в меню.\n" \
                "Для смены предмета нажми кнопку \"Выбрать предмет\" или выбери этот пункт в меню.\n" \
-               "Чтобы быстро узнать выбранный предмет нажми \"Выбранный предмет\" или выбери этот пункт в меню.\n\n" \
+               "Чтобы быстро узнать выбранный предмет нажми \"Выбранный предмет\" или выбери этот пункт в меню.\n" \
+               "Статистику по выбранному предмету покажет /stats.\n\n" \
                "Все прочие сообщения, которые ты будешь писать в чате будут записаны как твоя оценка уровня кринжа."
         self.bot_api.send_message(chat_id, text)
 
     def on_change_university(self, message):
         chat_id = message.chat.id
-        ready, _, _, _, _, _ = self.database.get_user_current_state(chat_id)
-        if ready != 1:
+        if self.database.get_user_current_state(chat_id).ready != 1:
             self.bot_api.send_message(chat_id, "Для начала закончи выбор университета и предмета.")
         else:
             self._maybe_cancel_previous_menu(message.chat.id)
@@ -351,18 +797,17 @@ class CringeMeterBot:
 
     def on_get_current_university(self, message):
         chat_id = message.chat.id
-        ready, university_id, _, _, _, _ = self.database.get_user_current_state(chat_id)
-        if ready != 1:
+        state = self.database.get_user_current_state(chat_id)
+        if state.ready != 1:
             self.bot_api.send_message(chat_id, "Для начала закончи выбор университета и предмета.")
         else:
             self._maybe_cancel_previous_menu(chat_id)
-            university_name = self.database.id2university(university_id)
+            university_name = self.database.id2university(state.university_id)
             self.bot_api.send_message(chat_id, f"Текущий выбор университета: {university_name}")
 
     def on_change_subject(self, message):
         chat_id = message.chat.id
-        ready, _, _, _, _, _ = self.database.get_user_current_state(chat_id)
-        if ready != 1:
+        if self.database.get_user_current_state(chat_id).ready != 1:
             self.bot_api.send_message(chat_id, "Для начала закончи выбор университета и предмета.")
         else:
             self._maybe_cancel_previous_menu(message.chat.id)
@@ -370,32 +815,343 @@ class CringeMeterBot:
 
     def on_get_current_subject(self, message):
         chat_id = message.chat.id
-        ready, _, subject_id, _, _, _ = self.database.get_user_current_state(chat_id)
-        if ready != 1:
+        state = self.database.get_user_current_state(chat_id)
+        if state.ready != 1:
             self.bot_api.send_message(chat_id, "Для начала закончи выбор университета и предмета.")
         else:
             self._maybe_cancel_previous_menu(chat_id)
-            subject_name = self.database.id2subject(subject_id)
+            subject_name = self.database.id2subject(state.subject_id)
             self.bot_api.send_message(chat_id, f"Текущий выбор предмет: {subject_name}")
 
+    def _format_stats(self, university_name, subject_name, total, daily, now):
+        lines = [
+            f"Статистика для {subject_name} в {university_name}",
+            f"Оценок: {total.count}",
+            f"Средний кринж: {total.mean:.1f} ± {total.std:.1f} (от {total.min} до {total.max})",
+            "",
+            "Распределение:",
+        ]
+        peak = max(total.histogram)
+        for score, count in enumerate(total.histogram):
+            bar = "█" * round(10 * count / peak) if peak else ""
+            lines.append(f"{score:>2} {bar} {count}")
+        # Trend: mean of the last week against the week before.
+        last_bucket = int(now) // BUCKET_SECONDS
+        weeks = [[0, 0], [0, 0]]
+        for aggregate in daily:
+            week = weeks[0] if aggregate.bucket > last_bucket - self.STATS_TREND_DAYS else weeks[1]
+            week[0] += aggregate.count
+            week[1] += aggregate.sum
+        (current_count, current_sum), (previous_count, previous_sum) = weeks
+        lines.append("")
+        if current_count and previous_count:
+            current_mean, previous_mean = current_sum / current_count, previous_sum / previous_count
+            arrow = "↑" if current_mean > previous_mean else "↓" if current_mean < previous_mean else "→"
+            lines.append(f"За неделю: {current_mean:.1f} {arrow} (неделей ранее {previous_mean:.1f})")
+        elif current_count:
+            lines.append(f"За неделю: {current_sum / current_count:.1f}")
+        else:
+            lines.append("За последнюю неделю оценок не было.")
+        return "\n".join(lines)
+
+    def _build_stats_text(self, state):
+        total = self.database.get_score_aggregate(state.university_id, state.subject_id)
+        subject_name = self.database.id2subject(state.subject_id)
+        if total is None:
+            return f"Для {subject_name} пока нет ни одной оценки."
+        now = time.time()
+        daily = self.database.get_daily_score_aggregates(
+            state.university_id,
+            state.subject_id,
+            2 * self.STATS_TREND_DAYS,
+            now,
+        )
+        university_name = self.database.id2university(state.university_id)
+        return self._format_stats(university_name, subject_name, total, daily, now)
+
+    def on_stats(self, message):
+        chat_id = message.chat.id
+        state = self.database.get_user_current_state(chat_id)
+        if state.ready != 1:
+            self.bot_api.send_message(chat_id, "Для начала закончи выбор университета и предмета.")
+            return
+        self._maybe_cancel_previous_menu(chat_id)
+        self.bot_api.send_message(chat_id, self._build_stats_text(state))
+
+    def _format_live(self, university_id, subject_id, now=None):
+        count, mean, trend = self.live.get(university_id, subject_id, now)
+        minutes = round(self.live.window / 60)
+        if count == 0:
+            return f"За последние {minutes} мин оценок не было."
+        text = f"Кринж сейчас: {mean:.1f} ({count} за {minutes} мин)"
+        if trend is not None:
+            arrow = "↑" if trend > 0 else "↓" if trend < 0 else "→"
+            text += f", {arrow} {trend:+.1f}"
+        return text
+
+    def on_now(self, message):
+        chat_id = message.chat.id
+        state = self.database.get_user_current_state(chat_id)
+        if state.ready != 1:
+            self.bot_api.send_message(chat_id, "Для начала закончи выбор университета и предмета.")
+            return
+        self._maybe_cancel_previous_menu(chat_id)
+        subject_name = self.database.id2subject(state.subject_id)
+        text = f"{subject_name}\n{self._format_live(state.university_id, state.subject_id)}"
+        self.bot_api.send_message(chat_id, text)
+
+    def on_metrics(self, message):
+        chat_id = message.chat.id
+        if chat_id not in self.admin_ids:
+            return
+        admission = ", ".join(f"{name} {value}" for name, value in self.admission.stats().items())
+        if self.metrics is None:
+            self.bot_api.send_message(chat_id, f"Метрики выключены, запусти бота с --metrics.\nadmission: {admission}")
+            return
+        self.bot_api.send_message(chat_id, f"{self.metrics.summary()}\nadmission: {admission}")
+
+    def _send_export(self, chat_id, format, since, until):
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = f"{tmp_dir}/scores.{format}"
+                with open(path, "w", newline="") as f:
+                    n_rows = export_scores(self.database, f, format, since=since, until=until)
+                with open(path, "rb") as document:
+                    self.bot_api.send_document(chat_id, document, caption=f"Оценок: {n_rows}")
+        except (ValueError, IndexError) as exception:
+            self.bot_api.send_message(chat_id, f"Не получилось выгрузить оценки: {exception}")
+
+    def on_export(self, message):
+        # /kon_export [csv|jsonl] [since] [until], dates in ISO format.
+        chat_id = message.chat.id
+        if chat_id not in self.admin_ids:
+            return
+        args = message.text.split()[1:]
+        format = args[0] if args else "csv"
+        if format not in EXPORT_FORMATS:
+            self.bot_api.send_message(chat_id, f"Формат выгрузки: {', '.join(EXPORT_FORMATS)}.")
+            return
+        since = args[1] if len(args) > 1 else None
+        until = args[2] if len(args) > 2 else None
+        # The export may take a while, the chat's dispatcher worker is not held for it.
+        threading.Thread(
+            target=self._send_export,
+            args=(chat_id, format, since, until),
+            name="export",
+            daemon=True,
+        ).start()
+
+    def _deliver_update_notification(self, chat_id, text):
+        self.outbound.set_my_commands(chat_id, [])
+        self.outbound.remove_reply_keyboard(chat_id, text)
+
+    def resume_broadcast(self):
+        # Continues a broadcast interrupted by a restart, if any.
+        return self.broadcaster.start()
+
     def notify_for_update(self, message):
+        # The broadcast is persistent and resumes after restarts, so only admins may start one.
+        if message.chat.id not in self.admin_ids:
+            return
         text = "Привет! У меня вышло новое обновление и я стал более удобным!\n" \
                "Обязательно нажми команду /start, чтобы я обновился.\n" \
                "P.S. Поделись ссылкой на меня со знакомыми."
-        for chat_id in self.database.get_all_users():
-            try:
-                chat_id = chat_id[0]
-                self.bot_api.set_my_commands([], telebot.types.BotCommandScopeChat(chat_id))
-                self.bot_api.send_message(chat_id, text, reply_markup=telebot.types.ReplyKeyboardRemove())
-            except:
-                with open("blacklist.txt", "a") as f:
-                    f.writelines([str(chat_id), ])
+        if self.broadcaster.start(text) is None:
+            self.bot_api.send_message(message.chat.id, "Рассылка уже идёт.")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Course cringe meter telegram bot")
     parser.add_argument("-t", "--api_token")
     parser.add_argument("-p", "--sqlite_db")
     parser.add_argument("-d", "--debug", action="store_true")
+    parser.add_argument("--storage", default="sqlite", choices=["sqlite", "memory"],
+                        help="Storage backend, \"memory\" keeps nothing after exit")
+    parser.add_argument("--sqlite_synchronous", default="NORMAL", choices=["OFF", "NORMAL", "FULL", "EXTRA"])
+    parser.add_argument("--sqlite_cache_size", type=int, default=-16000,
+                        help="SQLite page cache size: pages if positive, KiB if negative")
+    parser.add_argument("--sqlite_cached_statements", type=int, default=256,
+                        help="Prepared statements kept per SQLite connection")
+    parser.add_argument("--user_cache_size", type=int, default=4096,
+                        help="Number of user states kept in memory, 0 disables the cache")
+    parser.add_argument("--score_batch_size", type=int, default=0,
+                        help="Queue scores and commit them in batches of this size, 0 commits every score at once")
+    parser.add_argument("--score_flush_interval_ms", type=int, default=50)
+    parser.add_argument("--score_queue_size", type=int, default=10000)
+    parser.add_argument("--broadcast_rate", type=float, default=30.0,
+                        help="Global limit of Bot API calls per second during a broadcast")
+    parser.add_argument("--broadcast_workers", type=int, default=8)
+    parser.add_argument("--dispatch_workers", type=int, default=8,
+                        help="Workers handling updates, one chat is always handled by the same worker in order;"
+                             " 0 uses the telebot thread pool without per-chat ordering")
+    parser.add_argument("--dispatch_queue_size", type=int, default=100,
+                        help="Pending updates per worker before polling blocks")
+    parser.add_argument("--pending_updates", default="skip", choices=["skip", "catch_up"],
+                        help="Updates sent while the bot was down: dropped, or handled in bulk before polling starts."
+                             " In webhook mode catch_up keeps them for Telegram to deliver to the webhook")
+    parser.add_argument("--catch_up_batch_size", type=int, default=100, help="Updates per getUpdates call, at most 100")
+    parser.add_argument("--metrics", action="store_true", help="Collect handler, SQL and Bot API latency metrics")
+    parser.add_argument("--metrics_port", type=int, default=0,
+                        help="Serve metrics in Prometheus text format on 127.0.0.1:<port>/metrics, 0 disables")
+    parser.add_argument("--admin_ids", type=int, nargs="*", default=[],
+                        help="Chat ids allowed to use /kon_metrics, /kon_export and /kon_notify_users")
+    parser.add_argument("--retention_days", type=float, default=0,
+                        help="Delete raw scores older than this in the background, daily statistics are kept;"
+                             " 0 keeps raw scores forever")
+    parser.add_argument("--compaction_interval_s", type=float, default=3600)
+    parser.add_argument("--live_window_s", type=float, default=600,
+                        help="Window of the live cringe meter shown by /now and score confirmations")
+    parser.add_argument("--chat_rate", type=float, default=1.0,
+                        help="Updates per second a chat gets after its burst, more are dropped; 0 disables the limit")
+    parser.add_argument("--chat_burst", type=float, default=5.0, help="Updates a chat may send at once")
+    parser.add_argument("--score_coalesce_s", type=float, default=1.0,
+                        help="Scores of a chat within this many seconds are stored as one, the last one; 0 disables")
+    parser.add_argument("--reply_rate", type=float, default=25.0,
+                        help="Global limit of score confirmations per second, 0 disables the limit")
+    parser.add_argument("--mode", default="polling", choices=["polling", "webhook"],
+                        help="Long polling with threaded handlers or an asyncio webhook server")
+    parser.add_argument("--webhook_host", default="0.0.0.0")
+    parser.add_argument("--webhook_port", type=int, default=8080)
+    parser.add_argument("--webhook_path", default="/webhook")
+    parser.add_argument("--webhook_url", help="Public URL registered with Telegram, omit to keep the current one")
+    parser.add_argument("--webhook_secret", help="Expected X-Telegram-Bot-Api-Secret-Token header")
+    parser.add_argument("--db_workers", type=int, default=4,
+                        help="Threads running the handlers in webhook mode")
+    parser.add_argument("--bot_api_url", help="Bot API URL template for webhook mode, e.g. a local Bot API server")
+    subparsers = parser.add_subparsers(dest="command")
+    export_parser = subparsers.add_parser("export", help="Stream scores to CSV or JSON Lines and exit")
+    export_parser.add_argument("-o", "--output", help="Output file, stdout by default")
+    export_parser.add_argument("-f", "--format", default="csv", choices=EXPORT_FORMATS)
+    export_parser.add_argument("--university", help="University name")
+    export_parser.add_argument("--subject", help="Subject name")
+    export_parser.add_argument("--since", help="ISO date or datetime, inclusive")
+    export_parser.add_argument("--until", help="ISO date or datetime, exclusive")
+    export_parser.add_argument("--chunk_size", type=int, default=1000)
+    import_parser = subparsers.add_parser("import", help="Add universities, subjects and links from a file and exit")
+    import_parser.add_argument("path", help="CSV with a university,subject header or JSON {university: [subject]}")
+    import_parser.add_argument("-f", "--format", choices=CATALOG_FORMATS, help="By file extension by default")
+    compact_parser = subparsers.add_parser("compact", help="Delete old raw scores, reclaim space and exit")
+    compact_parser.add_argument("--retention_days", type=float, required=True)
+    compact_parser.add_argument("--batch_size", type=int, default=1000)
+    compact_parser.add_argument("--full_vacuum", action="store_true",
+                                help="Rewrite the file once to enable incremental vacuum on an older database")
     args = parser.parse_args()
-    bot = CringeMeterBot(args.api_token, args.sqlite_db, args.debug)
-    bot.bot_api.infinity_polling()
+    if args.command == "compact":
+        database = SQLiteDB(args.sqlite_db)
+        try:
+            deleted = database.compact_scores(int(time.time() - args.retention_days * 86400), args.batch_size)
+            freed_pages = database.incremental_vacuum(full=args.full_vacuum)
+        finally:
+            database.close()
+        print(f"Deleted {deleted} raw scores, freed {freed_pages} pages", file=sys.stderr)
+        sys.exit(0)
+    if args.command == "import":
+        format = args.format or ("json" if args.path.endswith(".json") else "csv")
+        database = SQLiteDB(args.sqlite_db)
+        try:
+            start = time.perf_counter()
+            with open(args.path, newline="") as f:
+                diff = import_catalog(database, f, format)
+            elapsed = time.perf_counter() - start
+        finally:
+            database.close()
+        if diff != ([], [], []):
+            print(format_catalog_diff(diff))
+        new_universities, new_subjects, new_university_subjects = diff
+        print(
+            f"Added {len(new_universities)} universities, {len(new_subjects)} subjects"
+            f" and {len(new_university_subjects)} links in {elapsed:.2f} s",
+            file=sys.stderr,
+        )
+        sys.exit(0)
+    if args.command == "export":
+        database = SQLiteDB(args.sqlite_db)
+        output = sys.stdout if args.output is None else open(args.output, "w", newline="")
+        try:
+            n_rows = export_scores(
+                database,
+                output,
+                args.format,
+                university=args.university,
+                subject=args.subject,
+                since=args.since,
+                until=args.until,
+                chunk_size=args.chunk_size,
+            )
+        finally:
+            if output is not sys.stdout:
+                output.close()
+            database.close()
+        print(f"Exported {n_rows} scores", file=sys.stderr)
+        sys.exit(0)
+    metrics = None
+    if args.metrics or args.metrics_port:
+        metrics = Metrics()
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+    options = dict(
+        metrics=metrics,
+        admin_ids=args.admin_ids,
+        retention_days=args.retention_days,
+        compaction_interval=args.compaction_interval_s,
+        storage=args.storage,
+        live_window=args.live_window_s,
+        chat_rate=args.chat_rate,
+        chat_burst=args.chat_burst,
+        score_coalesce_window=args.score_coalesce_s,
+        reply_rate=args.reply_rate,
+        broadcast_rate=args.broadcast_rate,
+        broadcast_workers=args.broadcast_workers,
+        synchronous=args.sqlite_synchronous,
+        cache_size=args.sqlite_cache_size,
+        cached_statements=args.sqlite_cached_statements,
+        user_cache_size=args.user_cache_size,
+        score_batch_size=args.score_batch_size,
+        score_flush_interval_ms=args.score_flush_interval_ms,
+        score_queue_size=args.score_queue_size,
+    )
+    if args.mode == "webhook":
+        # aiohttp is only needed by the webhook runtime.
+        from webhook import AsyncCringeMeterBot, run_webhook
+
+        bot = AsyncCringeMeterBot(
+            args.api_token,
+            args.sqlite_db,
+            args.debug,
+            db_workers=args.db_workers,
+            pending_updates=args.pending_updates,
+            **options,
+        )
+        run_webhook(
+            bot,
+            host=args.webhook_host,
+            port=args.webhook_port,
+            path=args.webhook_path,
+            webhook_url=args.webhook_url,
+            secret_token=args.webhook_secret,
+            api_url=args.bot_api_url,
+        )
+    else:
+        bot = CringeMeterBot(
+            args.api_token,
+            args.sqlite_db,
+            args.debug,
+            dispatch_workers=args.dispatch_workers,
+            dispatch_queue_size=args.dispatch_queue_size,
+            pending_updates=args.pending_updates,
+            **options,
+        )
+        if args.pending_updates == "catch_up":
+            n_updates, n_scores, seconds = bot.catch_up(args.catch_up_batch_size)
+            print(
+                f"Caught up on {n_updates} updates ({n_scores} scores) in {seconds:.1f} s,"
+                f" {n_updates / seconds if seconds else 0:.0f} updates/s",
+                file=sys.stderr,
+            )
+        # Stop polling on SIGTERM so that `shutdown` flushes queued scores.
+        signal.signal(signal.SIGTERM, lambda signum, frame: bot.bot_api.stop_polling())
+        bot.resume_broadcast()
+        try:
+            bot.bot_api.infinity_polling()
+        finally:
+            bot.shutdown()
@@ -0,0 +1,439 @@
+import bisect
+import itertools
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from cache import NameIndex
+from migrations import ALL_TIME_BUCKET, BUCKET_SECONDS
+from storage import ScoreAggregate, Storage, UserState
+
+__all__ = ["MemoryDB", ]
+
+
+def _id(value) -> Optional[int]:
+    # Ids may come as strings from callback data, like SQLite's INTEGER columns this stores them as ints.
+    return None if value is None else int(value)
+
+
+def _get_page(rows, after_id, before_id, limit):
+    # `rows` are (id, ...) tuples sorted by id.
+    ids = [row[0] for row in rows]
+    start = 0 if after_id is None else bisect.bisect_right(ids, int(after_id))
+    end = len(ids) if before_id is None else bisect.bisect_left(ids, int(before_id))
+    if before_id is not None:
+        return rows[max(start, end - limit):end]
+    return rows[start:min(end, start + limit)]
+
+
+class _Aggregate:
+    __slots__ = ("count", "sum", "sum_sq", "min", "max", "histogram")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.sum_sq = 0
+        self.min = None
+        self.max = None
+        self.histogram = [0] * 11
+
+    def add(self, score: int) -> None:
+        self.count += 1
+        self.sum += score
+        self.sum_sq += score * score
+        self.min = score if self.min is None else min(self.min, score)
+        self.max = score if self.max is None else max(self.max, score)
+        if 0 <= score <= 10:
+            self.histogram[score] += 1
+
+    def record(self, bucket: int) -> ScoreAggregate:
+        return ScoreAggregate(bucket, self.count, self.sum, self.sum_sq, self.min, self.max, *self.histogram)
+
+
+class MemoryDB(Storage):
+    # Process-local store with the same behaviour as `SQLiteDB`, for tests, benchmarks and throwaway runs.
+    # Everything lives in indexed dicts guarded by one lock and is lost on exit. Options that only make
+    # sense for SQLite are accepted and ignored, so both backends take the same configuration.
+    def __init__(self, **options):
+        self._lock = threading.RLock()
+        self._users: Dict[int, UserState] = {}
+        self._universities = NameIndex()
+        self._subjects = NameIndex()
+        self._university_subjects: Dict[int, List[int]] = {}
+        # Raw scores in insertion order as (id, user_id, university_id, subject_id, score, date).
+        self._scores: List[Tuple[int, int, int, int, int, int]] = []
+        self._score_ids = itertools.count(1)
+        self._aggregates: Dict[Tuple[int, int, int], _Aggregate] = {}
+        self._broadcasts: Dict[int, List] = {}
+        self._broadcast_recipients: Dict[int, Dict[int, int]] = {}
+        self._blocked_chats: Dict[int, Tuple[int, Optional[str]]] = {}
+        self._catalog_listeners = []
+        self._last_update_id = None
+
+    # PRIVATE METHODS
+    def _notify_catalog_change(self, table, university_id=None) -> None:
+        for listener in list(self._catalog_listeners):
+            listener(table, university_id)
+
+    def _update_user(self, user_id, **fields) -> None:
+        user_id = int(user_id)
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is not None:
+                self._users[user_id] = state._replace(**fields)
+
+    def _append_name(self, index: NameIndex, name: str) -> Tuple[int, bool]:
+        with self._lock:
+            id = index.name2id(name)
+            if id is not None:
+                return id, False
+            id = index.max_id + 1
+            index.add(id, name)
+            return id, True
+
+    def _link(self, university_id: int, subject_id: int) -> bool:
+        with self._lock:
+            subjects = self._university_subjects.setdefault(university_id, [])
+            if subject_id in subjects:
+                return False
+            bisect.insort(subjects, subject_id)
+            return True
+
+    @staticmethod
+    def _lookup(lookup, key):
+        value = lookup(key)
+        if value is None:
+            raise IndexError(f"Unknown catalog entry: {key}")
+        return value
+
+    # ____PUBLIC_METHODS____
+
+    def close(self) -> None:
+        pass
+
+    def add_catalog_listener(self, listener: Callable[[str, Optional[int]], None]) -> None:
+        self._catalog_listeners.append(listener)
+
+    def cache_stats(self) -> dict:
+        return {
+            "users": len(self._users),
+            "university_names": len(self._universities),
+            "subject_names": len(self._subjects),
+            "scores": len(self._scores),
+        }
+
+    # ___STATE_TRANSITIONS___
+    def begin_user_awaiting(self, user_id, status, response_message_id, request_message_id) -> None:
+        self._update_user(
+            user_id,
+            wait_for=int(status),
+            response_message_id=response_message_id,
+            request_message_id=request_message_id,
+        )
+
+    def clear_user_awaiting(self, user_id) -> None:
+        self._update_user(user_id, wait_for=0, response_message_id=None, request_message_id=None)
+
+    def register_and_select_university(self, user_id, university_name: str) -> int:
+        with self._lock:
+            university_id, inserted = self._append_name(self._universities, university_name)
+            self._update_user(user_id, university_id=university_id)
+        if inserted:
+            self._notify_catalog_change("university")
+        return university_id
+
+    def register_and_select_subject(self, user_id, subject_name: str) -> int:
+        # The subject is also linked to the university the user has selected.
+        with self._lock:
+            subject_id, _ = self._append_name(self._subjects, subject_name)
+            self._update_user(user_id, subject_id=subject_id)
+            state = self._users.get(int(user_id))
+            university_id = None if state is None else state.university_id
+            linked = university_id is not None and self._link(university_id, subject_id)
+        if linked:
+            self._notify_catalog_change("university_subject", university_id)
+        return subject_id
+
+    # ___GETTERS___
+    def get_all_users(self) -> List[Tuple[int]]:
+        with self._lock:
+            return [(user_id,) for user_id in self._users]
+
+    def get_all_universities(self) -> List[Tuple[int, str]]:
+        return self._universities.items()
+
+    def get_university_subjects(self, university_id: int = None) -> List[Tuple[int]]:
+        with self._lock:
+            return [(subject_id,) for subject_id in self._university_subjects.get(_id(university_id), [])]
+
+    def get_university_subject_names(self, university_id: int) -> List[Tuple[int, str]]:
+        with self._lock:
+            subject_ids = list(self._university_subjects.get(_id(university_id), []))
+        return [(subject_id, self._subjects.id2name(subject_id)) for subject_id in subject_ids]
+
+    def get_universities_page(
+            self,
+            after_id: int = None,
+            before_id: int = None,
+            limit: int = 10,
+    ) -> List[Tuple[int, str]]:
+        return _get_page(self._universities.items(), after_id, before_id, limit)
+
+    def get_university_subjects_page(
+            self,
+            university_id: int,
+            after_id: int = None,
+            before_id: int = None,
+            limit: int = 10,
+    ) -> List[Tuple[int, str]]:
+        return _get_page(self.get_university_subject_names(university_id), after_id, before_id, limit)
+
+    def find_university(self, university_name: str) -> Optional[int]:
+        return self._universities.find(university_name)
+
+    def find_subject(self, subject_name: str) -> Optional[int]:
+        return self._subjects.find(subject_name)
+
+    def search_universities(self, university_name: str, limit: int = 5) -> List[Tuple[int, str]]:
+        return self._universities.search(university_name, limit)
+
+    def search_subjects(self, subject_name: str, university_id: int = None, limit: int = 5) -> List[Tuple[int, str]]:
+        subject_ids = None
+        if university_id is not None:
+            with self._lock:
+                subject_ids = set(self._university_subjects.get(_id(university_id), []))
+        return self._subjects.search(subject_name, limit, subject_ids)
+
+    def get_score_aggregate(self, university_id: int, subject_id: int) -> Optional[ScoreAggregate]:
+        with self._lock:
+            aggregate = self._aggregates.get((_id(university_id), _id(subject_id), ALL_TIME_BUCKET))
+            return None if aggregate is None else aggregate.record(ALL_TIME_BUCKET)
+
+    def get_daily_score_aggregates(
+            self,
+            university_id: int,
+            subject_id: int,
+            days: int,
+            now: float = None,
+    ) -> List[ScoreAggregate]:
+        last_bucket = int(time.time() if now is None else now) // BUCKET_SECONDS
+        university_id, subject_id = _id(university_id), _id(subject_id)
+        result = []
+        with self._lock:
+            for bucket in range(last_bucket - days + 1, last_bucket + 1):
+                aggregate = self._aggregates.get((university_id, subject_id, bucket))
+                if aggregate is not None:
+                    result.append(aggregate.record(bucket))
+        return result
+
+    def iter_scores(
+            self,
+            university_id: int = None,
+            subject_id: int = None,
+            since: int = None,
+            until: int = None,
+            chunk_size: int = 1000,
+    ) -> Iterator[Tuple[int, int, str, str, int, int]]:
+        # Iterates over a snapshot taken at the first `next`.
+        university_id, subject_id = _id(university_id), _id(subject_id)
+        with self._lock:
+            scores = list(self._scores)
+        for id, user_id, score_university_id, score_subject_id, score, date in scores:
+            if university_id is not None and score_university_id != university_id:
+                continue
+            if subject_id is not None and score_subject_id != subject_id:
+                continue
+            if since is not None and (date is None or date < since):
+                continue
+            if until is not None and (date is None or date >= until):
+                continue
+            yield (
+                id,
+                user_id,
+                self._universities.id2name(score_university_id),
+                self._subjects.id2name(score_subject_id),
+                score,
+                date,
+            )
+
+    def get_recent_scores(self, since: int) -> List[Tuple[int, int, int, int]]:
+        with self._lock:
+            return [
+                (university_id, subject_id, score, date)
+                for _, _, university_id, subject_id, score, date in self._scores
+                if date is not None and date >= since and university_id is not None and subject_id is not None
+            ]
+
+    def get_user_current_state(self, user_id: int) -> UserState:
+        state = self._users.get(int(user_id))
+        if state is None:
+            raise IndexError(f"Unknown user: {user_id}")
+        return state
+
+    # ___APPENDERS___
+    def append_user(self, user_id: int) -> None:
+        with self._lock:
+            self._users.setdefault(int(user_id), UserState(0, None, None, None, None, 0))
+
+    def append_university(self, university_name: str) -> None:
+        _, inserted = self._append_name(self._universities, university_name)
+        if inserted:
+            self._notify_catalog_change("university")
+
+    def append_subject(self, subject_name: str) -> None:
+        self._append_name(self._subjects, subject_name)
+
+    def append_subject_to_university(self, university_id, subject_id) -> None:
+        if self._link(_id(university_id), _id(subject_id)):
+            self._notify_catalog_change("university_subject", _id(university_id))
+
+    def import_catalog(
+            self,
+            universities: Iterable[str],
+            subjects: Iterable[str],
+            university_subjects: Iterable[Tuple[str, str]],
+    ) -> Tuple[List[Tuple[int, str]], List[Tuple[int, str]], List[Tuple[str, str]]]:
+        university_subjects = list(university_subjects)
+        universities = [*universities, *(university for university, _ in university_subjects)]
+        subjects = [*subjects, *(subject for _, subject in university_subjects)]
+        new_universities, new_subjects, new_links = [], [], []
+        with self._lock:
+            for index, names, new_rows in [
+                (self._universities, universities, new_universities),
+                (self._subjects, subjects, new_subjects),
+            ]:
+                for name in names:
+                    id, inserted = self._append_name(index, name)
+                    if inserted:
+                        new_rows.append((id, name))
+            for university, subject in university_subjects:
+                university_id = self._universities.name2id(university)
+                if self._link(university_id, self._subjects.name2id(subject)):
+                    new_links.append((university_id, university, subject))
+        if new_universities:
+            self._notify_catalog_change("university")
+        for university_id in dict.fromkeys(university_id for university_id, _, _ in new_links):
+            self._notify_catalog_change("university_subject", university_id)
+        return new_universities, new_subjects, [(university, subject) for _, university, subject in new_links]
+
+    def append_score(self, user_id: int, university_id: int, subject_id: int, score: int, date: int) -> None:
+        self.append_scores([(user_id, university_id, subject_id, score, date)])
+
+    def append_scores(self, scores: List[Tuple[int, int, int, int, int]]) -> None:
+        with self._lock:
+            for user_id, university_id, subject_id, score, date in scores:
+                user_id, university_id, subject_id, date = _id(user_id), _id(university_id), _id(subject_id), _id(date)
+                score = int(score)
+                self._scores.append((next(self._score_ids), user_id, university_id, subject_id, score, date))
+                # Same rules as the `score_aggregate` triggers.
+                if university_id is None or subject_id is None:
+                    continue
+                buckets = [ALL_TIME_BUCKET] if date is None else [ALL_TIME_BUCKET, date // BUCKET_SECONDS]
+                for bucket in buckets:
+                    key = (university_id, subject_id, bucket)
+                    aggregate = self._aggregates.get(key)
+                    if aggregate is None:
+                        aggregate = self._aggregates[key] = _Aggregate()
+                    aggregate.add(score)
+
+    # ___SETTERS___
+    def set_ready_for_user(self, user_id) -> None:
+        self._update_user(user_id, ready=1)
+
+    def set_wait_for_user(self, user_id, status) -> None:
+        self._update_user(user_id, wait_for=int(status))
+
+    def set_request_message_id_for_user(self, user_id, request_message_id) -> None:
+        self._update_user(user_id, request_message_id=None if request_message_id is None else int(request_message_id))
+
+    def set_response_message_id_for_user(self, user_id, response_message_id) -> None:
+        self._update_user(
+            user_id,
+            response_message_id=None if response_message_id is None else int(response_message_id),
+        )
+
+    def set_university_for_user(self, user_id: int, university_id: int) -> None:
+        self._update_user(user_id, university_id=int(university_id))
+
+    def set_subject_for_user(self, user_id: int, subject_id: int) -> None:
+        self._update_user(user_id, subject_id=int(subject_id))
+
+    # ___COMPACTION___
+    def compact_scores(self, before: int, batch_size: int = 1000, pause: float = 0.01) -> int:
+        with self._lock:
+            kept = [
+                row for row in self._scores
+                if row[5] is None or row[5] >= before or row[2] is None or row[3] is None
+            ]
+            deleted = len(self._scores) - len(kept)
+            self._scores = kept
+        return deleted
+
+    def incremental_vacuum(self, pages: int = 0, full: bool = False) -> int:
+        return 0
+
+    # ___BROADCASTS___
+    def create_broadcast(self, text: str) -> int:
+        with self._lock:
+            broadcast_id = len(self._broadcasts) + 1
+            self._broadcasts[broadcast_id] = [text, int(time.time()), None]
+            self._broadcast_recipients[broadcast_id] = {
+                user_id: 0 for user_id in self._users if user_id not in self._blocked_chats
+            }
+        return broadcast_id
+
+    def get_unfinished_broadcast(self) -> Optional[Tuple[int, str]]:
+        with self._lock:
+            for broadcast_id, (text, _, finished) in sorted(self._broadcasts.items()):
+                if finished is None:
+                    return broadcast_id, text
+        return None
+
+    def get_pending_broadcast_recipients(self, broadcast_id: int) -> List[int]:
+        with self._lock:
+            return [
+                chat_id for chat_id, status in self._broadcast_recipients.get(broadcast_id, {}).items()
+                if status == 0 and chat_id not in self._blocked_chats
+            ]
+
+    def update_broadcast_recipients(self, progress: List[Tuple[int, int, int]]) -> None:
+        with self._lock:
+            for status, broadcast_id, chat_id in progress:
+                recipients = self._broadcast_recipients.get(broadcast_id)
+                if recipients is not None and chat_id in recipients:
+                    recipients[chat_id] = status
+
+    def finish_broadcast(self, broadcast_id: int) -> None:
+        with self._lock:
+            if broadcast_id in self._broadcasts:
+                self._broadcasts[broadcast_id][2] = int(time.time())
+
+    def block_chat(self, chat_id: int, reason: str = None) -> None:
+        with self._lock:
+            self._blocked_chats[chat_id] = (int(time.time()), reason)
+
+    def unblock_chat(self, chat_id: int) -> None:
+        with self._lock:
+            self._blocked_chats.pop(chat_id, None)
+
+    # ___UPDATE_OFFSET___
+    def get_last_update_id(self) -> Optional[int]:
+        return self._last_update_id
+
+    def save_update_offset(self, update_id: int, scores: List[Tuple[int, int, int, int, int]] = ()) -> None:
+        with self._lock:
+            self.append_scores(scores)
+            self._last_update_id = update_id
+
+    # ___CONVERTERS___
+    def id2subject(self, subject_id: int) -> str:
+        return self._lookup(self._subjects.id2name, int(subject_id))
+
+    def subject2id(self, subject_name: str) -> int:
+        return self._lookup(self._subjects.name2id, subject_name)
+
+    def id2university(self, university_id: int) -> str:
+        return self._lookup(self._universities.id2name, int(university_id))
+
+    def university2id(self, university_name: str) -> int:
+        return self._lookup(self._universities.name2id, university_name)
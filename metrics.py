@@ -0,0 +1,227 @@
+import bisect
+import functools
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Tuple
+
+__all__ = ["Metrics", "sql_template", ]
+
+# Latency histogram bounds in seconds.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# kind -> (metric name, label name, help)
+KINDS = {
+    "update": ("cringe_update_seconds", "type", "Time to handle one update, filters included"),
+    "handler": ("cringe_handler_seconds", "handler", "Handler and filter latency"),
+    "sql": ("cringe_sql_seconds", "statement", "SQLite statement latency by statement template"),
+    "api": ("cringe_api_seconds", "method", "Bot API request latency"),
+}
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\b-?\d+(?:\.\d+)?\b")
+_SQL_SPACES = re.compile(r"\s+")
+
+
+def sql_template(sql: str) -> str:
+    # Statements with values formatted into the text collapse into one label.
+    return _SQL_SPACES.sub(" ", _SQL_LITERALS.sub("?", sql)).strip()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+
+
+class Metrics:
+    # Latency histograms and error counters labelled by handler, SQL statement template and API method.
+    # Nothing is instrumented unless a `Metrics` instance is passed in, so disabled metrics cost nothing.
+    def __init__(self):
+        self._series: Dict[Tuple[str, str], _Histogram] = {}
+        # (metric name, help, label name, function returning counter values by label)
+        self._counters: List[Tuple[str, str, str, Callable[[], Dict[str, int]]]] = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    def observe(self, kind: str, label: str, seconds: float, error: bool = False) -> None:
+        with self._lock:
+            series = self._series.get((kind, label))
+            if series is None:
+                series = self._series[(kind, label)] = _Histogram()
+            series.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+            series.sum += seconds
+            series.count += 1
+            if error:
+                series.errors += 1
+
+    def add_counters(self, name: str, help: str, label_name: str, function: Callable[[], Dict[str, int]]) -> None:
+        # Counters kept elsewhere, read when metrics are rendered.
+        self._counters.append((name, help, label_name, function))
+
+    @contextmanager
+    def timer(self, kind: str, label: str) -> Iterator[None]:
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(kind, label, time.perf_counter() - start, error)
+
+    def wrap(self, kind: str, label: str, function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.timer(kind, label):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    def snapshot(self) -> List[Tuple[str, str, _Histogram]]:
+        with self._lock:
+            return [(kind, label, series) for (kind, label), series in sorted(self._series.items())]
+
+    def render(self) -> str:
+        # Prometheus text exposition format.
+        series_by_kind = {}
+        for kind, label, series in self.snapshot():
+            series_by_kind.setdefault(kind, []).append((label, series))
+        lines = []
+        for kind, (name, label_name, help) in KINDS.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            for label, series in series_by_kind.get(kind, []):
+                labels = f"{label_name}=\"{_escape(label)}\""
+                cumulative = 0
+                for bound, count in zip(BUCKETS, series.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{{{labels},le=\"{bound}\"}} {cumulative}")
+                lines.append(f"{name}_bucket{{{labels},le=\"+Inf\"}} {series.count}")
+                lines.append(f"{name}_sum{{{labels}}} {series.sum}")
+                lines.append(f"{name}_count{{{labels}}} {series.count}")
+            errors_name = name.replace("_seconds", "_errors_total")
+            lines.append(f"# HELP {errors_name} Failed calls")
+            lines.append(f"# TYPE {errors_name} counter")
+            for label, series in series_by_kind.get(kind, []):
+                lines.append(f"{errors_name}{{{label_name}=\"{_escape(label)}\"}} {series.errors}")
+        for name, help, label_name, function in self._counters:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} counter")
+            for label, value in function().items():
+                lines.append(f"{name}{{{label_name}=\"{_escape(label)}\"}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, limit: int = 20, label_length: int = 60) -> str:
+        # Short human-readable report ordered by total time, for chat.
+        rows = sorted(self.snapshot(), key=lambda row: row[2].sum, reverse=True)[:limit]
+        lines = []
+        for kind, label, series in rows:
+            if len(label) > label_length:
+                label = label[:label_length - 1] + "…"
+            lines.append(
+                f"{kind} {label}: {series.count} calls, {1000 * series.sum / series.count:.2f} ms avg,"
+                f" {series.sum:.2f} s total, {series.errors} errors"
+            )
+        return "\n".join(lines) if lines else "No metrics yet."
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> None:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def sqlite_connect(self, *args, **kwargs) -> sqlite3.Connection:
+        # `sqlite3.connect` returning a connection whose statements are timed, whichever cursor runs them.
+        with self.timer("sql", "<connect>"):
+            con = sqlite3.connect(*args, factory=_InstrumentedConnection, **kwargs)
+        con.metrics = self
+        return con
+
+    def instrument_bot_api(self) -> None:
+        # Every request of the synchronous telebot client goes through `apihelper._make_request`.
+        from telebot import apihelper
+
+        make_request = apihelper._make_request
+        if getattr(make_request, "__wrapped_by_metrics__", False):
+            return
+
+        @functools.wraps(make_request)
+        def timed_make_request(token, method_name, *args, **kwargs):
+            with self.timer("api", method_name):
+                return make_request(token, method_name, *args, **kwargs)
+
+        timed_make_request.__wrapped_by_metrics__ = True
+        apihelper._make_request = timed_make_request
+
+    def instrument_async_bot_api(self) -> None:
+        # Same for the asyncio client of webhook mode, whose requests go through `asyncio_helper._process_request`
+        # with the method name as `url`.
+        from telebot import asyncio_helper
+
+        process_request = asyncio_helper._process_request
+        if getattr(process_request, "__wrapped_by_metrics__", False):
+            return
+
+        @functools.wraps(process_request)
+        async def timed_process_request(token, url, *args, **kwargs):
+            with self.timer("api", url):
+                return await process_request(token, url, *args, **kwargs)
+
+        timed_process_request.__wrapped_by_metrics__ = True
+        asyncio_helper._process_request = timed_process_request
+
+
+class _InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        with self.connection.metrics.timer("sql", sql_template(sql)):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with self.connection.metrics.timer("sql", sql_template(sql)):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class _InstrumentedConnection(sqlite3.Connection):
+    metrics = None
+
+    def cursor(self, factory=_InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,224 @@
+import sqlite3
+from typing import Callable, List
+
+__all__ = ["ALL_TIME_BUCKET", "BUCKET_SECONDS", "MIGRATIONS", "SCHEMA_VERSION", "create_base_schema", "migrate", ]
+
+# `score_aggregate` keeps one row per day and one all-time row per university and subject.
+BUCKET_SECONDS = 86400
+ALL_TIME_BUCKET = -1
+
+_HISTOGRAM_COLUMNS = [f"h{score}" for score in range(11)]
+
+
+def create_base_schema(cur: sqlite3.Cursor) -> None:
+    # Schema of the first release, before migrations were tracked. Existing databases already have it.
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS user_activity ("
+        "   id INTEGER PRIMARY KEY,"
+        "   ready INTEGER DEFAULT 0,"
+        "   university_id INTEGER,"
+        "   subject_id INTEGER,"
+        "   response_message_id INTEGER,"
+        "   request_message_id INTEGER,"
+        "   wait_for INTEGER DEFAULT 0"
+        ")"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS subject ("
+        "   id INTEGER PRIMARY KEY,"
+        "   name TEXT NOT NULL UNIQUE"
+        ")"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS university ("
+        "   id INTEGER PRIMARY KEY,"
+        "   name TEXT NOT NULL UNIQUE"
+        ")"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS university_subject ("
+        "   id INTEGER PRIMARY KEY,"
+        "   university_id INTEGER NOT NULL,"
+        "   subject_id INTEGER NOT NULL,"
+        "   FOREIGN KEY (university_id) REFERENCES university(id),"
+        "   FOREIGN KEY (subject_id) REFERENCES subject(id),"
+        "   UNIQUE(university_id, subject_id)"
+        ")"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS score ("
+        "   id INTEGER PRIMARY KEY,"
+        "   user_id INTEGER,"
+        "   university_id INTEGER,"
+        "   subject_id INTEGER,"
+        "   score INTEGER NOT NULL,"
+        "   date FLOAT,"
+        "   FOREIGN KEY (user_id) REFERENCES user_activity(id),"
+        "   FOREIGN KEY (university_id) REFERENCES university(id),"
+        "   FOREIGN KEY (subject_id) REFERENCES subject(id)"
+        ")"
+    )
+
+
+def _v1_score_indexes_and_integer_date(cur: sqlite3.Cursor) -> None:
+    # `date` is a Telegram unix timestamp. SQLite cannot change a column type in place, so the table is rebuilt.
+    cur.execute(
+        "CREATE TABLE score_v1 ("
+        "   id INTEGER PRIMARY KEY,"
+        "   user_id INTEGER,"
+        "   university_id INTEGER,"
+        "   subject_id INTEGER,"
+        "   score INTEGER NOT NULL,"
+        "   date INTEGER,"
+        "   FOREIGN KEY (user_id) REFERENCES user_activity(id),"
+        "   FOREIGN KEY (university_id) REFERENCES university(id),"
+        "   FOREIGN KEY (subject_id) REFERENCES subject(id)"
+        ")"
+    )
+    cur.execute(
+        "INSERT INTO score_v1(id, user_id, university_id, subject_id, score, date)"
+        " SELECT id, user_id, university_id, subject_id, score,"
+        "   CASE WHEN typeof(date) IN ('integer', 'real') THEN CAST(date AS INTEGER) END"
+        " FROM score"
+    )
+    cur.execute("DROP TABLE score")
+    cur.execute("ALTER TABLE score_v1 RENAME TO score")
+    cur.execute("CREATE INDEX score_university_subject_date ON score(university_id, subject_id, date)")
+    cur.execute("CREATE INDEX score_user_date ON score(user_id, date)")
+    # Lookups by `university_id` are served by the UNIQUE(university_id, subject_id) index,
+    # this one covers the opposite direction.
+    cur.execute("CREATE INDEX university_subject_subject ON university_subject(subject_id, university_id)")
+
+
+def _aggregate_upsert(bucket: str) -> str:
+    histogram_values = ", ".join(f"NEW.score = {score}" for score in range(11))
+    histogram_updates = ", ".join(f"{column} = {column} + excluded.{column}" for column in _HISTOGRAM_COLUMNS)
+    return (
+        f"INSERT INTO score_aggregate(university_id, subject_id, bucket, count, sum, sum_sq, min, max,"
+        f" {', '.join(_HISTOGRAM_COLUMNS)})"
+        f" VALUES (NEW.university_id, NEW.subject_id, {bucket}, 1, NEW.score, NEW.score * NEW.score,"
+        f" NEW.score, NEW.score, {histogram_values})"
+        f" ON CONFLICT(university_id, subject_id, bucket) DO UPDATE SET"
+        f" count = count + 1, sum = sum + excluded.sum, sum_sq = sum_sq + excluded.sum_sq,"
+        f" min = MIN(min, excluded.min), max = MAX(max, excluded.max), {histogram_updates};"
+    )
+
+
+def _v2_score_aggregates(cur: sqlite3.Cursor) -> None:
+    # Maintained by a trigger, so both single inserts and group-committed batches keep it up to date.
+    cur.execute(
+        "CREATE TABLE score_aggregate ("
+        "   university_id INTEGER NOT NULL,"
+        "   subject_id INTEGER NOT NULL,"
+        "   bucket INTEGER NOT NULL,"
+        "   count INTEGER NOT NULL,"
+        "   sum INTEGER NOT NULL,"
+        "   sum_sq INTEGER NOT NULL,"
+        "   min INTEGER NOT NULL,"
+        "   max INTEGER NOT NULL,"
+        + "".join(f"   {column} INTEGER NOT NULL," for column in _HISTOGRAM_COLUMNS) +
+        "   PRIMARY KEY (university_id, subject_id, bucket)"
+        ") WITHOUT ROWID"
+    )
+    histogram_sums = ", ".join(f"SUM(score = {score})" for score in range(11))
+    for bucket, where, group_by in [
+        (str(ALL_TIME_BUCKET), "", ""),
+        (f"date / {BUCKET_SECONDS}", " AND date IS NOT NULL", f", date / {BUCKET_SECONDS}"),
+    ]:
+        cur.execute(
+            f"INSERT INTO score_aggregate"
+            f" SELECT university_id, subject_id, {bucket}, COUNT(*), SUM(score), SUM(score * score),"
+            f"   MIN(score), MAX(score), {histogram_sums}"
+            f" FROM score"
+            f" WHERE university_id IS NOT NULL AND subject_id IS NOT NULL{where}"
+            f" GROUP BY university_id, subject_id{group_by}"
+        )
+    cur.execute(
+        "CREATE TRIGGER score_aggregate_insert AFTER INSERT ON score"
+        " WHEN NEW.university_id IS NOT NULL AND NEW.subject_id IS NOT NULL"
+        " BEGIN "
+        + _aggregate_upsert(str(ALL_TIME_BUCKET)) +
+        " END"
+    )
+    cur.execute(
+        "CREATE TRIGGER score_aggregate_insert_bucket AFTER INSERT ON score"
+        " WHEN NEW.university_id IS NOT NULL AND NEW.subject_id IS NOT NULL AND NEW.date IS NOT NULL"
+        " BEGIN "
+        + _aggregate_upsert(f"NEW.date / {BUCKET_SECONDS}") +
+        " END"
+    )
+
+
+def _v3_broadcasts(cur: sqlite3.Cursor) -> None:
+    cur.execute(
+        "CREATE TABLE broadcast ("
+        "   id INTEGER PRIMARY KEY,"
+        "   text TEXT NOT NULL,"
+        "   created INTEGER NOT NULL,"
+        "   finished INTEGER"
+        ")"
+    )
+    # `status` values are `broadcast.RecipientStatus`.
+    cur.execute(
+        "CREATE TABLE broadcast_recipient ("
+        "   broadcast_id INTEGER NOT NULL,"
+        "   chat_id INTEGER NOT NULL,"
+        "   status INTEGER NOT NULL DEFAULT 0,"
+        "   FOREIGN KEY (broadcast_id) REFERENCES broadcast(id),"
+        "   PRIMARY KEY (broadcast_id, chat_id)"
+        ") WITHOUT ROWID"
+    )
+    cur.execute(
+        "CREATE TABLE blocked_chat ("
+        "   chat_id INTEGER PRIMARY KEY,"
+        "   date INTEGER NOT NULL,"
+        "   reason TEXT"
+        ")"
+    )
+
+
+def _v4_update_offset(cur: sqlite3.Cursor) -> None:
+    # Last update handled by the catch-up mode, a single row.
+    cur.execute(
+        "CREATE TABLE update_offset ("
+        "   id INTEGER PRIMARY KEY CHECK (id = 0),"
+        "   update_id INTEGER NOT NULL"
+        ")"
+    )
+
+
+# Applied in order, `PRAGMA user_version` is the number of migrations already applied. Never edit or reorder
+# released entries, append new ones instead.
+MIGRATIONS: List[Callable[[sqlite3.Cursor], None]] = [
+    _v1_score_indexes_and_integer_date,
+    _v2_score_aggregates,
+    _v3_broadcasts,
+    _v4_update_offset,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(con: sqlite3.Connection) -> int:
+    # Expects an autocommit connection. Every migration runs in its own transaction together with the
+    # version bump, so an interrupted upgrade resumes from the last applied migration.
+    while True:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # Read under the write lock, another process may have migrated in the meantime.
+            version = cur.execute("PRAGMA user_version").fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(f"Database schema version {version} is newer than supported {SCHEMA_VERSION}")
+            if version == SCHEMA_VERSION:
+                cur.execute("COMMIT")
+                return version
+            MIGRATIONS[version](cur)
+            cur.execute(f"PRAGMA user_version={version + 1}")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        else:
+            cur.execute("COMMIT")
+        finally:
+            cur.close()
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import queue
+import threading
+from typing import Dict, List
+
+import telebot
+from telebot import apihelper
+
+from cache import LRUCache
+
+__all__ = ["OutboundAPI", ]
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# `deleteMessages` accepts at most this many ids per call.
+MAX_DELETE_BATCH = 100
+
+
+def _digest(value: str) -> str:
+    return hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
+
+
+class OutboundAPI:
+    # Bot API calls that can be skipped or taken off the reply path:
+    # - deletions are queued and sent by a background thread, coalesced per chat into `deleteMessages`;
+    # - per-chat command lists and reply keyboards are remembered by hash and not pushed again unchanged.
+    # The remembered hashes live in memory only, so the first push after a restart always goes out.
+    def __init__(self, bot_api, cache_size: int = 4096, max_queue_size: int = 10000):
+        self.bot_api = bot_api
+        self.skipped = 0
+        self._commands = LRUCache(cache_size)
+        self._keyboards = LRUCache(cache_size)
+        self._deletions = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, name="outbound-deletes", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        # Sends the deletions that are still queued.
+        if self._thread.is_alive():
+            self._deletions.put(_STOP)
+            self._thread.join()
+
+    def delete_messages(self, chat_id: int, message_ids: List[int]) -> None:
+        # Fire and forget, failures (e.g. a message already deleted by the user) are only logged.
+        message_ids = [message_id for message_id in message_ids if message_id is not None]
+        if message_ids:
+            self._deletions.put((chat_id, message_ids))
+
+    def set_my_commands(self, chat_id: int, commands: List[telebot.types.BotCommand]) -> bool:
+        digest = _digest(repr([(command.command, command.description) for command in commands]))
+        if self._commands.get(chat_id) == digest:
+            self.skipped += 1
+            return False
+        self.bot_api.set_my_commands(commands, telebot.types.BotCommandScopeChat(chat_id))
+        self._commands.put(chat_id, digest)
+        return True
+
+    def send_reply_keyboard(self, chat_id: int, text: str, markup: telebot.types.ReplyKeyboardMarkup):
+        # Returns None when the chat already shows this keyboard.
+        digest = _digest(markup.to_json())
+        if self._keyboards.get(chat_id) == digest:
+            self.skipped += 1
+            return None
+        message = self.bot_api.send_message(chat_id, text=text, reply_markup=markup)
+        self._keyboards.put(chat_id, digest)
+        return message
+
+    def remove_reply_keyboard(self, chat_id: int, text: str):
+        message = self.bot_api.send_message(chat_id, text, reply_markup=telebot.types.ReplyKeyboardRemove())
+        self._keyboards.pop(chat_id)
+        return message
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._deletions.get()
+            batch = []
+            # Take whatever else is queued right now, so one chat's deletions go out in one call.
+            while item is not None:
+                if item is _STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+                try:
+                    item = self._deletions.get_nowait()
+                except queue.Empty:
+                    item = None
+            by_chat: Dict[int, List[int]] = {}
+            for chat_id, message_ids in batch:
+                by_chat.setdefault(chat_id, []).extend(message_ids)
+            for chat_id, message_ids in by_chat.items():
+                for i in range(0, len(message_ids), MAX_DELETE_BATCH):
+                    self._delete(chat_id, message_ids[i:i + MAX_DELETE_BATCH])
+
+    def _delete(self, chat_id: int, message_ids: List[int]) -> None:
+        try:
+            if len(message_ids) == 1:
+                self.bot_api.delete_message(chat_id, message_ids[0])
+            elif hasattr(self.bot_api, "delete_messages"):
+                self.bot_api.delete_messages(chat_id, message_ids)
+            else:
+                # The pinned pyTelegramBotAPI predates deleteMessages, so the request is made directly.
+                params = {"chat_id": chat_id, "message_ids": json.dumps(message_ids)}
+                apihelper._make_request(self.bot_api.token, "deleteMessages", params=params, method="post")
+        except Exception:
+            logger.exception(f"Failed to delete messages {message_ids} in chat {chat_id}")
@@ -0,0 +1,85 @@
+from typing import Any, Callable, Dict, Optional
+
+__all__ = ["Router", "extract_command", ]
+
+
+def extract_command(text: Optional[str]) -> Optional[str]:
+    # Same rule as `telebot.util.extract_command`: "/start@bot_name args" -> "start".
+    if text is None or not text.startswith("/"):
+        return None
+    return text.split()[0].split("@")[0][1:]
+
+
+class Router:
+    # Routing table equivalent to the telebot handler chain of `CringeMeterBot`, in its declaration order:
+    # commands, exact menu texts, the awaiting-input predicate, then the default text handler. Only text
+    # messages are routed, like telebot's default `content_types=["text"]`. Callback queries are looked up
+    # by the prefix before the first ":" of their data. Every lookup is a dict access, and the awaiting
+    # predicate is evaluated only for messages that are neither commands nor menu texts.
+    def __init__(self):
+        self.commands: Dict[str, Callable] = {}
+        self.texts: Dict[str, Callable] = {}
+        self.callback_prefixes: Dict[str, Callable] = {}
+        self.awaiting: Optional[Callable[[Any], bool]] = None
+        self.awaiting_handler: Optional[Callable] = None
+        self.default_handler: Optional[Callable] = None
+
+    def add_command(self, command: str, handler: Callable) -> None:
+        # The first registration wins, as with telebot handlers.
+        self.commands.setdefault(command, handler)
+
+    def add_text(self, text: str, handler: Callable) -> None:
+        self.texts.setdefault(text, handler)
+
+    def add_callback_prefix(self, prefix: str, handler: Callable) -> None:
+        self.callback_prefixes.setdefault(prefix, handler)
+
+    def set_awaiting(self, predicate: Callable[[Any], bool], handler: Callable) -> None:
+        self.awaiting = predicate
+        self.awaiting_handler = handler
+
+    def set_default(self, handler: Callable) -> None:
+        self.default_handler = handler
+
+    def route_message(self, message) -> Optional[Callable]:
+        if message.content_type != "text":
+            return None
+        command = extract_command(message.text)
+        if command is not None and command in self.commands:
+            return self.commands[command]
+        handler = self.texts.get(message.text)
+        if handler is not None:
+            return handler
+        if self.awaiting is not None and self.awaiting(message):
+            return self.awaiting_handler
+        return self.default_handler
+
+    def route_callback_query(self, callback_query) -> Optional[Callable]:
+        data = callback_query.data
+        if not data or ":" not in data:
+            return None
+        return self.callback_prefixes.get(data.split(":", 1)[0])
+
+    def dispatch(self, update) -> None:
+        if update.message is not None:
+            item, handler = update.message, self.route_message(update.message)
+        elif update.callback_query is not None:
+            item, handler = update.callback_query, self.route_callback_query(update.callback_query)
+        else:
+            return
+        if handler is not None:
+            handler(item)
+
+    def register(self, bot_api) -> None:
+        # Installs the same table as a telebot handler chain, for the threaded telebot runtime.
+        bot_api.callback_query_handler(func=lambda call: self.route_callback_query(call) is not None)(
+            lambda call: self.route_callback_query(call)(call),
+        )
+        for command, handler in self.commands.items():
+            bot_api.message_handler(commands=[command])(handler)
+        for text, handler in self.texts.items():
+            bot_api.message_handler(func=lambda message, text=text: message.text == text)(handler)
+        if self.awaiting is not None:
+            bot_api.message_handler(func=self.awaiting)(self.awaiting_handler)
+        if self.default_handler is not None:
+            bot_api.message_handler(content_types=["text"])(self.default_handler)
@@ -0,0 +1,112 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, List, Tuple
+
+__all__ = ["ScoreWriter", ]
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ScoreWriter:
+    # Write-behind queue: scores are flushed in one transaction every `batch_size` rows or
+    # `flush_interval` seconds, whichever comes first. A full queue blocks producers (backpressure).
+    # A batch that still fails after `max_retries` attempts is kept and written with the next flush, so while
+    # the database is failing the queue fills up and `put` raises instead of losing scores silently.
+    def __init__(
+            self,
+            flush: Callable[[List[Tuple]], None],
+            batch_size: int = 256,
+            flush_interval: float = 0.05,
+            max_queue_size: int = 10000,
+            put_timeout: float = 5.0,
+            max_retries: int = 3,
+    ):
+        self._flush = flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.flushed = 0
+        self.failed_flushes = 0
+        # Only scores still failing when the writer stops are dropped.
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        # Set by `stop`: a failing batch is no longer kept, so that a full queue cannot block stopping.
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="score-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, row: Tuple) -> None:
+        # Raises `queue.Full` if the writer cannot keep up for `put_timeout` seconds.
+        self._queue.put(row, timeout=self.put_timeout)
+
+    def stop(self) -> None:
+        if self._thread.is_alive():
+            self._stopping.set()
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "flushed": self.flushed,
+            "failed_flushes": self.failed_flushes,
+            "dropped": self.dropped,
+        }
+
+    def _run(self) -> None:
+        # Scores not written yet, kept across failed flushes.
+        batch = []
+        stopping = False
+        while not stopping:
+            if not batch:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                batch.append(item)
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            if self._write(batch):
+                batch = []
+            elif self._stopping.is_set():
+                break
+        # Drain whatever was queued behind the stop marker.
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+        if batch and not self._write(batch):
+            self.dropped += len(batch)
+            logger.error(f"Dropped {len(batch)} scores that could not be written before stopping")
+
+    def _write(self, batch: List[Tuple]) -> bool:
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self._flush(batch)
+            except Exception:
+                logger.exception(f"Failed to flush {len(batch)} scores (attempt {attempt}/{self.max_retries})")
+                time.sleep(self.flush_interval * attempt)
+            else:
+                self.flushed += len(batch)
+                return True
+        self.failed_flushes += 1
+        logger.error(f"Keeping {len(batch)} scores for the next flush")
+        return False
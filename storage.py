@@ -0,0 +1,310 @@
+import math
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+__all__ = ["ScoreAggregate", "Storage", "UserState", ]
+
+
+class UserState:
+    __slots__ = ("ready", "university_id", "subject_id", "response_message_id", "request_message_id", "wait_for")
+
+    def __init__(self, ready, university_id, subject_id, response_message_id, request_message_id, wait_for):
+        self.ready = ready
+        self.university_id = university_id
+        self.subject_id = subject_id
+        self.response_message_id = response_message_id
+        self.request_message_id = request_message_id
+        self.wait_for = wait_for
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"UserState({fields})"
+
+    def __eq__(self, other):
+        if not isinstance(other, UserState):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def _replace(self, **fields) -> "UserState":
+        # Cached states are shared between callers, so they are replaced instead of mutated.
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(fields)
+        return UserState(**values)
+
+
+class ScoreAggregate:
+    __slots__ = ("bucket", "count", "sum", "sum_sq", "min", "max", "histogram")
+
+    def __init__(self, bucket, count, sum, sum_sq, min, max, *histogram):
+        self.bucket = bucket
+        self.count = count
+        self.sum = sum
+        self.sum_sq = sum_sq
+        self.min = min
+        self.max = max
+        self.histogram = histogram
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"ScoreAggregate({fields})"
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(max(self.sum_sq / self.count - self.mean ** 2, 0.0))
+
+
+class Storage(ABC):
+    # Everything `CringeMeterBot` and its helpers need from a store. Ids passed in may be strings taken from
+    # callback data. Catalog listeners are called as `listener(table, university_id)` after a university
+    # ("university") or a university-subject link ("university_subject") is actually inserted.
+
+    @abstractmethod
+    def close(self) -> None:
+        ...
+
+    @abstractmethod
+    def add_catalog_listener(self, listener: Callable[[str, Optional[int]], None]) -> None:
+        ...
+
+    @abstractmethod
+    def cache_stats(self) -> dict:
+        ...
+
+    # ___STATE_TRANSITIONS___
+    @abstractmethod
+    def begin_user_awaiting(self, user_id, status, response_message_id, request_message_id) -> None:
+        ...
+
+    @abstractmethod
+    def clear_user_awaiting(self, user_id) -> None:
+        ...
+
+    @abstractmethod
+    def register_and_select_university(self, user_id, university_name: str) -> int:
+        ...
+
+    @abstractmethod
+    def register_and_select_subject(self, user_id, subject_name: str) -> int:
+        ...
+
+    # ___GETTERS___
+    @abstractmethod
+    def get_all_users(self) -> List[Tuple[int]]:
+        ...
+
+    @abstractmethod
+    def get_all_universities(self) -> List[Tuple[int, str]]:
+        ...
+
+    @abstractmethod
+    def get_university_subjects(self, university_id: int = None) -> List[Tuple[int]]:
+        ...
+
+    @abstractmethod
+    def get_university_subject_names(self, university_id: int) -> List[Tuple[int, str]]:
+        ...
+
+    # Keyset pages ordered by id: the first `limit` entries after `after_id`, or the last `limit` before
+    # `before_id`, still in ascending order.
+    @abstractmethod
+    def get_universities_page(
+            self,
+            after_id: int = None,
+            before_id: int = None,
+            limit: int = 10,
+    ) -> List[Tuple[int, str]]:
+        ...
+
+    @abstractmethod
+    def get_university_subjects_page(
+            self,
+            university_id: int,
+            after_id: int = None,
+            before_id: int = None,
+            limit: int = 10,
+    ) -> List[Tuple[int, str]]:
+        ...
+
+    # Lookups ignoring case, "ё" and punctuation, see `cache.normalize_name`.
+    @abstractmethod
+    def find_university(self, university_name: str) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    def find_subject(self, subject_name: str) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    def search_universities(self, university_name: str, limit: int = 5) -> List[Tuple[int, str]]:
+        ...
+
+    @abstractmethod
+    def search_subjects(self, subject_name: str, university_id: int = None, limit: int = 5) -> List[Tuple[int, str]]:
+        ...
+
+    @abstractmethod
+    def get_score_aggregate(self, university_id: int, subject_id: int) -> Optional[ScoreAggregate]:
+        ...
+
+    @abstractmethod
+    def get_daily_score_aggregates(
+            self,
+            university_id: int,
+            subject_id: int,
+            days: int,
+            now: float = None,
+    ) -> List[ScoreAggregate]:
+        ...
+
+    @abstractmethod
+    def iter_scores(
+            self,
+            university_id: int = None,
+            subject_id: int = None,
+            since: int = None,
+            until: int = None,
+            chunk_size: int = 1000,
+    ) -> Iterator[Tuple[int, int, str, str, int, int]]:
+        ...
+
+    @abstractmethod
+    def get_recent_scores(self, since: int) -> List[Tuple[int, int, int, int]]:
+        # (university_id, subject_id, score, date) rows dated at or after `since`, oldest first. Scores without
+        # university or subject are left out.
+        ...
+
+    @abstractmethod
+    def get_user_current_state(self, user_id: int) -> UserState:
+        # Raises IndexError for an unknown user.
+        ...
+
+    # ___APPENDERS___
+    @abstractmethod
+    def append_user(self, user_id: int) -> None:
+        ...
+
+    @abstractmethod
+    def append_university(self, university_name: str) -> None:
+        ...
+
+    @abstractmethod
+    def append_subject(self, subject_name: str) -> None:
+        ...
+
+    @abstractmethod
+    def append_subject_to_university(self, university_id, subject_id) -> None:
+        ...
+
+    @abstractmethod
+    def import_catalog(
+            self,
+            universities: Iterable[str],
+            subjects: Iterable[str],
+            university_subjects: Iterable[Tuple[str, str]],
+    ) -> Tuple[List[Tuple[int, str]], List[Tuple[int, str]], List[Tuple[str, str]]]:
+        # Inserts the missing names and (university name, subject name) links at once, names used by links
+        # included. Returns what was actually inserted: (id, name) universities, (id, name) subjects and links.
+        ...
+
+    @abstractmethod
+    def append_score(self, user_id: int, university_id: int, subject_id: int, score: int, date: int) -> None:
+        ...
+
+    @abstractmethod
+    def append_scores(self, scores: List[Tuple[int, int, int, int, int]]) -> None:
+        ...
+
+    # ___SETTERS___
+    @abstractmethod
+    def set_ready_for_user(self, user_id) -> None:
+        ...
+
+    @abstractmethod
+    def set_wait_for_user(self, user_id, status) -> None:
+        ...
+
+    @abstractmethod
+    def set_request_message_id_for_user(self, user_id, request_message_id) -> None:
+        ...
+
+    @abstractmethod
+    def set_response_message_id_for_user(self, user_id, response_message_id) -> None:
+        ...
+
+    @abstractmethod
+    def set_university_for_user(self, user_id: int, university_id: int) -> None:
+        ...
+
+    @abstractmethod
+    def set_subject_for_user(self, user_id: int, subject_id: int) -> None:
+        ...
+
+    # ___COMPACTION___
+    @abstractmethod
+    def compact_scores(self, before: int, batch_size: int = 1000, pause: float = 0.01) -> int:
+        ...
+
+    @abstractmethod
+    def incremental_vacuum(self, pages: int = 0, full: bool = False) -> int:
+        ...
+
+    # ___BROADCASTS___
+    @abstractmethod
+    def create_broadcast(self, text: str) -> int:
+        ...
+
+    @abstractmethod
+    def get_unfinished_broadcast(self) -> Optional[Tuple[int, str]]:
+        ...
+
+    @abstractmethod
+    def get_pending_broadcast_recipients(self, broadcast_id: int) -> List[int]:
+        ...
+
+    @abstractmethod
+    def update_broadcast_recipients(self, progress: List[Tuple[int, int, int]]) -> None:
+        ...
+
+    @abstractmethod
+    def finish_broadcast(self, broadcast_id: int) -> None:
+        ...
+
+    @abstractmethod
+    def block_chat(self, chat_id: int, reason: str = None) -> None:
+        ...
+
+    @abstractmethod
+    def unblock_chat(self, chat_id: int) -> None:
+        ...
+
+    # ___UPDATE_OFFSET___
+    @abstractmethod
+    def get_last_update_id(self) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    def save_update_offset(self, update_id: int, scores: List[Tuple[int, int, int, int, int]] = ()) -> None:
+        # Stores `update_id` as the last handled update, in one transaction with the scores of the updates up to it.
+        ...
+
+    # ___CONVERTERS___
+    # Raise IndexError for unknown entries.
+    @abstractmethod
+    def id2subject(self, subject_id: int) -> str:
+        ...
+
+    @abstractmethod
+    def subject2id(self, subject_name: str) -> int:
+        ...
+
+    @abstractmethod
+    def id2university(self, university_id: int) -> str:
+        ...
+
+    @abstractmethod
+    def university2id(self, university_name: str) -> int:
+        ...
@@ -0,0 +1,165 @@
+import itertools
+import threading
+import time
+
+import telebot
+
+METHODS = (
+    "send_message",
+    "send_document",
+    "delete_message",
+    "delete_messages",
+    "set_my_commands",
+    "answer_callback_query",
+    "edit_message_reply_markup",
+)
+
+
+class FakeApiError(Exception):
+    # Same attributes as `telebot.apihelper.ApiTelegramException`.
+    def __init__(self, error_code, description, retry_after=None):
+        super().__init__(f"Error code: {error_code}. Description: {description}")
+        self.error_code = error_code
+        self.description = description
+        self.result_json = {"ok": False, "error_code": error_code, "description": description}
+        if retry_after is not None:
+            self.result_json["parameters"] = {"retry_after": retry_after}
+
+
+class FakeBotAPI:
+    # Records the Bot API calls of `CringeMeterBot` instead of making them. `fail(method, chat_id, error)` makes
+    # the next calls of `method` for `chat_id` raise `error`.
+    def __init__(self):
+        self.calls = []
+        self._failures = {}
+        self._message_ids = itertools.count(1_000_000)
+        self._lock = threading.Lock()
+
+    def install(self, bot_api):
+        for method in METHODS:
+            setattr(bot_api, method, getattr(self, method))
+        # `TeleBot.user` is a cached getMe, used by `polling`.
+        bot_api._user = telebot.types.User(id=1, is_bot=True, first_name="Cringe meter", username="cringe_meter_bot")
+        return self
+
+    def fail(self, method, chat_id, *errors):
+        self._failures.setdefault((method, chat_id), []).extend(errors)
+
+    def _call(self, method, chat_id, **params):
+        with self._lock:
+            failures = self._failures.get((method, chat_id))
+            if failures:
+                raise failures.pop(0)
+            self.calls.append((method, chat_id, params))
+
+    def _message(self, chat_id, text):
+        message_id = next(self._message_ids)
+        return telebot.types.Message.de_json({
+            "message_id": message_id,
+            "chat": {"id": chat_id, "type": "private"},
+            "date": int(time.time()),
+            "text": text,
+        })
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        self._call("send_message", chat_id, text=text, reply_markup=kwargs.get("reply_markup"))
+        return self._message(chat_id, text)
+
+    def send_document(self, chat_id, document, *args, **kwargs):
+        self._call("send_document", chat_id, content=document.read(), caption=kwargs.get("caption"))
+        return self._message(chat_id, "")
+
+    def delete_message(self, chat_id, message_id, *args, **kwargs):
+        self._call("delete_message", chat_id, message_id=message_id)
+        return True
+
+    def delete_messages(self, chat_id, message_ids, *args, **kwargs):
+        self._call("delete_messages", chat_id, message_ids=list(message_ids))
+        return True
+
+    def set_my_commands(self, commands, scope=None, *args, **kwargs):
+        chat_id = None if scope is None else scope.chat_id
+        self._call("set_my_commands", chat_id, commands=[command.command for command in commands])
+        return True
+
+    def answer_callback_query(self, callback_query_id, text=None, *args, **kwargs):
+        self._call("answer_callback_query", None, callback_query_id=callback_query_id, text=text)
+        return True
+
+    def edit_message_reply_markup(self, chat_id, message_id=None, *args, **kwargs):
+        reply_markup = kwargs.get("reply_markup")
+        self._call("edit_message_reply_markup", chat_id, message_id=message_id, reply_markup=reply_markup)
+        return True
+
+    def sent(self, chat_id=None):
+        # Texts of the messages sent, to `chat_id` only if given.
+        return [
+            params["text"] for method, call_chat_id, params in self.calls
+            if method == "send_message" and (chat_id is None or call_chat_id == chat_id)
+        ]
+
+
+class Updates:
+    # Builds `telebot.types.Update` objects with increasing update and message ids.
+    def __init__(self, first_update_id=1):
+        self._update_ids = itertools.count(first_update_id)
+        self._message_ids = itertools.count(1)
+
+    def message_json(self, chat_id, text=None, content=None):
+        message = {
+            "message_id": next(self._message_ids),
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "chat": {"id": chat_id, "type": "private"},
+            "date": int(time.time()),
+        }
+        if text is not None:
+            message["text"] = text
+        if content is not None:
+            message.update(content)
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback_json(self, chat_id, data, message_id=None):
+        message = self.message_json(chat_id, "menu")["message"]
+        if message_id is not None:
+            message["message_id"] = message_id
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._message_ids)),
+                "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": message,
+            },
+        }
+
+    def message(self, chat_id, text=None, content=None):
+        return telebot.types.Update.de_json(self.message_json(chat_id, text, content))
+
+    def callback(self, chat_id, data, message_id=None):
+        return telebot.types.Update.de_json(self.callback_json(chat_id, data, message_id))
+
+
+# Admission control off: tests count every reply and row.
+NO_ADMISSION = dict(chat_rate=0, score_coalesce_window=0, reply_rate=0)
+
+
+def make_bot(tmp_path, dispatch_workers=0, **options):
+    # `CringeMeterBot` with the demo catalog (ИТМО, ЛЭТИ, СПБГУ) and a `FakeBotAPI` in place of the network.
+    from main import CringeMeterBot
+
+    options = {**NO_ADMISSION, **options}
+    path = str(tmp_path / "bot.sqlite")
+    bot = CringeMeterBot("0:test", path, debug=True, dispatch_workers=dispatch_workers, **options)
+    bot.fake_api = FakeBotAPI().install(bot.bot_api)
+    return bot
+
+
+def onboard(bot, updates, chat_id, university_id=1, subject_id=1):
+    # /start and both menu choices, through the handlers.
+    bot._process_update(updates.message(chat_id, "/start"))
+    state = bot.database.get_user_current_state(chat_id)
+    bot._process_update(updates.callback(chat_id, f"university_id:{university_id}", state.response_message_id))
+    state = bot.database.get_user_current_state(chat_id)
+    bot._process_update(updates.callback(chat_id, f"subject_id:{subject_id}", state.response_message_id))
+    assert bot.database.get_user_current_state(chat_id).ready == 1
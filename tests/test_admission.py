@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+import time
+
+from admission import Admission
+from tests.fakes import Updates, make_bot, onboard
+
+WINDOW = 0.2
+
+
+def _scores(path):
+    con = sqlite3.connect(path)
+    try:
+        return [score for _, score in con.execute("SELECT user_id, score FROM score ORDER BY id")]
+    finally:
+        con.close()
+
+
+def test_chat_rate_drops_updates_over_the_burst():
+    admission = Admission(lambda chat_id: None, chat_rate=1.0, chat_burst=2.0, coalesce_window=0)
+    assert [admission.admit(1) for _ in range(3)] == [True, True, False]
+    assert admission.admit(2)
+    assert admission.stats()["dropped"] == 1
+
+
+def test_dropped_callback_queries_are_answered(tmp_path):
+    bot = make_bot(tmp_path, chat_rate=0.01, chat_burst=2.0)
+    updates = Updates()
+    try:
+        bot._process_update(updates.message(1, "/start"))
+        menu_id = bot.database.get_user_current_state(1).response_message_id
+        bot._process_update(updates.callback(1, "university_id:1", menu_id))
+        pressed = updates.callback(1, "subject_id:1", menu_id)
+        bot._process_update(pressed)
+        answers = [params for method, _, params in bot.fake_api.calls if method == "answer_callback_query"]
+        # The dropped press is answered without a text and does nothing else.
+        assert answers[-1] == dict(callback_query_id=pressed.callback_query.id, text=None)
+        assert bot.admission.stats()["dropped"] == 1
+        assert bot.database.get_user_current_state(1).subject_id is None
+    finally:
+        bot.shutdown()
+
+
+def test_scores_within_the_window_are_held_and_coalesced():
+    due = []
+    admission = Admission(due.append, chat_rate=0, coalesce_window=WINDOW)
+    try:
+        assert not admission.hold_score(1, ("row", 5))
+        assert admission.hold_score(1, ("row", 6))
+        assert admission.hold_score(1, ("row", 7))
+        assert not admission.hold_score(2, ("row", 1))
+        deadline = time.monotonic() + 5
+        while not due and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # The held score stays until the owner takes it.
+        assert due == [1]
+        assert admission.take_held(1) == (("row", 7), 2)
+        assert admission.take_held(1) is None
+        admission.join()
+        assert admission.stats()["coalesced"] == 1
+        # The taken score started a new window.
+        assert admission.hold_score(1, ("row", 8))
+    finally:
+        admission.stop()
+    assert due == [1, 1]
+    # Until it is taken, the held score still takes the chat's next ones; nothing is held anew after stopping.
+    assert admission.hold_score(1, ("row", 9))
+    assert admission.take_held(1) == (("row", 9), 2)
+    assert not admission.hold_score(1, ("row", 10))
+
+
+def test_held_score_is_stored_in_the_chats_turn(tmp_path):
+    bot = make_bot(tmp_path, dispatch_workers=2, score_coalesce_window=WINDOW)
+    updates = Updates()
+    stored_by = []
+    append_score = bot.database.append_score
+
+    def recording_append_score(*row):
+        stored_by.append(threading.current_thread().name)
+        append_score(*row)
+
+    bot.database.append_score = recording_append_score
+    try:
+        onboard(bot, updates, 1)
+        for score in ("5", "6", "7"):
+            bot.dispatcher.submit(updates.message(1, score))
+        bot.dispatcher.join()
+        bot.admission.join()
+        bot.dispatcher.join()
+        assert _scores(bot.db_path) == [5, 7]
+        assert all(name.startswith("dispatcher-") for name in stored_by)
+        replies = [text.split("\n")[0] for text in bot.fake_api.sent(1)[-2:]]
+        assert replies == ["Записал 5 для ArchNN в ИТМО", "Записал 7 для ArchNN в ИТМО (последнюю из 2 оценок подряд)"]
+    finally:
+        bot.shutdown()
+
+
+def test_held_score_goes_in_before_the_next_update(tmp_path):
+    bot = make_bot(tmp_path, dispatch_workers=2, score_coalesce_window=60)
+    updates = Updates()
+    try:
+        onboard(bot, updates, 1)
+        for text in ("5", "6", "/stats"):
+            bot.dispatcher.submit(updates.message(1, text))
+        bot.dispatcher.join()
+        assert _scores(bot.db_path) == [5, 6]
+        replies = bot.fake_api.sent(1)[-3:]
+        expected = [f"Записал {score} для ArchNN в ИТМО" for score in (5, 6)]
+        assert [reply.split("\n")[0] for reply in replies[:2]] == expected
+        assert replies[2] == bot._build_stats_text(bot.database.get_user_current_state(1))
+    finally:
+        bot.shutdown()
+
+
+def test_shutdown_stores_held_scores(tmp_path):
+    bot = make_bot(tmp_path, dispatch_workers=2, score_coalesce_window=60)
+    updates = Updates()
+    onboard(bot, updates, 1)
+    for score in ("5", "6", "7"):
+        bot.dispatcher.submit(updates.message(1, score))
+    bot.dispatcher.join()
+    bot.shutdown()
+    assert _scores(bot.db_path) == [5, 7]
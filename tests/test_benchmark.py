@@ -0,0 +1,14 @@
+from benchmark import bench_replay
+
+
+def test_replay_counts_one_statement_per_score():
+    # A score is one INSERT, the aggregate triggers it fires are not statements of their own.
+    results = bench_replay(n_chats=5, n_scores=4, dispatch_workers=2)
+    assert results["phases"]["scores"]["updates"] == 20
+    assert results["phases"]["scores"]["sql_statements_per_update"] == 1.0
+    assert results["phases"]["onboarding"]["sql_statements_per_update"] > 1.0
+
+
+def test_replay_with_the_memory_backend_runs_no_sql():
+    results = bench_replay(n_chats=5, n_scores=4, dispatch_workers=2, storage="memory")
+    assert results["phases"]["scores"]["sql_statements_per_update"] == 0.0
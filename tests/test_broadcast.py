@@ -0,0 +1,130 @@
+import threading
+import time
+
+import pytest
+
+from broadcast import Broadcaster
+from database_handler import SQLiteDB
+from tests.fakes import FakeApiError, FakeBotAPI, Updates, make_bot, onboard
+
+TEXT = "Новая версия"
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = SQLiteDB(str(tmp_path / "db.sqlite"))
+    for chat_id in range(1, 7):
+        database.append_user(chat_id)
+    yield database
+    database.close()
+
+
+def _broadcaster(database, api, **options):
+    def deliver(chat_id, text):
+        api.send_message(chat_id, text)
+
+    return Broadcaster(database, deliver, **{"rate": 1000.0, "max_workers": 2, **options})
+
+
+def test_broadcast_reaches_everybody_once(database):
+    api = FakeBotAPI()
+    result = _broadcaster(database, api).run(TEXT)
+    assert result["sent"] == 6 and result["pending"] == 0
+    assert sorted(chat_id for _, chat_id, _ in api.calls) == list(range(1, 7))
+    assert database.get_unfinished_broadcast() is None
+
+
+def test_blocked_chats_are_recorded_and_skipped_later(database):
+    api = FakeBotAPI()
+    api.fail("send_message", 2, FakeApiError(403, "Forbidden: bot was blocked by the user"))
+    api.fail("send_message", 3, FakeApiError(400, "Bad Request: chat not found"))
+    result = _broadcaster(database, api).run(TEXT)
+    assert (result["sent"], result["blocked"]) == (4, 2)
+    api.calls.clear()
+    result = _broadcaster(database, api).run("Ещё одна")
+    assert result["sent"] == 4
+    assert sorted(chat_id for _, chat_id, _ in api.calls) == [1, 4, 5, 6]
+    # Writing to the bot again lifts the block.
+    database.unblock_chat(2)
+    broadcast_id = database.create_broadcast("Третья")
+    assert 2 in database.get_pending_broadcast_recipients(broadcast_id)
+
+
+def test_flood_limit_pauses_everybody_and_retries(database):
+    api = FakeBotAPI()
+    api.fail("send_message", 4, FakeApiError(429, "Too Many Requests: retry after 1", retry_after=0.3))
+    start = time.monotonic()
+    result = _broadcaster(database, api, max_retries=1).run(TEXT)
+    # The 429 is not a failed attempt even with a single retry allowed.
+    assert (result["sent"], result["failed"]) == (6, 0)
+    assert time.monotonic() - start >= 0.3
+
+
+def test_failures_are_retried_then_given_up(database):
+    api = FakeBotAPI()
+    api.fail("send_message", 5, FakeApiError(500, "Internal Server Error"))
+    api.fail("send_message", 6, *[FakeApiError(500, "Internal Server Error")] * 3)
+    result = _broadcaster(database, api, max_retries=3).run(TEXT)
+    assert (result["sent"], result["failed"]) == (5, 1)
+
+
+def test_interrupted_broadcast_resumes_where_it_stopped(tmp_path, database):
+    api = FakeBotAPI()
+    broadcaster = None
+
+    def deliver(chat_id, text):
+        api.send_message(chat_id, text)
+        if len(api.calls) == 3:
+            # Shutdown in the middle of the broadcast.
+            broadcaster._stopping.set()
+
+    broadcaster = Broadcaster(database, deliver, rate=1000.0, max_workers=1)
+    result = broadcaster.run(TEXT)
+    assert (result["sent"], result["pending"]) == (3, 3)
+    first = [chat_id for _, chat_id, _ in api.calls]
+    # A restart: new process state, same database file.
+    database.close()
+    reopened = SQLiteDB(str(tmp_path / "db.sqlite"))
+    try:
+        api.calls.clear()
+        result = _broadcaster(reopened, api).run()
+        assert (result["sent"], result["pending"]) == (3, 0)
+        second = [chat_id for _, chat_id, _ in api.calls]
+        assert sorted(first + second) == list(range(1, 7))
+        assert reopened.get_unfinished_broadcast() is None
+    finally:
+        reopened.close()
+
+
+def test_only_one_broadcast_runs_at_a_time(database):
+    api = FakeBotAPI()
+    release = threading.Event()
+
+    def deliver(chat_id, text):
+        release.wait()
+        api.send_message(chat_id, text)
+
+    broadcaster = Broadcaster(database, deliver, rate=1000.0)
+    assert broadcaster.start(TEXT) is not None
+    time.sleep(0.05)
+    assert broadcaster.start(TEXT) is None
+    release.set()
+    broadcaster.stop()
+    assert len(api.calls) == 6
+
+
+def test_notify_command_is_admin_only(tmp_path):
+    bot = make_bot(tmp_path, admin_ids=[1])
+    updates = Updates()
+    try:
+        onboard(bot, updates, 1)
+        onboard(bot, updates, 2)
+        bot._process_update(updates.message(2, "/kon_notify_users"))
+        assert bot.broadcaster._thread is None
+        assert bot.database.get_unfinished_broadcast() is None
+        bot._process_update(updates.message(1, "/kon_notify_users"))
+        bot.broadcaster._thread.join()
+        assert bot.database.get_unfinished_broadcast() is None
+        assert any(text.startswith("Привет! У меня вышло") for text in bot.fake_api.sent(2))
+    finally:
+        bot.shutdown()
@@ -0,0 +1,28 @@
+import io
+
+import pytest
+
+from catalog import read_catalog
+
+
+def test_json_catalog():
+    f = io.StringIO('{"ИТМО": ["ArchNN", "BigData"], "ЛЭТИ": []}')
+    assert read_catalog(f, "json") == (["ИТМО", "ЛЭТИ"], [], [("ИТМО", "ArchNN"), ("ИТМО", "BigData")])
+
+
+@pytest.mark.parametrize("text", [
+    '["ИТМО"]',
+    '{"ИТМО": "ArchNN"}',
+    '{"ИТМО": {"ArchNN": 1}}',
+    '{"ИТМО": ["ArchNN", 1]}',
+    '{"ИТМО": ["ArchNN", ["BigData"]]}',
+    '{"ИТМО": null}',
+])
+def test_json_catalog_must_map_names_to_lists_of_names(text):
+    with pytest.raises(ValueError):
+        read_catalog(io.StringIO(text), "json")
+
+
+def test_csv_catalog():
+    f = io.StringIO("university,subject\nИТМО,ArchNN\n ЛЭТИ ,\n,IRME\n")
+    assert read_catalog(f, "csv") == (["ЛЭТИ"], ["IRME"], [("ИТМО", "ArchNN")])
@@ -0,0 +1,79 @@
+import sqlite3
+
+from tests.fakes import Updates, make_bot, onboard
+
+
+class FakeBacklog:
+    # getUpdates as Telegram serves it: updates at or after `offset`, the ones before it confirmed and gone.
+    def __init__(self, updates):
+        self.updates = list(updates)
+        self.offsets = []
+
+    def __call__(self, offset=None, limit=None, timeout=20, allowed_updates=None, long_polling_timeout=20):
+        self.offsets.append(offset)
+        if offset is not None:
+            self.updates = [update for update in self.updates if update.update_id >= offset]
+        return self.updates[:limit or 100]
+
+
+def _scores(path):
+    con = sqlite3.connect(path)
+    try:
+        return con.execute("SELECT user_id, score FROM score ORDER BY id").fetchall()
+    finally:
+        con.close()
+
+
+def _catch_up(tmp_path, backlog_updates, saved_update_id=None, batch_size=100, **options):
+    bot = make_bot(tmp_path, pending_updates="catch_up", **options)
+    onboard(bot, Updates(first_update_id=1_000_000), 1)
+    if saved_update_id is not None:
+        bot.database.save_update_offset(saved_update_id)
+    backlog = FakeBacklog(backlog_updates)
+    bot.bot_api.get_updates = backlog
+    try:
+        n_updates, n_scores, _ = bot.catch_up(batch_size)
+        return bot, backlog, n_updates, n_scores
+    finally:
+        bot.shutdown()
+
+
+def test_catch_up_handles_the_backlog_in_order(tmp_path):
+    updates = Updates(first_update_id=10)
+    backlog = [updates.message(1, score) for score in ("3", "4", "/help", "5")]
+    bot, _, n_updates, n_scores = _catch_up(tmp_path, backlog, batch_size=2)
+    assert (n_updates, n_scores) == (4, 3)
+    assert _scores(bot.db_path) == [(1, 3), (1, 4), (1, 5)]
+    assert bot.bot_api.last_update_id == 13
+
+
+def test_catch_up_skips_updates_handled_before_a_restart(tmp_path):
+    updates = Updates(first_update_id=10)
+    # 10 and 11 were handled and stored, but not confirmed to Telegram.
+    backlog = [updates.message(1, score) for score in ("3", "4", "5", "6")]
+    bot, _, n_updates, _ = _catch_up(tmp_path, backlog, saved_update_id=11)
+    assert n_updates == 2
+    assert _scores(bot.db_path) == [(1, 5), (1, 6)]
+
+
+def test_catch_up_starts_over_when_update_ids_restart(tmp_path):
+    # After a week without updates Telegram picks the next update id at random, here below the stored one.
+    updates = Updates(first_update_id=500)
+    backlog = [updates.message(1, score) for score in ("3", "4", "5")]
+    bot, get_updates, n_updates, _ = _catch_up(tmp_path, backlog, saved_update_id=9000)
+    assert n_updates == 3
+    assert _scores(bot.db_path) == [(1, 3), (1, 4), (1, 5)]
+    assert bot.database.get_last_update_id() == 502
+    # Nothing was confirmed past the backlog before it was handled.
+    assert get_updates.offsets[:2] == [None, None]
+
+
+def test_catch_up_is_not_rate_limited(tmp_path):
+    # The chat's burst is spent on onboarding, yet every queued update is handled: they were sent over the whole
+    # downtime, not in a burst.
+    updates = Updates(first_update_id=10)
+    backlog = [updates.message(1, "/help") for _ in range(8)]
+    bot, _, n_updates, _ = _catch_up(tmp_path, backlog, chat_rate=0.01, chat_burst=3.0)
+    assert n_updates == 8
+    assert len([text for text in bot.fake_api.sent(1) if text.startswith("Шкала оценивания")]) == 8
+    assert bot.admission.stats()["dropped"] == 0
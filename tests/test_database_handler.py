@@ -0,0 +1,66 @@
+import sqlite3
+import threading
+
+import pytest
+
+from database_handler import SQLiteDB
+
+
+def test_user_state_miss_racing_a_setter_is_not_cached(tmp_path):
+    database = SQLiteDB(str(tmp_path / "db.sqlite"))
+    try:
+        database.append_user(1)
+        execute = database._execute
+
+        def racing_execute(sql, parameters=()):
+            rows = execute(sql, parameters)
+            if sql.startswith("SELECT ready"):
+                # Another thread's setter commits after the SELECT and before its row is cached.
+                database._execute = execute
+                database.set_wait_for_user(1, 2)
+            return rows
+
+        database._execute = racing_execute
+        assert database.get_user_current_state(1).wait_for == 0
+        assert database.get_user_current_state(1).wait_for == 2
+        assert database.get_user_current_state(1).wait_for == 2
+        assert database.cache_stats()["user_state"]["size"] == 1
+    finally:
+        database.close()
+
+
+def test_user_state_setters_write_through(tmp_path):
+    database = SQLiteDB(str(tmp_path / "db.sqlite"))
+    try:
+        database.append_user(1)
+        database.get_user_current_state(1)
+        database.begin_user_awaiting(1, 1, 10, 11)
+        hits = database.cache_stats()["user_state"]["hits"]
+        state = database.get_user_current_state(1)
+        assert (state.wait_for, state.response_message_id, state.request_message_id) == (1, 10, 11)
+        assert database.cache_stats()["user_state"]["hits"] == hits + 1
+    finally:
+        database.close()
+
+
+def test_connection_is_closed_when_its_thread_exits(tmp_path):
+    database = SQLiteDB(str(tmp_path / "db.sqlite"))
+    try:
+        database.append_user(1)
+        connections = []
+
+        def worker():
+            database.get_all_users()
+            connections.append(database._local.connection)
+
+        for _ in range(3):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+        assert len(database._connections) == 1
+        for con in connections:
+            with pytest.raises(sqlite3.ProgrammingError):
+                con.execute("SELECT 1")
+        assert database.get_all_users() == [(1,)]
+    finally:
+        database.close()
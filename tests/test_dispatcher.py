@@ -0,0 +1,89 @@
+import sqlite3
+import threading
+
+from dispatcher import ChatDispatcher
+from tests.fakes import Updates, make_bot, onboard
+
+
+class FakeGetUpdates:
+    # getUpdates over a fixed backlog: returns the updates at or after `offset` and stops polling after `n_polls`.
+    def __init__(self, bot, backlog, n_polls=5):
+        self.bot = bot
+        self.backlog = backlog
+        self.n_polls = n_polls
+        self.offsets = []
+
+    def __call__(self, offset=None, limit=None, timeout=20, allowed_updates=None, long_polling_timeout=20):
+        self.offsets.append(offset)
+        if len(self.offsets) >= self.n_polls:
+            self.bot.bot_api.stop_polling()
+        return [update for update in self.backlog if offset is None or update.update_id >= offset][:limit or 100]
+
+
+def _scores(path):
+    con = sqlite3.connect(path)
+    try:
+        return con.execute("SELECT user_id, score FROM score ORDER BY id").fetchall()
+    finally:
+        con.close()
+
+
+def test_polling_handles_every_update_once(tmp_path):
+    bot = make_bot(tmp_path, dispatch_workers=8, pending_updates="catch_up")
+    updates = Updates()
+    try:
+        onboard(bot, updates, 1)
+        bot.fake_api.calls.clear()
+        backlog = [updates.message(1, score) for score in ("5", "6", "7", "8")]
+        get_updates = FakeGetUpdates(bot, backlog)
+        bot.bot_api.get_updates = get_updates
+        bot.bot_api.polling(non_stop=True, interval=0, timeout=0)
+        bot.dispatcher.join()
+        assert _scores(bot.db_path) == [(1, 5), (1, 6), (1, 7), (1, 8)]
+        assert len(bot.fake_api.sent(1)) == 4
+        assert bot.bot_api.last_update_id == backlog[-1].update_id
+        assert get_updates.offsets[1:] == [backlog[-1].update_id + 1] * (len(get_updates.offsets) - 1)
+    finally:
+        bot.shutdown()
+
+
+def test_updates_of_one_chat_stay_in_order(tmp_path):
+    bot = make_bot(tmp_path, dispatch_workers=4, pending_updates="catch_up")
+    updates = Updates()
+    try:
+        for chat_id in (1, 2, 3):
+            onboard(bot, updates, chat_id)
+        backlog = [updates.message(chat_id, str(i % 11)) for i in range(30) for chat_id in (1, 2, 3)]
+        bot.bot_api.get_updates = FakeGetUpdates(bot, backlog, n_polls=2)
+        bot.bot_api.polling(non_stop=True, interval=0, timeout=0)
+        bot.dispatcher.join()
+        rows = _scores(bot.db_path)
+        for chat_id in (1, 2, 3):
+            assert [score for user_id, score in rows if user_id == chat_id] == [i % 11 for i in range(30)]
+    finally:
+        bot.shutdown()
+
+
+def test_dispatcher_runs_chats_in_parallel():
+    # Two chats on different workers: the second one is handled while the first one blocks.
+    release = threading.Event()
+    handled = []
+
+    def handle(update):
+        if update.chat_id == 0:
+            release.wait(5)
+        handled.append(update.chat_id)
+        if update.chat_id == 1:
+            release.set()
+
+    class Update:
+        def __init__(self, update_id, chat_id):
+            self.update_id = update_id
+            self.chat_id = chat_id
+            self.message = type("Message", (), {"chat": type("Chat", (), {"id": chat_id})})()
+
+    dispatcher = ChatDispatcher(handle, n_workers=2)
+    dispatcher.submit(Update(1, 0))
+    dispatcher.submit(Update(2, 1))
+    dispatcher.stop()
+    assert handled == [1, 0]
@@ -0,0 +1,105 @@
+import random
+
+from database_handler import SQLiteDB
+from live import LiveMeter
+from memory_storage import MemoryDB
+from tests.fakes import make_bot
+
+WINDOW = 600.0
+
+
+def _expected(scores, now, window=WINDOW):
+    # What `LiveMeter.get` should return, computed from scratch over (date, score) pairs.
+    older = [score for date, score in scores if now - window < date <= now - window / 2]
+    newer = [score for date, score in scores if date > now - window / 2]
+    count = len(older) + len(newer)
+    if count == 0:
+        return 0, None, None
+    trend = sum(newer) / len(newer) - sum(older) / len(older) if older and newer else None
+    return count, sum(older + newer) / count, trend
+
+
+def test_scores_leave_the_window():
+    live = LiveMeter(WINDOW)
+    assert live.get(1, 1, now=0) == (0, None, None)
+    live.add(1, 1, 4, 1000)
+    live.add(1, 1, 8, 1100)
+    assert live.get(1, 1, now=1100) == (2, 6.0, None)
+    assert live.get(1, 2, now=1100) == (0, None, None)
+    assert live.get(1, 1, now=1650) == (1, 8.0, None)
+    assert live.get(1, 1, now=1700) == (0, None, None)
+    # The emptied buffer is dropped and starts over with the next score.
+    live.add(1, 1, 2, 5000)
+    assert live.get(1, 1, now=5000) == (1, 2.0, None)
+
+
+def test_trend_is_newer_half_minus_older_half():
+    live = LiveMeter(WINDOW)
+    live.add(1, 1, 2, 1000)
+    live.add(1, 1, 4, 1100)
+    live.add(1, 1, 9, 1400)
+    # 1000 and 1100 are in the older half at 1400, 9 alone in the newer one.
+    assert live.get(1, 1, now=1400) == (3, 5.0, 6.0)
+    # At 1650 the 2 has expired and the 4 is still older.
+    assert live.get(1, 1, now=1650) == (2, 6.5, 5.0)
+    # At 1750 only the 9 is left, in the older half: no trend.
+    assert live.get(1, 1, now=1750) == (1, 9.0, None)
+
+
+def test_dates_out_of_order_are_taken_as_the_last_date():
+    live = LiveMeter(WINDOW)
+    live.add(1, 1, 10, 1000)
+    live.add(1, 1, 0, 100)
+    # The second score counts as dated 1000, so it is still in the window, in the same half as the first.
+    assert live.get(1, 1, now=1000) == (2, 5.0, None)
+    assert live.get(1, 1, now=1599) == (2, 5.0, None)
+    assert live.get(1, 1, now=1600) == (0, None, None)
+
+
+def test_ring_buffer_wraps_and_grows():
+    # Bursts of scores with pauses between them make the buffer both wrap around and grow past its capacity.
+    rng = random.Random(7)
+    live = LiveMeter(WINDOW)
+    scores = []
+    date = 0
+    for burst in range(60):
+        for _ in range(rng.randrange(1, 40)):
+            date += rng.randrange(0, 20)
+            score = rng.randrange(0, 11)
+            live.add(1, 1, score, date)
+            scores.append((date, score))
+            count, mean, trend = live.get(1, 1, now=date)
+            expected_count, expected_mean, expected_trend = _expected(scores, date)
+            assert count == expected_count
+            assert abs(mean - expected_mean) < 1e-9
+            assert (trend is None) == (expected_trend is None)
+            assert trend is None or abs(trend - expected_trend) < 1e-9
+        date += rng.randrange(0, 700)
+    assert max(len(window.dates) for window in live._windows.values()) > 16
+
+
+def test_load_rebuilds_from_recent_scores(tmp_path):
+    rows = [(1, 1, 1, 3, 1000), (2, 1, 1, 7, 1350), (2, 1, 2, 5, 1400), (1, 2, 1, 9, 1400), (1, 1, 1, 1, 200)]
+    for database in (MemoryDB(), SQLiteDB(str(tmp_path / "live.sqlite"))):
+        try:
+            database.append_scores(rows)
+            live = LiveMeter(WINDOW)
+            live.load(database.get_recent_scores(1400 - int(WINDOW)))
+            assert live.get(1, 1, now=1400) == (2, 5.0, 4.0)
+            assert live.get(1, 2, now=1400) == (1, 5.0, None)
+            assert live.get(2, 1, now=1400) == (1, 9.0, None)
+        finally:
+            database.close()
+
+
+def test_bot_rebuilds_the_meter_on_start(tmp_path):
+    bot = make_bot(tmp_path)
+    try:
+        bot.database.append_scores([(1, 1, 1, 4, 10 ** 10), (1, 1, 1, 6, 10 ** 10)])
+    finally:
+        bot.shutdown()
+    bot = make_bot(tmp_path)
+    try:
+        assert bot.live.get(1, 1, now=10 ** 10) == (2, 5.0, None)
+    finally:
+        bot.shutdown()
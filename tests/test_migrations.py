@@ -0,0 +1,92 @@
+import sqlite3
+
+import pytest
+
+import migrations
+from database_handler import SQLiteDB
+from migrations import BUCKET_SECONDS, SCHEMA_VERSION, create_base_schema, migrate
+
+DAY = BUCKET_SECONDS
+
+
+def _legacy_database(path):
+    # A database of the first release: base schema only, `user_version` 0 and dates as the old code wrote them.
+    con = sqlite3.connect(path)
+    create_base_schema(con.cursor())
+    con.execute("INSERT INTO university(id, name) VALUES (1, 'ИТМО')")
+    con.execute("INSERT INTO subject(id, name) VALUES (1, 'ArchNN')")
+    con.execute("INSERT INTO university_subject(university_id, subject_id) VALUES (1, 1)")
+    con.execute("INSERT INTO user_activity(id, ready, university_id, subject_id) VALUES (7, 1, 1, 1)")
+    for score, date in [(2, f'"{10 * DAY}"'), (4, f'"{10 * DAY + 5}"'), (9, f'"{11 * DAY}"'), (5, "'unknown'")]:
+        con.execute(
+            f"INSERT INTO score(user_id, university_id, subject_id, score, date) VALUES (7, 1, 1, {score}, {date})"
+        )
+    con.commit()
+    con.close()
+
+
+def _connect(path):
+    return sqlite3.connect(path, isolation_level=None)
+
+
+def test_legacy_database_is_migrated_with_its_data(tmp_path):
+    path = str(tmp_path / "legacy.sqlite")
+    _legacy_database(path)
+    database = SQLiteDB(path)
+    try:
+        state = database.get_user_current_state(7)
+        assert (state.ready, state.university_id, state.subject_id) == (1, 1, 1)
+        assert [(row[4], row[5]) for row in database.iter_scores()] == [
+            (2, 10 * DAY), (4, 10 * DAY + 5), (9, 11 * DAY), (5, None),
+        ]
+        aggregate = database.get_score_aggregate(1, 1)
+        assert (aggregate.count, aggregate.sum, aggregate.min, aggregate.max) == (4, 20, 2, 9)
+        daily = database.get_daily_score_aggregates(1, 1, 7, now=11 * DAY)
+        assert [(row.bucket, row.count, row.sum) for row in daily] == [(10, 2, 6), (11, 1, 9)]
+        # The trigger keeps the backfilled aggregates up to date.
+        database.append_score(7, 1, 1, 10, 11 * DAY)
+        assert database.get_score_aggregate(1, 1).count == 5
+    finally:
+        database.close()
+    con = _connect(path)
+    try:
+        assert con.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        date_types = con.execute("SELECT DISTINCT typeof(date) FROM score WHERE date IS NOT NULL").fetchall()
+        assert date_types == [("integer",)]
+        indexes = {name for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {"score_university_subject_date", "score_user_date", "university_subject_subject"} <= indexes
+        assert migrate(con) == SCHEMA_VERSION
+    finally:
+        con.close()
+
+
+def test_interrupted_upgrade_resumes_from_the_last_applied_migration(tmp_path, monkeypatch):
+    path = str(tmp_path / "legacy.sqlite")
+    _legacy_database(path)
+
+    def failing_migration(cur):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(migrations, "MIGRATIONS", [migrations.MIGRATIONS[0], failing_migration])
+    con = _connect(path)
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            migrate(con)
+        assert con.execute("PRAGMA user_version").fetchone()[0] == 1
+        assert con.execute("SELECT name FROM sqlite_master WHERE name = 'score_aggregate'").fetchall() == []
+        monkeypatch.undo()
+        assert migrate(con) == SCHEMA_VERSION
+        assert con.execute("SELECT count FROM score_aggregate WHERE bucket = -1").fetchall() == [(4,)]
+    finally:
+        con.close()
+
+
+def test_newer_schema_is_refused(tmp_path):
+    path = str(tmp_path / "future.sqlite")
+    con = _connect(path)
+    try:
+        con.execute(f"PRAGMA user_version={SCHEMA_VERSION + 1}")
+        with pytest.raises(RuntimeError):
+            migrate(con)
+    finally:
+        con.close()
@@ -0,0 +1,112 @@
+import json
+import threading
+
+from telebot import apihelper
+
+from outbound import MAX_DELETE_BATCH, OutboundAPI
+from tests.fakes import Updates, make_bot, onboard
+
+READY = "Я готов к использованию.\nНажми /help, чтобы увидеть справку."
+
+
+class DeletingClient:
+    # Bot API client recording deletions; `delete_messages` is only there with `batched`. The first deletion
+    # waits for `release`, so that the ones queued meanwhile are coalesced.
+    def __init__(self, batched):
+        self.token = "0:test"
+        self.calls = []
+        self.release = threading.Event()
+        if batched:
+            self.delete_messages = self._delete_messages
+
+    def _wait(self):
+        if not self.calls:
+            self.release.wait(5)
+
+    def delete_message(self, chat_id, message_id):
+        self._wait()
+        self.calls.append(("delete_message", chat_id, [message_id]))
+
+    def _delete_messages(self, chat_id, message_ids):
+        self._wait()
+        self.calls.append(("delete_messages", chat_id, list(message_ids)))
+
+
+def _queue_deletions(outbound, client):
+    outbound.delete_messages(1, [1])
+    outbound.delete_messages(1, [2, None])
+    outbound.delete_messages(2, [3, 4])
+    outbound.delete_messages(1, [5])
+    outbound.delete_messages(1, [None])
+    client.release.set()
+    outbound.stop()
+
+
+def test_deletions_are_coalesced_per_chat():
+    client = DeletingClient(batched=True)
+    _queue_deletions(OutboundAPI(client), client)
+    # The first deletion may have been taken before the others were queued.
+    assert client.calls in (
+        [("delete_messages", 1, [1, 2, 5]), ("delete_messages", 2, [3, 4])],
+        [("delete_message", 1, [1]), ("delete_messages", 1, [2, 5]), ("delete_messages", 2, [3, 4])],
+    )
+
+
+def test_clients_without_delete_messages_send_the_request_directly(monkeypatch):
+    requests = []
+
+    def make_request(token, method_name, method="get", params=None, files=None):
+        requests.append((token, method_name, method, params["chat_id"], json.loads(params["message_ids"])))
+        return True
+
+    monkeypatch.setattr(apihelper, "_make_request", make_request)
+    client = DeletingClient(batched=False)
+    client.release.set()
+    outbound = OutboundAPI(client)
+    outbound.delete_messages(1, list(range(MAX_DELETE_BATCH + 1)))
+    outbound.stop()
+    assert requests == [("0:test", "deleteMessages", "post", 1, list(range(MAX_DELETE_BATCH)))]
+    # A single id left over goes out with deleteMessage.
+    assert client.calls == [("delete_message", 1, [MAX_DELETE_BATCH])]
+
+
+def test_unchanged_commands_and_keyboards_are_skipped(tmp_path):
+    bot = make_bot(tmp_path)
+    updates = Updates()
+    try:
+        onboard(bot, updates, 1)
+        for _ in range(2):
+            bot._process_update(updates.message(1, "/start"))
+        calls = [(method, chat_id) for method, chat_id, _ in bot.fake_api.calls]
+        assert calls.count(("set_my_commands", 1)) == 1
+        assert bot.fake_api.sent(1).count(READY) == 1
+        assert bot.outbound.skipped == 4
+        # Removing the keyboard, as the broadcast does, makes the next /start show it again.
+        bot.outbound.remove_reply_keyboard(1, "Новая версия")
+        bot._process_update(updates.message(1, "/start"))
+        assert bot.fake_api.sent(1).count(READY) == 2
+        # A different command list goes out even if one was pushed before.
+        commands = bot._build_command_list()[:2]
+        assert bot.outbound.set_my_commands(1, commands)
+        assert not bot.outbound.set_my_commands(1, commands)
+        assert bot.outbound.set_my_commands(2, commands)
+    finally:
+        bot.shutdown()
+
+
+def test_replaced_menus_are_deleted_in_one_call(tmp_path):
+    bot = make_bot(tmp_path)
+    updates = Updates()
+    try:
+        onboard(bot, updates, 1)
+        bot._process_update(updates.message(1, "/change_subject"))
+        state = bot.database.get_user_current_state(1)
+        bot._process_update(updates.message(1, "/stats"))
+        bot.outbound.stop()
+        deletions = [(method, params) for method, _, params in bot.fake_api.calls if method.startswith("delete")]
+        # Both messages of the menu, in one call; the onboarding menus may or may not have been deleted with them.
+        menu_ids = [state.request_message_id, state.response_message_id]
+        assert any(method == "delete_messages" and params["message_ids"][-2:] == menu_ids
+                   for method, params in deletions)
+    finally:
+        bot.shutdown()
@@ -0,0 +1,155 @@
+from tests.fakes import Updates, make_bot, onboard
+
+
+def _buttons(markup):
+    return [button.text for row in markup.keyboard for button in row]
+
+
+def _last_menu(bot, chat_id):
+    return [
+        params["reply_markup"] for method, call_chat_id, params in bot.fake_api.calls
+        if method == "send_message" and call_chat_id == chat_id and params["reply_markup"] is not None
+    ][-1]
+
+
+def test_picker_keyboards_are_reused_until_the_catalog_changes(tmp_path):
+    bot = make_bot(tmp_path)
+    updates = Updates()
+    try:
+        universities, _ = bot._get_select_markup("university", None, True)
+        itmo_subjects, _ = bot._get_select_markup("subject", 1, True)
+        leti_subjects, _ = bot._get_select_markup("subject", 2, True)
+        assert bot._get_select_markup("university", None, True)[0] is universities
+        onboard(bot, updates, 1, university_id=2, subject_id=3)
+        # A new subject typed by a ЛЭТИ student drops ЛЭТИ's subject keyboards only.
+        bot._process_update(updates.message(1, "/change_subject"))
+        bot._process_update(updates.message(1, "Calculus"))
+        assert bot._get_select_markup("university", None, True)[0] is universities
+        assert bot._get_select_markup("subject", 1, True)[0] is itmo_subjects
+        assert _buttons(bot._get_select_markup("subject", 2, True)[0]) == ["Отмена", "IRME", "Calculus"]
+        assert _buttons(leti_subjects) == ["Отмена", "IRME"]
+        # So does a new university, for the university keyboards.
+        bot._process_update(updates.message(1, "/change_university"))
+        bot._process_update(updates.message(1, "МГУ"))
+        bot._process_update(updates.message(2, "/start"))
+        assert _buttons(_last_menu(bot, 2)) == ["ИТМО", "ЛЭТИ", "СПБГУ", "МГУ"]
+    finally:
+        bot.shutdown()
+
+
+def test_catalog_rows_added_by_another_process_drop_the_university_keyboards(tmp_path):
+    bot = make_bot(tmp_path)
+    other = make_bot(tmp_path)
+    try:
+        universities, _ = bot._get_select_markup("university", None, False)
+        other.database.append_university("МГУ")
+        # Names of other processes are picked up on the next lookup that checks `PRAGMA data_version`.
+        bot.database.find_university("МГУ")
+        markup, n_universities = bot._get_select_markup("university", None, False)
+        assert markup is not universities
+        assert n_universities == 4
+    finally:
+        other.shutdown()
+        bot.shutdown()
+
+
+def _callbacks(markup):
+    return {button.text: button.callback_data for row in markup.keyboard for button in row}
+
+
+def _last_edit(bot):
+    return [params for method, _, params in bot.fake_api.calls if method == "edit_message_reply_markup"][-1]
+
+
+def _answers(bot):
+    return [params["text"] for method, _, params in bot.fake_api.calls if method == "answer_callback_query"]
+
+
+def test_picker_pages(tmp_path):
+    bot = make_bot(tmp_path)
+    updates = Updates()
+    try:
+        bot.database.import_catalog([f"Университет {i:02}" for i in range(1, 15)], [], [])
+        bot._process_update(updates.message(1, "/start"))
+        menu_id = bot.database.get_user_current_state(1).response_message_id
+        first_page = _last_menu(bot, 1)
+        assert _buttons(first_page) == ["ИТМО", "ЛЭТИ", "СПБГУ"] + [f"Университет {i:02}" for i in range(1, 6)] + ["▶"]
+        bot._process_update(updates.callback(1, _callbacks(first_page)["▶"], menu_id))
+        assert _last_edit(bot)["message_id"] == menu_id
+        second_page = _last_edit(bot)["reply_markup"]
+        assert _buttons(second_page) == [f"Университет {i:02}" for i in range(6, 14)] + ["◀", "▶"]
+        bot._process_update(updates.callback(1, _callbacks(second_page)["▶"], menu_id))
+        last_page = _last_edit(bot)["reply_markup"]
+        assert _buttons(last_page) == ["Университет 14", "◀"]
+        bot._process_update(updates.callback(1, _callbacks(last_page)["◀"], menu_id))
+        assert _buttons(_last_edit(bot)["reply_markup"]) == _buttons(second_page)
+        # Pages of another message, or of a menu no longer open, are not shown.
+        n_calls = len(bot.fake_api.calls)
+        bot._process_update(updates.callback(1, _callbacks(first_page)["▶"], menu_id + 1))
+        bot._process_update(updates.callback(1, "university_page:after:x:0", menu_id))
+        assert [call[0] for call in bot.fake_api.calls[n_calls:]] == ["answer_callback_query"] * 2
+    finally:
+        bot.shutdown()
+
+
+def test_similar_names_are_suggested_before_adding(tmp_path):
+    bot = make_bot(tmp_path)
+    updates = Updates()
+    try:
+        bot._process_update(updates.message(1, "/start"))
+        bot._process_update(updates.message(1, "ЛЭТИ СПб"))
+        suggestions = _last_menu(bot, 1)
+        assert _callbacks(suggestions) == {"ЛЭТИ": "university_id:2", "Добавить «ЛЭТИ СПб»": "university_new:"}
+        assert bot.database.find_university("ЛЭТИ СПб") is None
+        # A different spelling of an existing name is that name, no suggestions.
+        bot._process_update(updates.message(2, "/start"))
+        bot._process_update(updates.message(2, "итмо"))
+        assert bot.database.get_user_current_state(2).university_id == 1
+        # "Добавить" on the suggestions adds the typed name and moves on to the subject.
+        suggestions_id = bot.database.get_user_current_state(1).response_message_id
+        bot._process_update(updates.callback(1, "university_new:", suggestions_id))
+        state = bot.database.get_user_current_state(1)
+        assert bot.database.id2university(state.university_id) == "ЛЭТИ СПб"
+        # Awaiting the subject now.
+        assert state.wait_for == 1
+        assert bot.fake_api.sent(1)[-1] == "Напиши название предмета."
+    finally:
+        bot.shutdown()
+
+
+def test_same_name_typed_again_is_added(tmp_path):
+    bot = make_bot(tmp_path)
+    updates = Updates()
+    try:
+        bot._process_update(updates.message(1, "/start"))
+        for _ in range(2):
+            bot._process_update(updates.message(1, "ЛЭТИ СПб"))
+        assert bot.database.get_user_current_state(1).university_id == bot.database.find_university("ЛЭТИ СПб")
+    finally:
+        bot.shutdown()
+
+
+def test_stale_add_buttons_are_refused(tmp_path):
+    bot = make_bot(tmp_path)
+    updates = Updates()
+    try:
+        onboard(bot, updates, 1)
+        bot._process_update(updates.message(1, "/change_university"))
+        bot._process_update(updates.message(1, "ЛЭТИ СПб"))
+        suggestions_id = bot.database.get_user_current_state(1).response_message_id
+        # The menu is replaced by another one: its "Добавить" no longer adds the name.
+        bot._process_update(updates.message(1, "/change_subject"))
+        bot._process_update(updates.callback(1, "university_new:", suggestions_id))
+        # Nor does a subject "Добавить" pressed while a subject menu is open, if it is not that menu.
+        bot._process_update(updates.callback(1, "subject_new:", suggestions_id))
+        assert _answers(bot)[-2:] == ["Это меню уже закрыто.", "Это меню уже закрыто."]
+        assert bot.database.find_university("ЛЭТИ СПб") is None
+        state = bot.database.get_user_current_state(1)
+        assert (state.university_id, state.wait_for) == (1, 1)
+        # Closed altogether.
+        bot._process_update(updates.message(1, "/stats"))
+        bot._process_update(updates.callback(1, "university_new:", suggestions_id))
+        assert _answers(bot)[-1] == "Это меню уже закрыто."
+        assert bot.database.find_university("ЛЭТИ СПб") is None
+    finally:
+        bot.shutdown()
@@ -0,0 +1,110 @@
+import pytest
+import telebot
+
+from router import Router, extract_command
+from tests.fakes import Updates
+
+AWAITING_CHAT_ID = 2
+
+
+def _router(handled):
+    # The same table shape as `CringeMeterBot`, each handler recording its name.
+    def handler(name):
+        return lambda item: handled.append(name)
+
+    router = Router()
+    router.add_callback_prefix("university_id", handler("callback:university"))
+    router.add_callback_prefix("subject_page", handler("callback:page"))
+    router.add_command("start", handler("start"))
+    router.add_command("stats", handler("stats"))
+    router.add_command("start", handler("start:again"))
+    router.add_text("Выбрать предмет", handler("text:change_subject"))
+    router.add_text("Выбранный предмет", handler("text:current_subject"))
+    router.set_awaiting(lambda message: message.chat.id == AWAITING_CHAT_ID, handler("awaiting"))
+    router.set_default(handler("default"))
+    return router
+
+
+def _route_with_telebot(update):
+    # The table installed as a telebot handler chain and evaluated by telebot itself.
+    handled = []
+    bot_api = telebot.TeleBot("0:test", threaded=False)
+    _router(handled).register(bot_api)
+    bot_api.process_new_updates([update])
+    return handled
+
+
+def _route_with_router(update):
+    handled = []
+    _router(handled).dispatch(update)
+    return handled
+
+
+updates = Updates()
+
+MESSAGES = [
+    (1, "/start"),
+    (1, "/start@cringe_meter_bot"),
+    (1, "/start@cringe_meter_bot extra args"),
+    (1, "/stats now"),
+    (1, "/unknown"),
+    (1, "/"),
+    (1, "Выбрать предмет"),
+    (1, "Выбранный предмет"),
+    (1, "выбрать предмет"),
+    (1, "Выбрать предмет "),
+    (1, "7"),
+    (1, "start"),
+    (AWAITING_CHAT_ID, "ИТМО"),
+    (AWAITING_CHAT_ID, "/start"),
+    (AWAITING_CHAT_ID, "Выбранный предмет"),
+    (AWAITING_CHAT_ID, "/unknown"),
+]
+
+CONTENTS = [
+    {"sticker": {"file_id": "s", "file_unique_id": "s", "width": 1, "height": 1, "is_animated": False,
+                 "is_video": False, "type": "regular"}},
+    {"photo": [{"file_id": "p", "file_unique_id": "p", "width": 1, "height": 1}], "caption": "/start"},
+    {"location": {"latitude": 59.9, "longitude": 30.3}},
+]
+
+CALLBACK_DATA = [
+    "university_id:1",
+    "subject_page:2:3",
+    "subject_id:1",
+    "unknown:1",
+    "university_id",
+    ":1",
+    "",
+]
+
+
+@pytest.mark.parametrize("chat_id, text", MESSAGES)
+def test_text_messages_route_like_telebot(chat_id, text):
+    update = updates.message(chat_id, text)
+    assert _route_with_router(update) == _route_with_telebot(update)
+
+
+@pytest.mark.parametrize("content", CONTENTS)
+@pytest.mark.parametrize("chat_id", [1, AWAITING_CHAT_ID])
+def test_other_content_is_not_routed_like_telebot(chat_id, content):
+    update = updates.message(chat_id, content=content)
+    assert _route_with_router(update) == _route_with_telebot(update) == []
+
+
+@pytest.mark.parametrize("data", CALLBACK_DATA)
+def test_callback_queries_route_like_telebot(data):
+    update = updates.callback(1, data)
+    assert _route_with_router(update) == _route_with_telebot(update)
+
+
+def test_routes_are_the_expected_ones():
+    assert _route_with_router(updates.message(1, "/start@cringe_meter_bot")) == ["start"]
+    assert _route_with_router(updates.message(AWAITING_CHAT_ID, "Выбранный предмет")) == ["text:current_subject"]
+    assert _route_with_router(updates.message(AWAITING_CHAT_ID, "/unknown")) == ["awaiting"]
+    assert _route_with_router(updates.callback(1, "unknown:1")) == []
+
+
+@pytest.mark.parametrize("text", ["/start", "/start@bot", "/start@bot a b", "/Start", "/", "start", "", None])
+def test_extract_command_matches_telebot(text):
+    assert extract_command(text) == telebot.util.extract_command(text)
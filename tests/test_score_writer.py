@@ -0,0 +1,87 @@
+import queue
+import threading
+
+import pytest
+
+from database_handler import SQLiteDB
+from score_writer import ScoreWriter
+
+
+class FlakyFlush:
+    # Records flushed batches, raising for the first `n_failures` calls.
+    def __init__(self, n_failures=0):
+        self.n_failures = n_failures
+        self.batches = []
+        self.calls = 0
+
+    def __call__(self, batch):
+        self.calls += 1
+        if self.calls <= self.n_failures:
+            raise RuntimeError("database is locked")
+        self.batches.append(list(batch))
+
+
+def test_stop_flushes_queued_scores(tmp_path):
+    database = SQLiteDB(str(tmp_path / "db.sqlite"), score_batch_size=100, score_flush_interval_ms=60_000)
+    for score in range(5):
+        database.append_score(1, None, None, score, 100)
+    database.close()
+    database = SQLiteDB(str(tmp_path / "db.sqlite"))
+    try:
+        assert [row[4] for row in database.iter_scores()] == [0, 1, 2, 3, 4]
+    finally:
+        database.close()
+
+
+def test_failed_batch_is_kept_for_the_next_flush():
+    flush = FlakyFlush(n_failures=3)
+    writer = ScoreWriter(flush, batch_size=2, flush_interval=0.001, max_retries=2)
+    for score in range(3):
+        writer.put(("row", score))
+    writer.stop()
+    assert [row for batch in flush.batches for row in batch] == [("row", score) for score in range(3)]
+    stats = writer.stats()
+    assert (stats["flushed"], stats["failed_flushes"], stats["dropped"]) == (3, 1, 0)
+
+
+def test_scores_still_failing_on_stop_are_counted_as_dropped():
+    flush = FlakyFlush(n_failures=1000)
+    writer = ScoreWriter(flush, batch_size=10, flush_interval=0.001, max_retries=1)
+    writer.put(("row", 1))
+    writer.stop()
+    assert flush.batches == []
+    assert writer.stats()["dropped"] == 1
+
+
+def test_full_queue_pushes_back_on_producers():
+    flushing = threading.Event()
+    release = threading.Event()
+    flushed = []
+
+    def blocked_flush(batch):
+        flushing.set()
+        release.wait()
+        flushed.extend(batch)
+
+    writer = ScoreWriter(blocked_flush, batch_size=1, flush_interval=0.001, max_queue_size=2, put_timeout=0.05)
+    try:
+        # The first row is taken by the blocked flush, the next two fill the queue.
+        writer.put(("row", 0))
+        assert flushing.wait(5)
+        writer.put(("row", 1))
+        writer.put(("row", 2))
+        with pytest.raises(queue.Full):
+            writer.put(("row", 3))
+    finally:
+        release.set()
+        writer.stop()
+    assert flushed == [("row", 0), ("row", 1), ("row", 2)]
+
+
+def test_stop_is_not_blocked_by_a_full_queue_while_failing():
+    flush = FlakyFlush(n_failures=1000)
+    writer = ScoreWriter(flush, batch_size=1, flush_interval=0.001, max_queue_size=2, max_retries=1)
+    for score in range(3):
+        writer.put(("row", score))
+    writer.stop()
+    assert writer.stats()["dropped"] == 3
@@ -0,0 +1,81 @@
+from migrations import BUCKET_SECONDS
+from tests.fakes import Updates, make_bot, onboard
+
+DAY = BUCKET_SECONDS
+NOW = 100 * DAY + 3600
+
+
+def _stats_text(bot, now=NOW):
+    total = bot.database.get_score_aggregate(1, 1)
+    daily = bot.database.get_daily_score_aggregates(1, 1, 2 * bot.STATS_TREND_DAYS, now)
+    return bot._format_stats("ИТМО", "ArchNN", total, daily, now)
+
+
+def test_stats_show_distribution_and_weekly_trend(tmp_path):
+    bot = make_bot(tmp_path)
+    try:
+        bot.database.append_scores([
+            (1, 1, 1, 8, NOW),
+            (1, 1, 1, 6, NOW - DAY),
+            (2, 1, 1, 4, NOW - 8 * DAY),
+            (2, 1, 1, 2, NOW - 9 * DAY),
+        ])
+        full_bar = "█" * 10
+        assert _stats_text(bot).split("\n") == [
+            "Статистика для ArchNN в ИТМО",
+            "Оценок: 4",
+            "Средний кринж: 5.0 ± 2.2 (от 2 до 8)",
+            "",
+            "Распределение:",
+            " 0  0",
+            " 1  0",
+            f" 2 {full_bar} 1",
+            " 3  0",
+            f" 4 {full_bar} 1",
+            " 5  0",
+            f" 6 {full_bar} 1",
+            " 7  0",
+            f" 8 {full_bar} 1",
+            " 9  0",
+            "10  0",
+            "",
+            "За неделю: 7.0 ↑ (неделей ранее 3.0)",
+        ]
+    finally:
+        bot.shutdown()
+
+
+def test_stats_trend_lines(tmp_path):
+    bot = make_bot(tmp_path)
+    try:
+        bot.database.append_scores([(1, 1, 1, 5, NOW - 3 * DAY), (1, 1, 1, 10, NOW - 3 * DAY)])
+        lines = _stats_text(bot).split("\n")
+        assert lines[-1] == "За неделю: 7.5"
+        # Bars are scaled to the most frequent score.
+        assert (lines[10], lines[15]) == (" 5 " + "█" * 10 + " 1", "10 " + "█" * 10 + " 1")
+        assert _stats_text(bot, now=NOW + 8 * DAY).split("\n")[-1] == "За последнюю неделю оценок не было."
+        bot.database.append_score(1, 1, 1, 7, NOW - 10 * DAY)
+        assert _stats_text(bot).split("\n")[-1] == "За неделю: 7.5 ↑ (неделей ранее 7.0)"
+        bot.database.append_score(1, 1, 1, 8, NOW - 10 * DAY)
+        assert _stats_text(bot).split("\n")[-1] == "За неделю: 7.5 → (неделей ранее 7.5)"
+    finally:
+        bot.shutdown()
+
+
+def test_stats_command(tmp_path):
+    bot = make_bot(tmp_path)
+    updates = Updates()
+    try:
+        bot._process_update(updates.message(1, "/start"))
+        bot._process_update(updates.message(1, "/stats"))
+        assert bot.fake_api.sent(1)[-1] == "Для начала закончи выбор университета и предмета."
+        onboard(bot, updates, 1)
+        bot._process_update(updates.message(1, "/stats"))
+        assert bot.fake_api.sent(1)[-1] == "Для ArchNN пока нет ни одной оценки."
+        bot._process_update(updates.message(1, "9"))
+        bot._process_update(updates.message(1, "/stats"))
+        text = bot.fake_api.sent(1)[-1]
+        assert text.startswith("Статистика для ArchNN в ИТМО\nОценок: 1\nСредний кринж: 9.0 ± 0.0 (от 9 до 9)")
+        assert text.endswith("За неделю: 9.0")
+    finally:
+        bot.shutdown()
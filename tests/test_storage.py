@@ -0,0 +1,218 @@
+import pytest
+
+from database_handler import SQLiteDB
+from memory_storage import MemoryDB
+from migrations import BUCKET_SECONDS
+
+# Both backends go through the same cases: `MemoryDB` is meant to behave exactly like `SQLiteDB`.
+DAY = BUCKET_SECONDS
+NOW = 100 * DAY + 3600
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def database(request, tmp_path):
+    if request.param == "sqlite":
+        database = SQLiteDB(str(tmp_path / "db.sqlite"))
+    else:
+        database = MemoryDB()
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def catalog(database):
+    database.import_catalog(
+        ["ИТМО", "ЛЭТИ"],
+        ["ArchNN", "BigData", "IRME"],
+        [("ИТМО", "ArchNN"), ("ИТМО", "BigData"), ("ЛЭТИ", "IRME")],
+    )
+    return database
+
+
+def test_new_user_state(database):
+    database.append_user(1)
+    database.append_user(1)
+    state = database.get_user_current_state(1)
+    assert (state.ready, state.university_id, state.subject_id, state.wait_for) == (0, None, None, 0)
+    assert (state.response_message_id, state.request_message_id) == (None, None)
+    assert database.get_all_users() == [(1,)]
+    with pytest.raises(IndexError):
+        database.get_user_current_state(2)
+
+
+def test_user_state_setters(catalog):
+    database = catalog
+    database.append_user(1)
+    database.set_university_for_user(1, "1")
+    database.set_subject_for_user(1, 2)
+    database.set_ready_for_user(1)
+    database.begin_user_awaiting(1, 2, 10, 11)
+    state = database.get_user_current_state(1)
+    assert (state.ready, state.university_id, state.subject_id) == (1, 1, 2)
+    assert (state.wait_for, state.response_message_id, state.request_message_id) == (2, 10, 11)
+    database.set_wait_for_user(1, 1)
+    database.set_response_message_id_for_user(1, 20)
+    database.set_request_message_id_for_user(1, None)
+    state = database.get_user_current_state(1)
+    assert (state.wait_for, state.response_message_id, state.request_message_id) == (1, 20, None)
+    database.clear_user_awaiting(1)
+    state = database.get_user_current_state(1)
+    assert (state.wait_for, state.response_message_id, state.request_message_id) == (0, None, None)
+
+
+def test_catalog_import_returns_what_was_inserted(catalog):
+    database = catalog
+    universities, subjects, links = database.import_catalog(["ИТМО", "СПБГУ"], ["IRME"], [("СПБГУ", "Calculus")])
+    assert universities == [(3, "СПБГУ")]
+    assert subjects == [(4, "Calculus")]
+    assert links == [("СПБГУ", "Calculus")]
+    assert database.import_catalog(["ИТМО"], ["IRME"], [("СПБГУ", "Calculus")]) == ([], [], [])
+    assert database.get_all_universities() == [(1, "ИТМО"), (2, "ЛЭТИ"), (3, "СПБГУ")]
+    assert database.get_university_subjects(1) == [(1,), (2,)]
+    assert database.get_university_subject_names(1) == [(1, "ArchNN"), (2, "BigData")]
+    assert database.get_university_subject_names(3) == [(4, "Calculus")]
+    # Ids taken from callback data are strings.
+    assert database.get_university_subjects("1") == [(1,), (2,)]
+    assert database.get_university_subject_names("3") == [(4, "Calculus")]
+
+
+def test_converters(catalog):
+    database = catalog
+    assert database.id2university("2") == "ЛЭТИ"
+    assert database.university2id("ИТМО") == 1
+    assert database.id2subject(3) == "IRME"
+    assert database.subject2id("BigData") == 2
+    for converter, key in [
+        (database.id2university, 9),
+        (database.university2id, "МГУ"),
+        (database.id2subject, 9),
+        (database.subject2id, "Calculus"),
+    ]:
+        with pytest.raises(IndexError):
+            converter(key)
+
+
+def test_catalog_listeners_see_actual_inserts_only(catalog):
+    database = catalog
+    events = []
+    database.add_catalog_listener(lambda table, university_id: events.append((table, university_id)))
+    database.append_university("ИТМО")
+    database.append_subject_to_university(1, 1)
+    assert events == []
+    database.append_university("СПБГУ")
+    database.append_subject_to_university(2, 1)
+    assert events == [("university", None), ("university_subject", 2)]
+    events.clear()
+    database.append_user(1)
+    database.set_university_for_user(1, 2)
+    database.register_and_select_subject(1, "Calculus")
+    database.register_and_select_university(1, "МГУ")
+    assert events == [("university_subject", 2), ("university", None)]
+    state = database.get_user_current_state(1)
+    assert (database.id2university(state.university_id), database.id2subject(state.subject_id)) == ("МГУ", "Calculus")
+    assert database.get_university_subject_names(2) == [(1, "ArchNN"), (3, "IRME"), (4, "Calculus")]
+
+
+def test_keyset_pages(database):
+    universities = [f"Университет {i}" for i in range(1, 8)]
+    database.import_catalog(universities, [], [("Университет 1", f"S{i}") for i in range(5)])
+    ids = [row[0] for row in database.get_universities_page(limit=3)]
+    assert ids == [1, 2, 3]
+    assert [row[0] for row in database.get_universities_page(after_id=3, limit=3)] == [4, 5, 6]
+    assert [row[0] for row in database.get_universities_page(after_id="6", limit=3)] == [7]
+    assert [row[0] for row in database.get_universities_page(before_id=4, limit=2)] == [2, 3]
+    assert [row[0] for row in database.get_universities_page(before_id=2, limit=3)] == [1]
+    page = database.get_university_subjects_page(1, after_id=2, limit=2)
+    assert page == [(3, "S2"), (4, "S3")]
+    assert database.get_university_subjects_page("1", before_id=3, limit=5) == [(1, "S0"), (2, "S1")]
+    assert database.get_university_subjects_page(2) == []
+
+
+def test_find_and_search(catalog):
+    database = catalog
+    assert database.find_university("итмо") == 1
+    assert database.find_university("МГУ") is None
+    assert database.find_subject("bigdata") == 2
+    assert [name for _, name in database.search_universities("ЛЭТ")] == ["ЛЭТИ"]
+    assert database.search_subjects("IRME", university_id=1) == []
+    assert database.search_subjects("IRME", university_id="2") == [(3, "IRME")]
+    assert database.search_subjects("big data", limit=1) == [(2, "BigData")]
+
+
+def test_score_aggregates(catalog):
+    database = catalog
+    database.append_score(1, 1, 1, 2, NOW - DAY)
+    database.append_scores([(1, 1, 1, 4, NOW), (2, 1, 1, 9, NOW), (2, 1, 2, 5, NOW), (3, None, None, 7, NOW)])
+    aggregate = database.get_score_aggregate(1, 1)
+    assert (aggregate.count, aggregate.sum, aggregate.sum_sq, aggregate.min, aggregate.max) == (3, 15, 101, 2, 9)
+    assert aggregate.histogram[2] == aggregate.histogram[4] == aggregate.histogram[9] == 1
+    assert sum(aggregate.histogram) == 3
+    assert aggregate.mean == 5
+    assert database.get_score_aggregate(2, 3) is None
+    daily = database.get_daily_score_aggregates(1, 1, 7, now=NOW)
+    assert [(row.bucket, row.count, row.sum) for row in daily] == [(NOW // DAY - 1, 1, 2), (NOW // DAY, 2, 13)]
+    assert database.get_daily_score_aggregates(1, 1, 1, now=NOW)[0].count == 2
+    assert database.get_score_aggregate("1", "1").count == 3
+    assert [row.count for row in database.get_daily_score_aggregates("1", "1", 7, now=NOW)] == [1, 2]
+    database.append_score("1", "1", "1", 3, NOW)
+    assert database.get_score_aggregate(1, 1).count == 4
+
+
+def test_iter_and_recent_scores(catalog):
+    database = catalog
+    database.append_scores([(1, 1, 1, 2, NOW - DAY), (1, 1, 2, 4, NOW), (2, 2, 3, 9, NOW + 1), (3, None, None, 7, NOW)])
+    rows = list(database.iter_scores())
+    assert [row[1:] for row in rows] == [
+        (1, "ИТМО", "ArchNN", 2, NOW - DAY),
+        (1, "ИТМО", "BigData", 4, NOW),
+        (2, "ЛЭТИ", "IRME", 9, NOW + 1),
+        (3, None, None, 7, NOW),
+    ]
+    assert [row[0] for row in rows] == sorted(row[0] for row in rows)
+    assert [row[4] for row in database.iter_scores(university_id=1)] == [2, 4]
+    assert [row[4] for row in database.iter_scores(university_id=1, subject_id=2)] == [4]
+    assert [row[4] for row in database.iter_scores(university_id="1", subject_id="2")] == [4]
+    assert [row[4] for row in database.iter_scores(since=NOW, until=NOW + 1)] == [4, 7]
+    assert [row[4] for row in database.iter_scores(chunk_size=1)] == [2, 4, 9, 7]
+    assert database.get_recent_scores(NOW) == [(1, 2, 4, NOW), (2, 3, 9, NOW + 1)]
+
+
+def test_compaction_keeps_aggregates(catalog):
+    database = catalog
+    database.append_scores([(1, 1, 1, 2, NOW - 10 * DAY), (1, 1, 1, 4, NOW - DAY), (1, 1, 1, 6, NOW)])
+    assert database.compact_scores(NOW - 2 * DAY, batch_size=1, pause=0) == 1
+    assert [row[4] for row in database.iter_scores()] == [4, 6]
+    assert database.get_score_aggregate(1, 1).count == 3
+    assert database.compact_scores(NOW - 2 * DAY, pause=0) == 0
+    assert database.incremental_vacuum() >= 0
+
+
+def test_broadcasts_and_blocked_chats(database):
+    for chat_id in (1, 2, 3):
+        database.append_user(chat_id)
+    database.block_chat(3, "blocked")
+    assert database.get_unfinished_broadcast() is None
+    broadcast_id = database.create_broadcast("Новая версия")
+    assert database.get_unfinished_broadcast() == (broadcast_id, "Новая версия")
+    assert sorted(database.get_pending_broadcast_recipients(broadcast_id)) == [1, 2]
+    database.update_broadcast_recipients([(1, broadcast_id, 1)])
+    assert database.get_pending_broadcast_recipients(broadcast_id) == [2]
+    database.block_chat(2)
+    assert database.get_pending_broadcast_recipients(broadcast_id) == []
+    database.unblock_chat(2)
+    assert database.get_pending_broadcast_recipients(broadcast_id) == [2]
+    database.finish_broadcast(broadcast_id)
+    assert database.get_unfinished_broadcast() is None
+    second_id = database.create_broadcast("Ещё одна")
+    assert second_id != broadcast_id
+    assert sorted(database.get_pending_broadcast_recipients(second_id)) == [1, 2]
+
+
+def test_update_offset_is_saved_with_its_scores(catalog):
+    database = catalog
+    assert database.get_last_update_id() is None
+    database.save_update_offset(10, [(1, 1, 1, 5, NOW), (1, 1, 1, 7, NOW)])
+    database.save_update_offset(12)
+    assert database.get_last_update_id() == 12
+    assert [row[4] for row in database.iter_scores()] == [5, 7]
+    assert database.get_score_aggregate(1, 1).count == 2
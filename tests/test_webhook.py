@@ -0,0 +1,260 @@
+import asyncio
+import itertools
+import json
+import sqlite3
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from telebot import asyncio_helper
+
+from metrics import Metrics
+from tests.fakes import NO_ADMISSION, Updates
+from webhook import AsyncCringeMeterBot, build_webhook_app
+
+SECRET = "secret"
+
+
+class StubBotAPI:
+    # Bot API server answering every method with success and recording the calls as (method, form fields),
+    # uploaded files as their content.
+    def __init__(self):
+        self.calls = []
+        self._message_ids = itertools.count(1_000_000)
+        self.app = web.Application()
+        # telebot's async client sends its form data with GET requests.
+        self.app.router.add_route("*", "/bot{token}/{method}", self.handle)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.clone(method="POST").post())
+        for name, value in params.items():
+            if isinstance(value, web.FileField):
+                params[name] = value.file.read()
+        self.calls.append((method, params))
+        result = True
+        if method in ("sendMessage", "sendDocument"):
+            result = {
+                "message_id": next(self._message_ids),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "date": int(time.time()),
+                "text": params.get("text", ""),
+            }
+        return web.json_response({"ok": True, "result": result})
+
+    def called(self, method, chat_id=None):
+        return [
+            params for called_method, params in self.calls
+            if called_method == method and (chat_id is None or params.get("chat_id") == str(chat_id))
+        ]
+
+    def sent(self, chat_id):
+        return [params["text"] for params in self.called("sendMessage", chat_id)]
+
+
+def run_webhook_test(tmp_path, scenario, webhook_url=None, **options):
+    # Runs `scenario(bot, client, api)` against the webhook app, with the bot's Bot API calls going to a stub.
+    async def main():
+        api = StubBotAPI()
+        async with TestServer(api.app) as api_server:
+            api_url = asyncio_helper.API_URL
+            asyncio_helper.API_URL = str(api_server.make_url("/")) + "bot{0}/{1}"
+            try:
+                bot = AsyncCringeMeterBot(
+                    "0:test", str(tmp_path / "bot.sqlite"), debug=True, db_workers=2, **{**NO_ADMISSION, **options}
+                )
+                app = build_webhook_app(bot, secret_token=SECRET, webhook_url=webhook_url)
+                async with TestClient(TestServer(app)) as client:
+                    await scenario(bot, client, api)
+            finally:
+                asyncio_helper.API_URL = api_url
+
+    asyncio.run(main())
+
+
+async def post(client, bot, update_json, secret=SECRET):
+    response = await client.post("/webhook", json=update_json, headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+    await bot.join()
+    return response.status
+
+
+async def onboard(client, bot, updates, chat_id):
+    assert await post(client, bot, updates.message_json(chat_id, "/start")) == 200
+    for data in ("university_id:1", "subject_id:1"):
+        message_id = bot.database.get_user_current_state(chat_id).response_message_id
+        assert await post(client, bot, updates.callback_json(chat_id, data, message_id)) == 200
+    assert bot.database.get_user_current_state(chat_id).ready == 1
+
+
+async def wait_for_documents(api, chat_id, n_documents=1):
+    # Exports are sent from their own thread, after the update is handled.
+    deadline = time.monotonic() + 5
+    while len(api.called("sendDocument", chat_id)) < n_documents and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    return api.called("sendDocument", chat_id)
+
+
+def _scores(path):
+    con = sqlite3.connect(path)
+    try:
+        return con.execute("SELECT user_id, score FROM score ORDER BY id").fetchall()
+    finally:
+        con.close()
+
+
+def test_webhook_runs_the_conversation(tmp_path):
+    updates = Updates()
+
+    async def scenario(bot, client, api):
+        await onboard(client, bot, updates, 1)
+        assert len(api.called("setMyCommands")) == 1
+        for text in ("5", "7"):
+            await post(client, bot, updates.message_json(1, text))
+        replies = api.sent(1)[-2:]
+        assert [reply.split("\n")[0] for reply in replies] == [f"Записал {score} для ArchNN в ИТМО" for score in (5, 7)]
+
+    run_webhook_test(tmp_path, scenario)
+    assert _scores(str(tmp_path / "bot.sqlite")) == [(1, 5), (1, 7)]
+
+
+def test_webhook_skips_unchanged_commands_and_keyboard(tmp_path):
+    updates = Updates()
+
+    async def scenario(bot, client, api):
+        await onboard(client, bot, updates, 1)
+        n_messages = len(api.sent(1))
+        await post(client, bot, updates.message_json(1, "/start"))
+        # The welcome and the current choice again, without the keyboard message.
+        assert len(api.sent(1)) == n_messages + 3
+        assert not any(text.startswith("Я готов") for text in api.sent(1)[n_messages:])
+        assert len(api.called("setMyCommands")) == 1
+
+    run_webhook_test(tmp_path, scenario)
+
+
+def test_webhook_admin_commands_are_not_scores(tmp_path):
+    updates = Updates()
+
+    async def scenario(bot, client, api):
+        await onboard(client, bot, updates, 1)
+        await post(client, bot, updates.message_json(1, "5"))
+        await post(client, bot, updates.message_json(1, "/kon_metrics"))
+        assert api.sent(1)[-1].startswith("Метрики выключены")
+        await post(client, bot, updates.message_json(1, "/kon_export"))
+        assert [params["caption"] for params in await wait_for_documents(api, 1)] == ["Оценок: 1"]
+
+    run_webhook_test(tmp_path, scenario, admin_ids=[1])
+    assert _scores(str(tmp_path / "bot.sqlite")) == [(1, 5)]
+
+
+def test_webhook_rejects_bad_requests(tmp_path):
+    updates = Updates()
+
+    async def scenario(bot, client, api):
+        assert await post(client, bot, updates.message_json(1, "/start"), secret="wrong") == 403
+        headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET, "Content-Type": "application/json"}
+        response = await client.post("/webhook", data="{", headers=headers)
+        assert response.status == 400
+        # Valid JSON that is not an Update.
+        message = updates.message_json(1, "/start")["message"]
+        for update_json in (
+                [1, 2],
+                {"message": message},
+                {"update_id": 1, "message": {}},
+                {"update_id": 1, "message": {**message, "entities": 5}},
+        ):
+            assert await post(client, bot, update_json) == 400
+        assert api.calls == []
+
+    run_webhook_test(tmp_path, scenario)
+
+
+def test_webhook_metrics_time_the_async_client(tmp_path):
+    updates = Updates()
+
+    async def scenario(bot, client, api):
+        await onboard(client, bot, updates, 1)
+        await post(client, bot, updates.message_json(1, "5"))
+        await post(client, bot, updates.message_json(1, "/kon_metrics"))
+        summary = api.sent(1)[-1]
+        assert "api sendMessage: " in summary
+        assert "handler on_get_score: 1 calls" in summary
+
+    run_webhook_test(tmp_path, scenario, admin_ids=[1], metrics=Metrics())
+
+
+def test_webhook_export_sends_the_scores(tmp_path):
+    updates = Updates()
+
+    async def scenario(bot, client, api):
+        for chat_id in (1, 2):
+            await onboard(client, bot, updates, chat_id)
+        for chat_id, text in ((1, "5"), (2, "9")):
+            await post(client, bot, updates.message_json(chat_id, text))
+        await post(client, bot, updates.message_json(2, "/kon_export"))
+        await post(client, bot, updates.message_json(1, "/kon_export jsonl"))
+        documents = await wait_for_documents(api, 1)
+        assert [params["caption"] for params in documents] == ["Оценок: 2"]
+        lines = documents[0]["document"].decode().splitlines()
+        assert [json.loads(line)["score"] for line in lines] == [5, 9]
+        assert api.called("sendDocument", 2) == []
+
+    run_webhook_test(tmp_path, scenario, admin_ids=[1])
+
+
+def test_webhook_keeps_pending_updates_for_catch_up(tmp_path):
+    drop_pending_updates = {}
+
+    async def scenario(bot, client, api):
+        [params] = api.called("setWebhook")
+        assert params["url"] == "https://example.org/webhook"
+        drop_pending_updates[bot.pending_updates] = params.get("drop_pending_updates")
+
+    for pending_updates in ("skip", "catch_up"):
+        (tmp_path / pending_updates).mkdir()
+        run_webhook_test(
+            tmp_path / pending_updates,
+            scenario,
+            webhook_url="https://example.org/webhook",
+            pending_updates=pending_updates,
+        )
+    assert drop_pending_updates == {"skip": "True", "catch_up": "False"}
+
+
+def test_webhook_stores_held_scores_in_the_chats_turn(tmp_path):
+    updates = Updates()
+    apis = []
+
+    async def scenario(bot, client, api):
+        await onboard(client, bot, updates, 1)
+        api.calls.clear()
+        for text in ("5", "6", "7", "/help", "8"):
+            await post(client, bot, updates.message_json(1, text))
+        apis.append(api)
+
+    # The score after /help is still held when the app stops, and stored on cleanup.
+    run_webhook_test(tmp_path, scenario, score_coalesce_window=60)
+    assert _scores(str(tmp_path / "bot.sqlite")) == [(1, 5), (1, 7), (1, 8)]
+    replies = [reply.split("\n")[0] for reply in apis[0].sent(1)]
+    assert replies == [
+        "Записал 5 для ArchNN в ИТМО",
+        "Записал 7 для ArchNN в ИТМО (последнюю из 2 оценок подряд)",
+        "Шкала оценивания: 0 - ноль кринжа, 10 - кринжевый кринж.",
+        "Записал 8 для ArchNN в ИТМО",
+    ]
+
+
+def test_webhook_deletes_replaced_menus_in_one_request(tmp_path):
+    updates = Updates()
+
+    async def scenario(bot, client, api):
+        await onboard(client, bot, updates, 1)
+        await post(client, bot, updates.message_json(1, "/change_subject"))
+        state = bot.database.get_user_current_state(1)
+        await post(client, bot, updates.message_json(1, "/stats"))
+        await asyncio.get_running_loop().run_in_executor(None, bot.outbound.stop)
+        # Earlier deletions of the chat may have gone out in the same request.
+        menu_ids = [state.request_message_id, state.response_message_id]
+        assert menu_ids in [json.loads(params["message_ids"])[-2:] for params in api.called("deleteMessages", 1)]
+
+    run_webhook_test(tmp_path, scenario)
@@ -0,0 +1,195 @@
+import asyncio
+import functools
+import hmac
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import telebot
+from aiohttp import web
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from dispatcher import update_chat_id
+from main import CringeMeterBot
+
+__all__ = ["AsyncCringeMeterBot", "LoopBotAPI", "build_webhook_app", "run_webhook", ]
+
+logger = logging.getLogger(__name__)
+
+
+class LoopBotAPI:
+    # Synchronous face of an `AsyncTeleBot` for code running in worker threads: every Bot API call is made by the
+    # async client on the event loop, and the calling thread waits for its result. `loop` is set once it runs.
+    def __init__(self, async_api: AsyncTeleBot):
+        self.async_api = async_api
+        self.loop = None
+
+    def __getattr__(self, name):
+        method = getattr(self.async_api, name)
+        if not asyncio.iscoroutinefunction(method):
+            return method
+
+        def call(*args, **kwargs):
+            return self._run(method(*args, **kwargs))
+
+        return call
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def delete_messages(self, chat_id, message_ids):
+        # Missing from the pinned async client, like from the synchronous one (see `OutboundAPI`).
+        params = {"chat_id": chat_id, "message_ids": json.dumps(message_ids)}
+        return self._run(
+            asyncio_helper._process_request(self.async_api.token, "deleteMessages", method="post", params=params)
+        )
+
+    def stop_polling(self) -> None:
+        # Updates come from the webhook, there is nothing to stop.
+        pass
+
+
+class AsyncCringeMeterBot(CringeMeterBot):
+    # `CringeMeterBot` behind a webhook: the same routing table and handlers, with Bot API requests made by an
+    # asyncio client. Handlers, and with them the blocking database calls, run in a dedicated executor so that
+    # they never stall the event loop; their Bot API calls go through `LoopBotAPI`. Updates of one chat are
+    # handled in order, like in the threaded dispatcher.
+    def __init__(self, api_token, sqlite_db_path, debug=False, db_workers=4, **options):
+        options["dispatch_workers"] = 0
+        super().__init__(api_token, sqlite_db_path, debug, **options)
+        if self.metrics is not None:
+            self.metrics.instrument_async_bot_api()
+        self._handler_executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="handler")
+        self._chat_locks = {}
+        self._tasks = set()
+
+    def _create_bot_api(self, api_token, skip_pending, threaded):
+        self.async_api = AsyncTeleBot(api_token)
+        return LoopBotAPI(self.async_api)
+
+    def _register_handlers(self):
+        # Updates are routed by `process_update`, not by a telebot handler chain.
+        pass
+
+    async def start_async(self, webhook_url=None, secret_token=None):
+        # `webhook_url` is the public address registered with Telegram, None keeps the current registration.
+        # Updates sent while the bot was down are delivered to the webhook unless `pending_updates` is "skip".
+        self.bot_api.loop = asyncio.get_running_loop()
+        if webhook_url is not None:
+            await self.async_api.set_webhook(
+                url=webhook_url,
+                secret_token=secret_token,
+                drop_pending_updates=self.pending_updates == "skip",
+            )
+        self.resume_broadcast()
+
+    async def shutdown_async(self):
+        loop = asyncio.get_running_loop()
+        # Background workers still send through the loop while they stop, so they are stopped off it. Held
+        # scores are handed to their chats first, and stored by the last `join`.
+        await loop.run_in_executor(None, self.admission.stop)
+        await self.join()
+        await loop.run_in_executor(None, self.shutdown)
+        await self.async_api.close_session()
+        self._handler_executor.shutdown()
+
+    async def join(self):
+        # Waits for every update submitted so far.
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    # Updates
+
+    def submit_update(self, update):
+        # Schedules the update and returns at once, the webhook response must not wait for handlers.
+        return self._create_task(self.process_update(update))
+
+    def _create_task(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _run_in_chat(self, chat_id, function):
+        # Called from other threads, e.g. by `self.admission`.
+        def run():
+            try:
+                function()
+            except Exception:
+                logger.exception(f"Failed to run {function} in chat {chat_id}")
+
+        self.bot_api.loop.call_soon_threadsafe(lambda: self._create_task(self._call_in_chat(chat_id, run)))
+
+    def _handle_update(self, update):
+        try:
+            self._process_update(update)
+        except Exception:
+            logger.exception(f"Failed to handle update {update.update_id}")
+
+    async def process_update(self, update):
+        await self._call_in_chat(update_chat_id(update), functools.partial(self._handle_update, update))
+
+    async def _call_in_chat(self, chat_id, function):
+        # Runs `function()` in the handler executor, after the calls of the same chat made before it.
+        loop = asyncio.get_running_loop()
+        if chat_id is None:
+            await loop.run_in_executor(self._handler_executor, function)
+            return
+        # Locks are dropped as soon as nobody holds or waits for them.
+        entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await loop.run_in_executor(self._handler_executor, function)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat_id]
+
+
+def build_webhook_app(
+        bot: AsyncCringeMeterBot,
+        path: str = "/webhook",
+        secret_token: str = None,
+        webhook_url: str = None,
+) -> web.Application:
+    async def handle(request: web.Request) -> web.Response:
+        if secret_token is not None:
+            received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(received, secret_token):
+                return web.Response(status=403)
+        # Anything that is not an Update is answered with 400, Telegram would keep retrying a 500.
+        try:
+            update = telebot.types.Update.de_json(await request.json())
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        bot.submit_update(update)
+        return web.Response()
+
+    async def on_startup(app):
+        await bot.start_async(webhook_url, secret_token)
+
+    async def on_cleanup(app):
+        await bot.shutdown_async()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run_webhook(
+        bot: AsyncCringeMeterBot,
+        host: str = "0.0.0.0",
+        port: int = 8080,
+        path: str = "/webhook",
+        webhook_url: str = None,
+        secret_token: str = None,
+        api_url: str = None,
+) -> None:
+    # `api_url` points the async client at another Bot API server, e.g. a local one or a test stub.
+    if api_url is not None:
+        asyncio_helper.API_URL = api_url
+    web.run_app(build_webhook_app(bot, path, secret_token, webhook_url), host=host, port=port)